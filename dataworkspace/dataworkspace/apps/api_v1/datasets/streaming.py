@@ -0,0 +1,258 @@
+"""
+Encoding of pages of rows of the dataset API, chunked for streaming
+
+Pages are JSON by default, with the rows and the URL of the next page in one document, or
+NDJSON or Arrow IPC streams if the client asks for them in its Accept header, so it can
+process rows as they arrive. In all formats, pages are paginated with $searchAfter, and
+can be bounded with $searchUpTo, so disjoint ranges of rows can be fetched in parallel.
+
+These don't depend on Django, so they can be benchmarked on their own, for example by
+test/benchmark_dataset_api_streaming.py
+"""
+
+import itertools
+import json
+from urllib.parse import quote
+
+from dataworkspace.apps.core.parquet import ArrowStreamWriter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """
+    Returns value encoded as JSON, e.g. b'[[1,"a"],[2,"b"]]' for a list of rows. Values that
+    aren't JSON types, such as datetimes and decimals, are encoded as strings, as str would
+    format them. orjson is used if it's installed, since per row json.dumps is much of the
+    CPU time of the dataset API
+
+    NaN and infinite floats are encoded as NaN, Infinity and -Infinity, as json encodes them,
+    whether or not orjson is used
+    """
+    if orjson is not None:
+        try:
+            # orjson would otherwise format datetimes as RFC 3339, rather than as str does
+            encoded = orjson.dumps(value, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            # For example integers larger than 64 bits, which json can encode
+            pass
+        else:
+            # orjson encodes non-finite floats as null, so if there are more nulls than Nones
+            # there could be one. Nested Nones and strings containing "null" also make more,
+            # but that only means the value is encoded again with json
+            if b"null" not in encoded or encoded.count(b"null") == _num_nones(value):
+                return encoded
+    return json.dumps(value, default=str).encode("utf-8")
+
+
+def _num_nones(value):
+    # Of value, or of the lists and tuples in it, e.g. of a list of rows, without iterating
+    # over every item of every row
+    if isinstance(value, dict):
+        value = list(value.values())
+    if not isinstance(value, (list, tuple)):
+        return int(value is None)
+    return value.count(None) + sum(
+        item.count(None) for item in value if isinstance(item, (list, tuple))
+    )
+
+
+class ByteChunker:
+    """
+    Collects bytes and returns them in chunks of chunk_size bytes. Bytes are copied once into
+    the buffer and once into their chunk, however many chunks they're collected over, rather
+    than the buffer being joined and re-sliced for each chunk
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.num_bytes = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """
+        Adds data, and returns the list of chunks that are now complete
+        """
+        self.num_bytes += len(data)
+        self._buffer += data
+        num_chunked_bytes = len(self._buffer) - len(self._buffer) % self.chunk_size
+        if not num_chunked_bytes:
+            return []
+
+        with memoryview(self._buffer) as view:
+            chunks = [
+                bytes(view[start : start + self.chunk_size])
+                for start in range(0, num_chunked_bytes, self.chunk_size)
+            ]
+        # Less than a chunk is left, so this moves fewer than chunk_size bytes
+        del self._buffer[:num_chunked_bytes]
+        return chunks
+
+    def flush(self):
+        """
+        Returns the list of the remaining bytes as a chunk, if there are any
+        """
+        chunks = [bytes(self._buffer)] if self._buffer else []
+        self._buffer.clear()
+        return chunks
+
+
+class JsonPageEncoder:
+    """
+    {"headers": [...], "values": [[...], ...], "next": "..."}, where next is null on the
+    last page
+    """
+
+    content_type = "application/json"
+
+    def __init__(self, cursor_description):
+        self._has_rows = False
+
+    def start(self, columns):
+        return b'{"headers": ' + dumps(columns) + b', "values": ['
+
+    def prepare(self, rows):
+        return memoryview(dumps(rows))[1:-1]
+
+    def size(self, prepared):
+        return len(prepared) + self._has_rows
+
+    def write(self, prepared):
+        rows_bytes = b"," + prepared if self._has_rows else prepared
+        self._has_rows = True
+        return rows_bytes
+
+    def end(self, next_url):
+        return b'], "next": ' + dumps(next_url) + b"}"
+
+
+class NdjsonPageEncoder:
+    """
+    A line of {"headers": [...]}, then a line for each row as a JSON array, then a line of
+    {"next": "..."}, where next is null on the last page
+    """
+
+    content_type = "application/x-ndjson"
+
+    def __init__(self, cursor_description):
+        pass
+
+    def start(self, columns):
+        return dumps({"headers": columns}) + b"\n"
+
+    def prepare(self, rows):
+        return b"".join(dumps(row) + b"\n" for row in rows)
+
+    def size(self, prepared):
+        return len(prepared)
+
+    def write(self, prepared):
+        return prepared
+
+    def end(self, next_url):
+        return dumps({"next": next_url}) + b"\n"
+
+
+class ArrowPageEncoder:
+    """
+    An Arrow IPC stream of the rows, of the same types as Parquet downloads. If there is a next
+    page, the stream ends with an empty record batch with its URL as the custom metadata "next"
+    """
+
+    content_type = "application/vnd.apache.arrow.stream"
+
+    def __init__(self, cursor_description):
+        self._writer = ArrowStreamWriter(cursor_description)
+
+    def start(self, columns):
+        return b""
+
+    def prepare(self, rows):
+        return self._writer.record_batch(rows)
+
+    def size(self, prepared):
+        # Only approximate, since it excludes the IPC message headers and the schema
+        return prepared.nbytes
+
+    def write(self, prepared):
+        return self._writer.write_batch(prepared)
+
+    def end(self, next_url):
+        return self._writer.close({"next": next_url} if next_url is not None else None)
+
+
+PAGE_ENCODERS = (JsonPageEncoder, NdjsonPageEncoder, ArrowPageEncoder)
+
+
+def get_page_encoder_class(accepted_types):
+    """
+    Returns the first of PAGE_ENCODERS that encodes a type in accepted_types, the parsed
+    Accept header of a request, or JsonPageEncoder if there isn't one, as before pages could
+    be encoded in other formats
+    """
+    for accepted_type in accepted_types:
+        for encoder_class in PAGE_ENCODERS:
+            if accepted_type.match(encoder_class.content_type):
+                return encoder_class
+    return JsonPageEncoder
+
+
+def get_search_query(search_after=(), search_up_to=()):
+    """
+    Returns the query string of the page of the dataset API of the rows with primary keys
+    greater than search_after and no greater than search_up_to, where either can be empty
+    """
+    return "&".join(
+        [f"$searchAfter={quote(str(value))}" for value in search_after]
+        + [f"$searchUpTo={quote(str(value))}" for value in search_up_to]
+    )
+
+
+def yield_page(
+    encoder,
+    primary_key,
+    columns,
+    rows,
+    base_url,
+    search_up_to=(),
+    num_bytes_max=49_990_000,
+    batch_size=1000,
+    chunk_size=16384,
+):
+    """
+    Yields a page of the dataset API as chunks encoded by encoder, with as many rows as fit in
+    num_bytes_max bytes, and if there are more rows, the URL of the next page. The next page
+    keeps the same upper bound, search_up_to, as this page
+
+    Rows are encoded a batch at a time, since the overhead of each call to the encoder is
+    much of the cost of encoding a row. If a batch would take the page over num_bytes_max, the
+    page ends with the first row of the batch that takes it over, found by bisecting the batch
+    """
+    chunker = ByteChunker(chunk_size)
+    yield from chunker.write(encoder.start(columns))
+    for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+        prepared = encoder.prepare(batch)
+        if chunker.num_bytes + encoder.size(prepared) <= num_bytes_max:
+            yield from chunker.write(encoder.write(prepared))
+            continue
+
+        low, high = 1, len(batch)
+        while low < high:
+            middle = (low + high) // 2
+            if chunker.num_bytes + encoder.size(encoder.prepare(batch[:middle])) > num_bytes_max:
+                high = middle
+            else:
+                low = middle + 1
+        yield from chunker.write(encoder.write(encoder.prepare(batch[:low])))
+
+        search_after = [batch[low - 1][columns.index(k)] for k in primary_key]
+        next_url = "{}?{}".format(base_url, get_search_query(search_after, search_up_to))
+        yield from chunker.write(encoder.end(next_url))
+        yield from chunker.flush()
+        return
+
+    yield from chunker.write(encoder.end(None))
+    yield from chunker.flush()
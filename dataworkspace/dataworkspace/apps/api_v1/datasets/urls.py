@@ -24,6 +24,13 @@ urlpatterns = [
         views.reference_dataset_api_view_GET,
         name="api-reference-dataset-view",
     ),
+    # After the reference dataset view, so reference datasets with the slug "partitions" are
+    # still routed to it
+    path(
+        "<str:dataset_id>/<str:source_table_id>/partitions",
+        views.dataset_partitions_api_view_GET,
+        name="api-dataset-partitions-view",
+    ),
     path(
         "tool-query-audit-logs",
         views.ToolQueryAuditLogViewSet.as_view({"get": "list"}),
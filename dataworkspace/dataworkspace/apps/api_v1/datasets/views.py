@@ -1,26 +1,40 @@
-import json
-
 import psycopg2
+from psycopg2.extensions import Column
 from django.conf import settings
 from django.contrib.postgres.aggregates.general import ArrayAgg
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
 from django.db.models import Case, F, Q, Value, When
 from django.db.models.functions import Substr
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from rest_framework import status, viewsets
 from rest_framework.decorators import api_view
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from waffle import switch_is_active
 
 from dataworkspace.apps.api_v1.datasets.serializers import (
     CatalogueItemSerializer,
     DataCutSerializer,
     ToolQueryAuditLogSerializer,
 )
+from dataworkspace.apps.api_v1.datasets.streaming import (
+    dumps,
+    get_page_encoder_class,
+    get_search_query,
+    yield_page,
+)
 from dataworkspace.apps.api_v1.mixins import TimestampFilterMixin
 from dataworkspace.apps.api_v1.pagination import TimestampCursorPagination
+from dataworkspace.apps.core.download_slots import (
+    DownloadSlotsUnavailable,
+    acquire_download_slot,
+    download_slots_unavailable_response,
+    hold_download_slot,
+)
 from dataworkspace.apps.core.utils import (
     StreamingHttpResponseWithoutDjangoDbConnection,
     database_dsn,
@@ -40,16 +54,23 @@ from dataworkspace.apps.datasets.models import (
     ToolQueryAuditLog,
     VisualisationCatalogueItem,
 )
+from dataworkspace.datasets_db import (
+    get_dataset_partition_boundaries,
+    get_dataset_primary_key,
+)
+
+# The most ranges a table can be split into by dataset_partitions_api_view_GET
+MAX_DATASET_PARTITIONS = 1000
 
 
-def _get_dataset_columns(connection, source_table):
+def _get_dataset_description(connection, source_table):
     sql = psycopg2.sql.SQL("SELECT * from {}.{} LIMIT 0").format(
         psycopg2.sql.Identifier(source_table.schema),
         psycopg2.sql.Identifier(source_table.table),
     )
     with connection.cursor() as cursor:
         cursor.execute(sql)
-        return [c[0] for c in cursor.description]
+        return cursor.description
 
 
 def _get_dataset_rows(connection, sql, query_args=None, cursor_itersize=1000):
@@ -67,128 +88,18 @@ def _get_dataset_rows(connection, sql, query_args=None, cursor_itersize=1000):
                 break
 
 
-def _get_dataset_primary_key(connection, schema, table):
-    check_is_table = psycopg2.sql.SQL(
-        """
-        SELECT
-            CASE
-                WHEN pg_class.relkind = 'r' THEN 'table'::text
-                WHEN pg_class.relkind = 'v' THEN 'view'::text
-                ELSE pg_class.relkind::text
-            END
-        FROM pg_class
-                 INNER JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
-        WHERE pg_namespace.nspname = %s
-          AND pg_class.relname = %s;
-        """
-    )
-    sql = psycopg2.sql.SQL(
-        """
-        SELECT
-            pg_attribute.attname AS column_name
-        FROM
-            pg_catalog.pg_class pg_class_table
-        INNER JOIN
-            pg_catalog.pg_index ON pg_index.indrelid = pg_class_table.oid
-        INNER JOIN
-            pg_catalog.pg_class pg_class_index ON pg_class_index.oid = pg_index.indexrelid
-        INNER JOIN
-            pg_catalog.pg_namespace ON pg_namespace.oid = pg_class_table.relnamespace
-        INNER JOIN
-            pg_catalog.pg_attribute ON pg_attribute.attrelid = pg_class_index.oid
-        WHERE
-            pg_namespace.nspname = %s
-            AND pg_class_table.relname = %s
-            AND pg_index.indisprimary
-        ORDER BY
-            pg_attribute.attnum
-        """
-    )
-
-    with connection.cursor() as cursor:
-        cursor.execute(check_is_table, (schema, table))
-        result = cursor.fetchall()
-
-        if len(result) == 0:
-            raise ValueError(f"Table does not exist: `{schema}`.`{table}`")
-        if result[0][0] != "table":
-            raise ValueError(
-                f"Cannot get primary keys from something other than an ordinary table. "
-                f"`{schema}`.`{table}` is a: {result[0][0]}"
-            )
-
-        cursor.execute(sql, (schema, table))
-        return [row[0] for row in cursor.fetchall()]
-
-
-def _len_chunk_header(num_chunk_bytes):
-    return len("%X\r\n" % num_chunk_bytes)
-
-
-def _get_streaming_http_response(streaming_class, request, primary_key, columns, rows):
-    # StreamingHttpResponse translates to HTTP/1.1 chunking performed by gunicorn. However,
-    # we don't have any visibility on the actual bytes sent as part of the HTTP body, i.e. each
-    # chunk header and footer. We also don't appear to be able to work-around it and implement
-    # our own chunked-encoder that makes these things visible. The best thing we can do is make
-    # a good guess as to what these are, and add their lengths to the total number of bytes sent
-
-    def yield_chunks(row_bytes):
-        nonlocal queue
-        nonlocal num_bytes_queued
-        nonlocal num_bytes_sent
-        nonlocal num_bytes_sent_and_queued
-
-        queue.append(row_bytes)
-        num_bytes_queued += len(row_bytes)
-        num_bytes_sent_and_queued += len(row_bytes)
-        while num_bytes_queued >= chunk_size:
-            to_send_bytes = b"".join(queue)
-            chunk, to_send_bytes = (
-                to_send_bytes[:chunk_size],
-                to_send_bytes[chunk_size:],
-            )
-            queue = [to_send_bytes] if to_send_bytes else []
-            num_bytes_queued = len(to_send_bytes)
-            num_bytes_sent += len(chunk) + _len_chunk_header(len(chunk)) + len_chunk_footer
-            yield chunk
-
-    def yield_data(columns, rows, base_url):
-        yield from yield_chunks(b'{"headers": ')
-        yield from yield_chunks(json.dumps(columns).encode("utf-8"))
-        yield from yield_chunks(b', "values": [')
-        for i, row in enumerate(rows):
-            row_bytes = json.dumps(row, default=str).encode("utf-8")
-            if i > 0:
-                row_bytes = b"," + row_bytes
-            yield from yield_chunks(row_bytes)
-
-            if num_bytes_sent_and_queued > num_bytes_max:
-                search_after = [columns.index(k) for k in primary_key]
-                search_after = [row[i] for i in search_after]
-                search_after = "&".join(["$searchAfter={}".format(k) for k in search_after])
-                next_url = "{}?{}".format(base_url, search_after)
-                yield from yield_chunks(b'], "next": "' + next_url.encode("utf-8") + b'"}')
-                break
-        else:
-            yield from yield_chunks(b'], "next": null}')
-        yield from yield_remaining()
-
-    def yield_remaining():
-        if queue:
-            yield b"".join(queue)
-
-    num_bytes_max = 49_990_000
-    len_chunk_footer = len("\r\n")
-    chunk_size = 16384
-    queue = []
-    num_bytes_queued = 0
-    num_bytes_sent = 0
-    num_bytes_sent_and_queued = 0
-
+def _get_streaming_http_response(
+    streaming_class, request, primary_key, columns, rows, cursor_description, search_up_to=()
+):
+    encoder = get_page_encoder_class(request.accepted_types)(cursor_description)
     base_url = request.build_absolute_uri().split("?")[0]
-    return streaming_class(
-        yield_data(columns, rows, base_url), content_type="application/json", status=200
+    response = streaming_class(
+        yield_page(encoder, primary_key, columns, rows, base_url, search_up_to),
+        content_type=encoder.content_type,
+        status=200,
     )
+    patch_vary_headers(response, ("Accept",))
+    return response
 
 
 def dataset_api_view_GET(request, dataset_id, source_table_id):
@@ -197,57 +108,141 @@ def dataset_api_view_GET(request, dataset_id, source_table_id):
     )
 
     search_after = request.GET.getlist("$searchAfter")
+    search_up_to = request.GET.getlist("$searchUpTo")
+
+    slot = None
+    if switch_is_active(settings.LIMIT_CONCURRENT_DOWNLOADS_SWITCH):
+        try:
+            slot = acquire_download_slot(
+                request.user.email if request.user.is_authenticated else None,
+                source_table.database.memorable_name,
+            )
+        except DownloadSlotsUnavailable as e:
+            return download_slots_unavailable_response(e)
+
+    try:
+        with psycopg2.connect(
+            database_dsn(settings.DATABASES_DATA[source_table.database.memorable_name])
+        ) as connection:
+            primary_key = get_dataset_primary_key(
+                connection, source_table.schema, source_table.table
+            )
 
-    with psycopg2.connect(
-        database_dsn(settings.DATABASES_DATA[source_table.database.memorable_name])
-    ) as connection:
-        primary_key = _get_dataset_primary_key(connection, source_table.schema, source_table.table)
+            if not primary_key:
+                raise ValueError(
+                    f"Cannot order response without a primary key on the table: "
+                    f"`{source_table.schema}`.`{source_table.table}`"
+                )
 
-        if not primary_key:
-            raise ValueError(
-                f"Cannot order response without a primary key on the table: "
-                f"`{source_table.schema}`.`{source_table.table}`"
+            primary_key_columns = psycopg2.sql.SQL(",").join(
+                map(psycopg2.sql.Identifier, primary_key)
             )
+            conditions = []
+            if search_after:
+                conditions.append(
+                    psycopg2.sql.SQL("({}) > ({})").format(
+                        primary_key_columns,
+                        psycopg2.sql.SQL(",").join(psycopg2.sql.Placeholder() * len(search_after)),
+                    )
+                )
+            if search_up_to:
+                conditions.append(
+                    psycopg2.sql.SQL("({}) <= ({})").format(
+                        primary_key_columns,
+                        psycopg2.sql.SQL(",").join(psycopg2.sql.Placeholder() * len(search_up_to)),
+                    )
+                )
 
-        if search_after == []:
-            sql = psycopg2.sql.SQL(
-                """
-                    select
-                        *
-                    from {}.{}
-                    order by {}
-                """
-            ).format(
-                psycopg2.sql.Identifier(source_table.schema),
-                psycopg2.sql.Identifier(source_table.table),
-                psycopg2.sql.SQL(",").join(map(psycopg2.sql.Identifier, primary_key)),
-            )
-        else:
             sql = psycopg2.sql.SQL(
                 """
                     select
                         *
                     from {}.{}
-                    where ({}) > ({})
+                    {}
                     order by {}
                 """
             ).format(
                 psycopg2.sql.Identifier(source_table.schema),
                 psycopg2.sql.Identifier(source_table.table),
-                psycopg2.sql.SQL(",").join(map(psycopg2.sql.Identifier, primary_key)),
-                psycopg2.sql.SQL(",").join(psycopg2.sql.Placeholder() * len(search_after)),
-                psycopg2.sql.SQL(",").join(map(psycopg2.sql.Identifier, primary_key)),
+                (
+                    psycopg2.sql.SQL("where ") + psycopg2.sql.SQL(" and ").join(conditions)
+                    if conditions
+                    else psycopg2.sql.SQL("")
+                ),
+                primary_key_columns,
             )
 
-        columns = _get_dataset_columns(connection, source_table)
-        rows = _get_dataset_rows(connection, sql, query_args=search_after)
+            cursor_description = _get_dataset_description(connection, source_table)
+            columns = [column.name for column in cursor_description]
+            rows = _get_dataset_rows(connection, sql, query_args=search_after + search_up_to)
+
+        response = _get_streaming_http_response(
+            StreamingHttpResponseWithoutDjangoDbConnection,
+            request,
+            primary_key,
+            columns,
+            rows,
+            cursor_description,
+            search_up_to,
+        )
+    except BaseException:
+        # The slot is otherwise only released once the response is closed
+        if slot is not None:
+            slot.release()
+        raise
 
-    return _get_streaming_http_response(
-        StreamingHttpResponseWithoutDjangoDbConnection,
-        request,
-        primary_key,
-        columns,
-        rows,
+    return hold_download_slot(response, slot) if slot is not None else response
+
+
+def dataset_partitions_api_view_GET(request, dataset_id, source_table_id):
+    """
+    Returns the URLs of pages of the dataset API of $partitions disjoint ranges of the primary
+    key of a table, with roughly the same number of rows, so they can be fetched in parallel
+    """
+    source_table = get_object_or_404(
+        SourceTable, id=source_table_id, dataset__id=dataset_id, dataset__deleted=False
+    )
+
+    try:
+        num_partitions = int(request.GET.get("$partitions", ""))
+    except ValueError:
+        num_partitions = 0
+    if not 1 <= num_partitions <= MAX_DATASET_PARTITIONS:
+        return HttpResponseBadRequest(
+            f"$partitions must be an integer from 1 to {MAX_DATASET_PARTITIONS}"
+        )
+
+    with psycopg2.connect(
+        database_dsn(settings.DATABASES_DATA[source_table.database.memorable_name])
+    ) as connection:
+        primary_key = get_dataset_primary_key(connection, source_table.schema, source_table.table)
+        if not primary_key:
+            raise ValueError(
+                f"Cannot partition a table without a primary key: "
+                f"`{source_table.schema}`.`{source_table.table}`"
+            )
+        boundaries = get_dataset_partition_boundaries(
+            connection, source_table.schema, source_table.table, primary_key, num_partitions
+        )
+
+    base_url = request.build_absolute_uri(
+        reverse(
+            "api-v1:dataset:api-dataset-view",
+            kwargs={"dataset_id": dataset_id, "source_table_id": source_table_id},
+        )
+    )
+    ranges = list(zip([[]] + boundaries, boundaries + [[]]))
+    urls = [
+        (
+            f"{base_url}?{get_search_query(search_after, search_up_to)}"
+            if search_after or search_up_to
+            else base_url
+        )
+        for search_after, search_up_to in ranges
+    ]
+    return HttpResponse(
+        dumps({"primary_key": primary_key, "boundaries": boundaries, "urls": urls}),
+        content_type="application/json",
     )
 
 
@@ -291,10 +286,31 @@ def reference_dataset_api_view_GET(request, group_slug, reference_slug):
     field_names.sort()
     rows = get_rows(field_names)
     return _get_streaming_http_response(
-        StreamingHttpResponse, request, primary_key.name, field_names, rows
+        StreamingHttpResponse,
+        request,
+        [primary_key.name],
+        field_names,
+        rows,
+        _get_reference_dataset_description(ref_dataset, field_names),
     )
 
 
+def _get_reference_dataset_description(ref_dataset, field_names):
+    # Mirrors a psycopg2 cursor description, for the types of the values of the API
+    data_types = {
+        field.name: (
+            field.linked_reference_dataset_field.data_type
+            if field.data_type == ReferenceDatasetField.DATA_TYPE_FOREIGN_KEY
+            else field.data_type
+        )
+        for field in ref_dataset.fields.select_related("linked_reference_dataset_field")
+    }
+    return [
+        Column(name, ReferenceDatasetField.POSTGRES_TYPE_MAP[data_types[name]])
+        for name in field_names
+    ]
+
+
 def _replace(items, a, b):
     return [b if i == a else i for i in items]
 
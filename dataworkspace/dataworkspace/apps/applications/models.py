@@ -1,3 +1,4 @@
+import logging
 import uuid
 from collections import namedtuple
 
@@ -7,10 +8,14 @@ from django.core.validators import RegexValidator
 from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django_redis import get_redis_connection
 
 from dataworkspace.apps.core.models import Database, TimeStampedModel
 from dataworkspace.apps.eventlog.models import EventLog
 from dataworkspace.apps.eventlog.utils import log_event
+from dataworkspace.utils import APPLICATION_INSTANCE_CHANGED_CHANNEL
+
+logger = logging.getLogger("app")
 
 
 class ApplicationTemplate(TimeStampedModel):
@@ -331,6 +336,21 @@ def save_application_instance(instance, **kwargs):
         )
 
 
+def publish_application_instance_change(public_host):
+    # The proxy caches the state of applications, and drops it for this host when notified
+    try:
+        get_redis_connection("default").publish(APPLICATION_INSTANCE_CHANGED_CHANNEL, public_host)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Unable to publish change to application %s", public_host)
+
+
+@receiver(post_save, sender=ApplicationInstance)
+def save_application_instance_publish_change(instance, **_):
+    # After commit so the proxy doesn't re-fetch and cache the previous state
+    public_host = instance.public_host
+    transaction.on_commit(lambda: publish_application_instance_change(public_host))
+
+
 class ApplicationInstanceDbUsers(TimeStampedModel):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     db = models.ForeignKey(Database, on_delete=models.CASCADE)
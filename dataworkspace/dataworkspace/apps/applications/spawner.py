@@ -6,6 +6,7 @@ import logging
 import os
 import re
 import subprocess
+from collections import defaultdict
 
 import boto3
 import gevent
@@ -239,6 +240,19 @@ class ProcessSpawner:
             logger.exception("PROCESS %s %s", spawner_application_id_parsed, proxy_url)
             return "STOPPED"
 
+    @staticmethod
+    def states(application_instances):
+        return {
+            application_instance.id: ProcessSpawner.state(
+                application_instance.spawner_application_template_options,
+                application_instance.created_date.replace(tzinfo=None),
+                application_instance.spawner_application_instance_id,
+                # As passed by api_application_dict
+                application_instance.public_host,
+            )
+            for application_instance in application_instances
+        }
+
     @staticmethod
     def stop(application_instance_id):
         application_instance = ApplicationInstance.objects.get(id=application_instance_id)
@@ -516,8 +530,72 @@ class FargateSpawner:
                 _gitlab_ecr_pipeline_cancel(pipeline_id)
 
     @staticmethod
-    def state(  # pylint: disable=too-many-return-statements
-        spawner_options, created_date, spawner_application_id, proxy_url
+    def state(spawner_options, created_date, spawner_application_id, proxy_url):
+        return FargateSpawner._state(
+            spawner_options,
+            created_date,
+            spawner_application_id,
+            proxy_url,
+            _fargate_task_describe,
+        )
+
+    @staticmethod
+    def states(application_instances):
+        """The states of many application instances, describing their tasks in as few calls
+        to ECS as possible. Instances whose tasks could not be described are omitted
+        """
+
+        def cluster_name_and_task_arn(application_instance):
+            try:
+                return (
+                    json.loads(application_instance.spawner_application_template_options)[
+                        "CLUSTER_NAME"
+                    ],
+                    json.loads(application_instance.spawner_application_instance_id).get(
+                        "task_arn"
+                    ),
+                )
+            except Exception:  # pylint: disable=broad-except
+                return None, None
+
+        instances_with_tasks = [
+            (application_instance, *cluster_name_and_task_arn(application_instance))
+            for application_instance in application_instances
+        ]
+
+        task_arns_by_cluster = defaultdict(list)
+        for _, cluster_name, task_arn in instances_with_tasks:
+            if task_arn:
+                task_arns_by_cluster[cluster_name].append(task_arn)
+
+        described_tasks_by_cluster = {}
+        for cluster_name, task_arns in task_arns_by_cluster.items():
+            try:
+                described_tasks_by_cluster[cluster_name] = _fargate_tasks_describe(
+                    cluster_name, task_arns
+                )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Unable to describe tasks in %s", cluster_name)
+
+        def describe_task(cluster_name, task_arn):
+            return described_tasks_by_cluster[cluster_name].get(task_arn)
+
+        return {
+            application_instance.id: FargateSpawner._state(
+                application_instance.spawner_application_template_options,
+                application_instance.created_date.replace(tzinfo=None),
+                application_instance.spawner_application_instance_id,
+                # As passed by api_application_dict
+                application_instance.public_host,
+                describe_task,
+            )
+            for application_instance, cluster_name, task_arn in instances_with_tasks
+            if not task_arn or cluster_name in described_tasks_by_cluster
+        }
+
+    @staticmethod
+    def _state(  # pylint: disable=too-many-return-statements
+        spawner_options, created_date, spawner_application_id, proxy_url, describe_task
     ):
         close_admin_db_connection_if_not_in_atomic_block()
         try:
@@ -567,7 +645,7 @@ class FargateSpawner:
                 return "STOPPED"
 
             # .... give eight minutes to get the task itself (to mitigate eventual consistency)...
-            task = _fargate_task_describe(cluster_name, task_arn)
+            task = describe_task(cluster_name, task_arn)
             if task is None and task_should_be_created > eight_minutes_ago:
                 return "RUNNING"
             if task is None:
@@ -804,6 +882,19 @@ def _fargate_task_describe(cluster_name, arn):
     return task
 
 
+def _fargate_tasks_describe(cluster_name, arns):
+    client = boto3.client("ecs")
+
+    # DescribeTasks accepts at most 100 tasks per call
+    tasks = {}
+    for i in range(0, len(arns), 100):
+        described_tasks = client.describe_tasks(cluster=cluster_name, tasks=arns[i : i + 100])
+        for task in described_tasks.get("tasks", []):
+            tasks[task["taskArn"]] = task
+
+    return tasks
+
+
 def _fargate_task_stop(cluster_name, task_arn):
     client = boto3.client("ecs")
     sleep_time = 1
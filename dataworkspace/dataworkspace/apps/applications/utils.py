@@ -17,12 +17,14 @@ from botocore.config import Config
 from botocore.exceptions import ClientError
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, connections
+from django.db import IntegrityError, connections, transaction
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from psycopg2 import connect, sql
 from pytz import utc
 from smart_open import open as smart_open
@@ -36,6 +38,7 @@ from dataworkspace.apps.applications.models import (
     ApplicationInstanceDbUsers,
     ApplicationTemplate,
     VisualisationApproval,
+    publish_application_instance_change,
 )
 from dataworkspace.apps.applications.spawner import (
     _fargate_task_describe,
@@ -66,7 +69,15 @@ from dataworkspace.apps.core.utils import (
     transaction_and_lock,
 )
 from dataworkspace.apps.datasets.constants import UserAccessType
-from dataworkspace.apps.datasets.models import ToolQueryAuditLog, VisualisationCatalogueItem
+from dataworkspace.apps.datasets.models import (
+    DataSet,
+    DataSetApplicationTemplatePermission,
+    DataSetUserPermission,
+    SourceTable,
+    ToolQueryAuditLog,
+    VisualisationCatalogueItem,
+    VisualisationUserPermission,
+)
 from dataworkspace.cel import celery_app
 from dataworkspace.datasets_db import extract_queried_tables_from_sql_query
 from dataworkspace.notify import EmailSendFailureException, send_email
@@ -90,6 +101,18 @@ class HawkException(Exception):
     pass
 
 
+# The reconciler stores spawner states every 30 seconds. Older states are not trusted, and
+# the spawner is asked directly
+SPAWNER_STATE_MAX_AGE = 90
+
+# Decisions of application_api_is_allowed are cached per user and host, with the version
+# they were made at. All are invalidated together by incrementing the version whenever
+# something they depend on changes, and the max age limits the impact of any change that
+# isn't caught
+APPLICATION_API_IS_ALLOWED_MAX_AGE = 60 * 5
+application_api_is_allowed_version_key = "application_api_is_allowed_version"
+
+
 def is_8_char_hex(val):
     try:
         int(val, 16)
@@ -170,16 +193,38 @@ def application_options(application_template):
     }
 
 
-def api_application_dict(application_instance, ignore_spawner_state=False):
-    if ignore_spawner_state:
-        api_state = application_instance.state
-    else:
-        spawner_state = get_spawner(application_instance.application_template.spawner).state(
+def _spawner_state_cache_key(application_instance_id):
+    return f"application_instance_spawner_state_{application_instance_id}"
+
+
+def get_spawner_state(application_instance):
+    """The state of the application instance according to its spawner, and when that was
+    checked. Usually stored by reconcile_spawner_states, so no calls to AWS are made
+    """
+    cache_key = _spawner_state_cache_key(application_instance.id)
+    stored_state = cache.get(cache_key)
+    if stored_state is not None:
+        return stored_state
+
+    state = (
+        get_spawner(application_instance.application_template.spawner).state(
             application_instance.spawner_application_template_options,
             application_instance.created_date.replace(tzinfo=None),
             application_instance.spawner_application_instance_id,
             application_instance.public_host,
-        )
+        ),
+        datetime.datetime.now(datetime.timezone.utc),
+    )
+    cache.set(cache_key, state, timeout=SPAWNER_STATE_MAX_AGE)
+    return state
+
+
+def api_application_dict(application_instance, ignore_spawner_state=False):
+    if ignore_spawner_state:
+        api_state = application_instance.state
+        spawner_state_checked_at = None
+    else:
+        spawner_state, spawner_state_checked_at = get_spawner_state(application_instance)
 
         # Only pass through the database state if the spawner is running,
         # Otherwise, we are in an error condition, and so return the spawner
@@ -194,6 +239,7 @@ def api_application_dict(application_instance, ignore_spawner_state=False):
         "id": application_instance.id,
         "proxy_url": application_instance.proxy_url,
         "state": api_state,
+        "spawner_state_checked_at": spawner_state_checked_at,
         "user": sso_id_hex_short,
         "wrap": application_instance.application_template.wrap,
         # Used by metrics to label the application
@@ -211,7 +257,40 @@ def get_api_visible_application_instance_by_public_host(public_host):
     )
 
 
+def _application_api_is_allowed_version():
+    # Set to never expire as reverting to a previous version could cause
+    # decisions made before a change to be used
+    cache.set(application_api_is_allowed_version_key, 1, nx=True, timeout=None)
+    return cache.get(application_api_is_allowed_version_key, None)
+
+
+def invalidate_application_api_is_allowed_cache():
+    version = cache.get(application_api_is_allowed_version_key, None)
+    if version:
+        cache.incr(application_api_is_allowed_version_key)
+
+
 def application_api_is_allowed(request, public_host):
+    # Only True/False decisions are cached. Denials that raise carry context for the error
+    # page, and are rare enough to not be worth caching
+    # The version and the decision are fetched together, since this is called for every
+    # request to an application
+    cache_key = f"application_api_is_allowed_{request.user.id}_{public_host}"
+    cached = cache.get_many([application_api_is_allowed_version_key, cache_key])
+    version = cached.get(application_api_is_allowed_version_key)
+    if version is not None and cache_key in cached:
+        decision_version, is_allowed = cached[cache_key]
+        if decision_version == version:
+            return is_allowed
+
+    if version is None:
+        version = _application_api_is_allowed_version()
+    is_allowed = bool(_application_api_is_allowed(request, public_host))
+    cache.set(cache_key, (version, is_allowed), timeout=APPLICATION_API_IS_ALLOWED_MAX_AGE)
+    return is_allowed
+
+
+def _application_api_is_allowed(request, public_host):
     try:
         (
             application_template,
@@ -319,6 +398,52 @@ def application_api_is_allowed(request, public_host):
     )
 
 
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_application_api_is_allowed_cache_on_change(instance, update_fields=None, **_):
+    # Checked by instance rather than connected per sender so saves through proxy
+    # models, e.g. MasterDataset, are included
+    if not isinstance(
+        instance,
+        (
+            ApplicationTemplate,
+            DataSet,
+            DataSetApplicationTemplatePermission,
+            DataSetUserPermission,
+            Group,
+            SourceTable,
+            VisualisationApproval,
+            VisualisationCatalogueItem,
+            VisualisationUserPermission,
+        ),
+    ):
+        return
+
+    # Download counts are saved often, and don't affect access
+    if update_fields is not None and set(update_fields) <= {"number_of_downloads"}:
+        return
+
+    # After commit so a decision made from the previous data isn't cached under the new version
+    transaction.on_commit(invalidate_application_api_is_allowed_cache)
+
+
+@receiver(m2m_changed, sender=get_user_model().user_permissions.through)
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_application_api_is_allowed_cache_on_user_permission_change(action, **_):
+    if action in ("post_add", "post_remove", "post_clear"):
+        transaction.on_commit(invalidate_application_api_is_allowed_cache)
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_application_api_is_allowed_cache_on_user_change(created, update_fields=None, **_):
+    # For example is_superuser, is_active, is_staff, or the email domain changing. New users
+    # have no decisions cached, and logins only save last_login
+    if created or (update_fields is not None and set(update_fields) <= {"last_login"}):
+        return
+    transaction.on_commit(invalidate_application_api_is_allowed_cache)
+
+
 def stop_spawner_and_application(application_instance):
     stop.delay(application_instance.spawner, application_instance.id)
     set_application_stopped(application_instance)
@@ -378,6 +503,56 @@ def application_instance_max_cpu(application_instance):
     return max_cpu, ts_at_max
 
 
+@celery_app.task()
+@close_all_connections_if_not_in_atomic_block
+def reconcile_spawner_states():
+    try:
+        with cache.lock(
+            "reconcile_spawner_states", blocking_timeout=0, timeout=SPAWNER_STATE_MAX_AGE
+        ):
+            _do_reconcile_spawner_states()
+    except redis.exceptions.LockError as e:
+        logger.warning("Failed to acquire lock for reconcile_spawner_states: %s", e)
+
+
+def _do_reconcile_spawner_states():
+    application_instances_by_spawner = defaultdict(list)
+    for application_instance in ApplicationInstance.objects.filter(
+        state__in=["RUNNING", "SPAWNING"]
+    ).select_related("application_template"):
+        application_instances_by_spawner[application_instance.application_template.spawner].append(
+            application_instance
+        )
+
+    for spawner_name, application_instances in application_instances_by_spawner.items():
+        checked_at = datetime.datetime.now(datetime.timezone.utc)
+        states = get_spawner(spawner_name).states(application_instances)
+
+        cache_keys = {
+            application_instance.id: _spawner_state_cache_key(application_instance.id)
+            for application_instance in application_instances
+        }
+        previous_states = cache.get_many(list(cache_keys.values()))
+        cache.set_many(
+            {
+                cache_keys[application_instance_id]: (state, checked_at)
+                for application_instance_id, state in states.items()
+            },
+            timeout=SPAWNER_STATE_MAX_AGE,
+        )
+
+        # The proxy may be caching that these are running, but the next request should
+        # result in it stopping them
+        for application_instance in application_instances:
+            state = states.get(application_instance.id)
+            previous_state, _ = previous_states.get(
+                cache_keys[application_instance.id], (None, None)
+            )
+            if state not in (None, "RUNNING") and state != previous_state:
+                logger.info("reconcile_spawner_states: %s is %s", application_instance, state)
+                publish_application_instance_change(application_instance.public_host)
+
+
 @celery_app.task()
 @close_all_connections_if_not_in_atomic_block
 def kill_idle_fargate():
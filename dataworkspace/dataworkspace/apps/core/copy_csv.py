@@ -0,0 +1,45 @@
+"""
+Runs a COPY ... TO STDOUT statement and writes its output to stdout, as a separate process
+
+psycopg2 refuses copy_expert while a wait callback is registered, and the web and Celery
+processes register psycogreen's for gevent. The callback is global to the process, so it
+can't be disabled for one connection without making every other greenlet's queries block.
+So COPY is run by this script, in a process without the callback, and its output is read
+from a pipe, which gevent can wait on without blocking other greenlets.
+
+The DSN and the statement are passed in the environment, rather than in the arguments,
+so they aren't visible to other users of the host. The number of rows copied is written
+to stderr once the output is complete, or the error if the statement fails.
+"""
+
+import os
+import sys
+
+import psycopg2
+
+COPY_CSV_DSN_ENV = "COPY_CSV_DSN"
+COPY_CSV_STATEMENT_ENV = "COPY_CSV_STATEMENT"
+
+# psycopg2 writes each row of the COPY output separately, so they are buffered
+COPY_CSV_BUFFER_SIZE = 1024 * 1024
+
+
+class CopyCsvError(Exception):
+    pass
+
+
+def main():
+    with os.fdopen(sys.stdout.fileno(), "wb", buffering=COPY_CSV_BUFFER_SIZE) as stdout:
+        try:
+            with psycopg2.connect(os.environ[COPY_CSV_DSN_ENV]) as conn, conn.cursor() as cur:
+                cur.copy_expert(os.environ[COPY_CSV_STATEMENT_ENV], stdout)
+                stdout.flush()
+                sys.stderr.write(str(cur.rowcount))
+            conn.close()
+        except psycopg2.Error as e:
+            sys.stderr.write(f"{type(e).__name__}: {e}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Limits on the number of concurrent downloads from the datasets databases
+
+Each download takes a slot for its database, and one for its user, for as long as its data
+is streamed. A download that can't get both waits briefly for them, and if they don't become
+free, a 429 is returned to tell the client to retry later, rather than adding to the load on
+an already busy database.
+
+Slots are leases in Redis sorted sets, scored by when they were last renewed. They are renewed
+on a timer while a download is streamed, so the slots of downloads of processes that die
+without releasing them expire rather than being lost. If a lease is lost anyway, the download
+fails, rather than continuing without a slot.
+"""
+
+import logging
+import time
+import uuid
+
+import gevent
+import redis
+from django.conf import settings
+from django.http import HttpResponse
+from django_redis import get_redis_connection
+
+logger = logging.getLogger("app")
+
+# Takes a slot in each of KEYS if all of them have a free slot, where ARGV[3 + i] is the
+# number of slots of KEYS[i]. Leases last renewed before ARGV[1] - ARGV[2] have expired
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease_seconds = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    redis.call("ZREMRANGEBYSCORE", key, "-inf", now - lease_seconds)
+    if redis.call("ZCARD", key) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call("ZADD", key, now, ARGV[3])
+    redis.call("EXPIRE", key, lease_seconds)
+end
+return 1
+"""
+
+DOWNLOAD_SLOT_POLL_INTERVAL = 0.25
+
+
+class DownloadSlotsUnavailable(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"No download slots available. Retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class DownloadSlotLost(Exception):
+    pass
+
+
+class DownloadSlot:
+    def __init__(self, redis_client, keys, token):
+        self._redis_client = redis_client
+        self._keys = keys
+        self._token = token
+        self._renewer = None
+        self._released = False
+        self.lost = False
+
+    def start_renewing(self):
+        # On a timer rather than as chunks are streamed, so a download that stalls for longer
+        # than the lease, e.g. on a slow query or a slow client, keeps its slots
+        self._renewer = gevent.spawn(self._renew_until_released)
+
+    def _renew_until_released(self):
+        while not self._released and not self.lost:
+            gevent.sleep(settings.DOWNLOAD_SLOT_LEASE_SECONDS / 3)
+            if self._released:
+                return
+            try:
+                self.renew()
+            except redis.exceptions.RedisError:
+                # Tried again on the next tick, which is still within the lease
+                logger.exception("download_slot_renew_failed: %s", self._keys)
+
+    def renew(self):
+        with self._redis_client.pipeline() as pipe:
+            for key in self._keys:
+                pipe.zadd(key, {self._token: time.time()}, xx=True, ch=True)
+                pipe.expire(key, settings.DOWNLOAD_SLOT_LEASE_SECONDS)
+            results = pipe.execute()
+        # zadd with xx doesn't add the lease if it has expired
+        if not all(results[::2]):
+            self.lost = True
+            logger.warning("download_slot_lost: %s", self._keys)
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._renewer is not None:
+            self._renewer.kill(block=False)
+        with self._redis_client.pipeline() as pipe:
+            for key in self._keys:
+                pipe.zrem(key, self._token)
+            pipe.execute()
+
+
+def acquire_download_slot(user_email, database):
+    """
+    Returns a DownloadSlot for a download by user_email from database, waiting for up to
+    DOWNLOAD_SLOT_WAIT_SECONDS for one to become free, or raises DownloadSlotsUnavailable.
+    Downloads without a user, e.g. by API clients, only take a slot for the database
+    """
+    keys = [f"download_slots:database:{database}"]
+    limits = [settings.DOWNLOAD_SLOTS_PER_DATABASE]
+    if user_email:
+        keys.append(f"download_slots:user:{user_email}")
+        limits.append(settings.DOWNLOAD_SLOTS_PER_USER)
+
+    redis_client = get_redis_connection("default")
+    acquire = redis_client.register_script(_ACQUIRE_SCRIPT)
+    token = uuid.uuid4().hex
+    start = time.monotonic()
+
+    while True:
+        if acquire(
+            keys=keys, args=[time.time(), settings.DOWNLOAD_SLOT_LEASE_SECONDS, token] + limits
+        ):
+            logger.info(
+                "download_slot_acquired: %s %s waited %.3f seconds",
+                user_email,
+                database,
+                time.monotonic() - start,
+            )
+            return DownloadSlot(redis_client, keys, token)
+
+        if time.monotonic() - start >= settings.DOWNLOAD_SLOT_WAIT_SECONDS:
+            logger.warning(
+                "download_slot_unavailable: %s %s waited %.3f seconds",
+                user_email,
+                database,
+                time.monotonic() - start,
+            )
+            raise DownloadSlotsUnavailable(settings.DOWNLOAD_SLOT_RETRY_AFTER_SECONDS)
+
+        time.sleep(DOWNLOAD_SLOT_POLL_INTERVAL)
+
+
+def hold_download_slot(response, slot):
+    """
+    Holds slot while the data of the streaming response is streamed, and releases it once
+    the response is closed, including if the client disconnects part way through. If the
+    slot is lost, the response fails at its next chunk
+    """
+    slot.start_renewing()
+    response.streaming_content = _SlotHoldingIterator(response.streaming_content, slot)
+    return response
+
+
+def download_slots_unavailable_response(exception):
+    response = HttpResponse(
+        "Too many downloads are in progress. Please try again later.",
+        content_type="text/plain",
+        status=429,
+    )
+    response["Retry-After"] = str(exception.retry_after)
+    return response
+
+
+class _SlotHoldingIterator:
+    # A class rather than a generator, since Django closes the content of streaming responses
+    # once they are sent, but closing a generator that never started doesn't run its finally
+    def __init__(self, iterator, slot):
+        self._iterator = iterator
+        self._slot = slot
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except BaseException:
+            self._slot.release()
+            raise
+        if self._slot.lost:
+            self._slot.release()
+            raise DownloadSlotLost()
+        return chunk
+
+    def close(self):
+        self._slot.release()
@@ -0,0 +1,174 @@
+"""
+A cache in S3 of full exports of tables, e.g. CSV downloads of master datasets
+
+The data in a table only changes when a pipeline replaces it, which is recorded in
+dataflow.metadata, so an export is cached against that version of the data. The first
+export of a table at a version is uploaded to S3 as it's streamed to the client, and later
+exports at the same version are streamed from S3, rather than running the query again.
+Exports of earlier versions are deleted once an export of a later version is cached.
+
+CSV exports made with COPY are cached separately to those made with csv.writer, since
+they quote values differently.
+"""
+
+import logging
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from dataworkspace.apps.core.boto3_client import get_s3_client
+
+logger = logging.getLogger("app")
+
+# S3 requires each part of a multipart upload, except the last, to be at least 5MB
+EXPORT_CACHE_PART_SIZE = 16 * 1024 * 1024
+
+
+def _table_prefix(database, schema, table):
+    return f"{settings.EXPORT_CACHE_PREFIX}{database}/{schema}/{table}/"
+
+
+def get_export_cache_key(database, schema, table, data_version, file_format, use_copy=False):
+    # The version is first in the filename, and sorts in time order, for delete_stale_exports
+    return (
+        f"{_table_prefix(database, schema, table)}"
+        f"{data_version.strftime('%Y%m%dT%H%M%S%fZ')}"
+        f"{'.copy' if use_copy and file_format == 'csv' else ''}.{file_format}"
+    )
+
+
+class CachedExportRangeNotSatisfiable(Exception):
+    """
+    The export is cached, but the requested range starts after its end
+    """
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.size = size
+
+
+def get_cached_export(key, byte_range=None):
+    """
+    Returns the S3 object of a cached export, or None if it isn't cached. Errors from S3
+    are treated as the export not being cached, so the export falls back to the database.
+    byte_range is the value of an HTTP Range header, to fetch only part of the export. If
+    the export is cached but the range is past its end, CachedExportRangeNotSatisfiable is
+    raised, since exporting it again wouldn't change its size
+    """
+    client = get_s3_client()
+    try:
+        return client.get_object(
+            Bucket=settings.AWS_UPLOADS_BUCKET,
+            Key=key,
+            **({"Range": byte_range} if byte_range else {}),
+        )
+    except ClientError as ex:
+        error = ex.response.get("Error", {})
+        if error.get("Code") == "InvalidRange":
+            size = error.get("ActualObjectSize")
+            if size is None:
+                try:
+                    size = client.head_object(Bucket=settings.AWS_UPLOADS_BUCKET, Key=key)[
+                        "ContentLength"
+                    ]
+                except ClientError:
+                    logger.exception("Unable to fetch size of cached export %s", key)
+                    return None
+            raise CachedExportRangeNotSatisfiable(int(size)) from ex
+        if error.get("Code") != "NoSuchKey":
+            logger.exception("Unable to fetch cached export %s", key)
+        return None
+
+
+def tee_to_export_cache(chunks, key, content_type):
+    """
+    Yields chunks of an export, while uploading them to S3 as the cached export at key
+
+    The upload is only completed once all the chunks have been yielded, so an export that
+    fails or is abandoned by the client part way through is never cached
+    """
+    client = get_s3_client()
+    try:
+        upload_id = client.create_multipart_upload(
+            Bucket=settings.AWS_UPLOADS_BUCKET, Key=key, ContentType=content_type
+        )["UploadId"]
+    except ClientError:
+        logger.exception("Unable to start caching export %s", key)
+        yield from chunks
+        return
+
+    parts = []
+    buffer = bytearray()
+    uploading = True
+    completed = False
+
+    def upload_part():
+        part_number = len(parts) + 1
+        etag = client.upload_part(
+            Bucket=settings.AWS_UPLOADS_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=bytes(buffer),
+        )["ETag"]
+        parts.append({"ETag": etag, "PartNumber": part_number})
+        buffer.clear()
+
+    try:
+        for chunk in chunks:
+            yield chunk
+
+            if not uploading:
+                continue
+            buffer += chunk
+            if len(buffer) >= EXPORT_CACHE_PART_SIZE:
+                try:
+                    upload_part()
+                except ClientError:
+                    # The export is still streamed to the client, just not cached
+                    logger.exception("Unable to cache export %s", key)
+                    uploading = False
+                    buffer.clear()
+
+        if uploading:
+            upload_part()
+            client.complete_multipart_upload(
+                Bucket=settings.AWS_UPLOADS_BUCKET,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            completed = True
+            delete_stale_exports(key)
+    except ClientError:
+        logger.exception("Unable to cache export %s", key)
+    finally:
+        if not completed:
+            try:
+                client.abort_multipart_upload(
+                    Bucket=settings.AWS_UPLOADS_BUCKET, Key=key, UploadId=upload_id
+                )
+            except ClientError:
+                logger.exception("Unable to abort caching export %s", key)
+
+
+def delete_stale_exports(key):
+    """
+    Deletes the cached exports of the same table as key, but at an earlier version of its
+    data. Exports of the same version in other file formats are kept, as are exports of later
+    versions, which a slower export of an earlier version could complete after
+    """
+    prefix, filename = key.rsplit("/", 1)
+    version = filename.split(".", 1)[0]
+    client = get_s3_client()
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=settings.AWS_UPLOADS_BUCKET, Prefix=f"{prefix}/"):
+        stale_keys = [
+            {"Key": s3_object["Key"]}
+            for s3_object in page.get("Contents", [])
+            if s3_object["Key"][len(prefix) + 1 :].split(".", 1)[0] < version
+        ]
+        if stale_keys:
+            client.delete_objects(
+                Bucket=settings.AWS_UPLOADS_BUCKET, Delete={"Objects": stale_keys}
+            )
@@ -0,0 +1,149 @@
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dataworkspace.utils import TYPE_CODES_REVERSED
+
+
+def _identity(value):
+    return value
+
+
+def _to_float(value):
+    return float(value) if value is not None else None
+
+
+def _to_str(value):
+    return str(value) if value is not None else None
+
+
+def _to_json(value):
+    return json.dumps(value) if value is not None else None
+
+
+# Map the names of PostgreSQL types, as returned by datasets_db.get_columns, to Parquet types,
+# and functions to convert the values fetched by psycopg2 to values that pyarrow accepts. Any
+# other type is written as a string. Numerics are written as doubles, since their precision
+# and scale aren't known from the query alone, and most users load them as floats anyway
+PARQUET_TYPES = {
+    "boolean": (pa.bool_(), _identity),
+    "smallint": (pa.int16(), _identity),
+    "integer": (pa.int32(), _identity),
+    "bigint": (pa.int64(), _identity),
+    "double precision": (pa.float64(), _identity),
+    "numeric": (pa.float64(), _to_float),
+    "text": (pa.string(), _identity),
+    "date": (pa.date32(), _identity),
+    "time": (pa.time64("us"), _identity),
+    "timestamp with time zone": (pa.timestamp("us", tz="UTC"), _identity),
+    "json": (pa.string(), _to_json),
+    "jsonb": (pa.string(), _to_json),
+    "bytea": (pa.binary(), lambda value: bytes(value) if value is not None else None),
+    "boolean[]": (pa.list_(pa.bool_()), _identity),
+    "text[]": (pa.list_(pa.string()), _identity),
+    "integer[]": (pa.list_(pa.int32()), _identity),
+    "bigint[]": (pa.list_(pa.int64()), _identity),
+}
+
+
+def get_parquet_columns(cursor_description):
+    """
+    Returns (schema, converters) for the columns of a psycopg2 cursor description
+    """
+    types_and_converters = [
+        PARQUET_TYPES.get(TYPE_CODES_REVERSED.get(column.type_code), (pa.string(), _to_str))
+        for column in cursor_description
+    ]
+    schema = pa.schema(
+        [
+            (column.name, parquet_type)
+            for column, (parquet_type, _) in zip(cursor_description, types_and_converters)
+        ]
+    )
+    return schema, [converter for _, converter in types_and_converters]
+
+
+class ParquetStreamWriter:
+    """
+    Writes rows as Parquet row groups, returning the bytes of the file as they are written, so
+    the file can be streamed without being held in memory, or written to disk
+    """
+
+    def __init__(self, cursor_description, compression="snappy"):
+        self.schema, self._converters = get_parquet_columns(cursor_description)
+        self._sink = _Sink()
+        self._writer = pq.ParquetWriter(
+            pa.PythonFile(self._sink, mode="w"), self.schema, compression=compression
+        )
+
+    def write_rows(self, rows):
+        columns = [
+            [converter(row[i]) for row in rows] for i, converter in enumerate(self._converters)
+        ]
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        return self._sink.take()
+
+    def close(self):
+        self._writer.close()
+        return self._sink.take()
+
+
+class ArrowStreamWriter:
+    """
+    Writes rows as record batches of an Arrow IPC stream, returning the bytes of the stream
+    as they are written. The stream uses the same types as ParquetStreamWriter
+    """
+
+    def __init__(self, cursor_description):
+        self.schema, self._converters = get_parquet_columns(cursor_description)
+        self._sink = _Sink()
+        self._writer = pa.ipc.new_stream(pa.PythonFile(self._sink, mode="w"), self.schema)
+
+    def record_batch(self, rows):
+        return pa.RecordBatch.from_arrays(
+            [[converter(row[i]) for row in rows] for i, converter in enumerate(self._converters)],
+            schema=self.schema,
+        )
+
+    def write_batch(self, record_batch):
+        self._writer.write_batch(record_batch)
+        return self._sink.take()
+
+    def write_rows(self, rows):
+        return self.write_batch(self.record_batch(rows))
+
+    def close(self, custom_metadata=None):
+        # Metadata can only be written with a record batch, so an empty one is written for it
+        if custom_metadata:
+            self._writer.write_batch(self.record_batch([]), custom_metadata=custom_metadata)
+        self._writer.close()
+        return self._sink.take()
+
+
+class _Sink:
+    # pyarrow needs the position in the file to write the offsets of row groups in the footer,
+    # so it's tracked here even though the bytes are discarded once they're taken
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
@@ -10,8 +10,9 @@ import random
 import re
 import secrets
 import string
+import sys
 import time
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from contextlib import contextmanager
 from functools import wraps
 from io import StringIO
@@ -22,6 +23,7 @@ from urllib.parse import unquote
 import boto3
 import gevent
 import gevent.queue
+import gevent.subprocess
 import psycopg2
 import requests
 import sqlalchemy as sa
@@ -34,7 +36,7 @@ from django.db import connection, connections
 from django.db.models import Value, F, Q
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from mohawk import Sender
 from pg_sync_roles import (
     DatabaseConnect,
@@ -47,10 +49,12 @@ from pg_sync_roles import (
     sync_roles,
 )
 from psycopg2 import connect, sql
+from psycopg2.extensions import make_dsn
 from psycopg2.sql import SQL
 from tableschema import Schema
 
 import redis
+from dataworkspace.apps.core import copy_csv
 from dataworkspace.apps.core.boto3_client import get_iam_client, get_s3_client
 from dataworkspace.apps.core.constants import (
     DATA_FLOW_TASK_ERROR_MAP,
@@ -58,7 +62,20 @@ from dataworkspace.apps.core.constants import (
     TABLESCHEMA_FIELD_TYPE_MAP,
     PostgresDataTypes,
 )
+from dataworkspace.apps.core.download_slots import (
+    DownloadSlotsUnavailable,
+    acquire_download_slot,
+    download_slots_unavailable_response,
+    hold_download_slot,
+)
+from dataworkspace.apps.core.export_cache import (
+    CachedExportRangeNotSatisfiable,
+    get_cached_export,
+    get_export_cache_key,
+    tee_to_export_cache,
+)
 from dataworkspace.apps.core.models import DatabaseUser, Team, TeamMembership
+from dataworkspace.apps.core.parquet import ParquetStreamWriter
 from dataworkspace.apps.datasets.constants import UserAccessType
 from dataworkspace.apps.datasets.models import (
     AdminVisualisationUserPermission,
@@ -68,6 +85,10 @@ from dataworkspace.apps.datasets.models import (
 )
 from dataworkspace.apps.notification_banner.models import NotificationBanner
 from dataworkspace.cel import celery_app
+from dataworkspace.datasets_db import (
+    get_dataset_primary_key,
+    get_earliest_tables_last_updated_date,
+)
 
 logger = logging.getLogger("app")
 
@@ -800,38 +821,60 @@ def streaming_query_response(
     query,
     filename,
     query_params=None,
-    unfiltered_query=None,
     query_metrics_callback=None,
     cursor_name="data_download",
+    use_copy=False,
+    file_format="csv",
 ):
     """
-    Returns a streaming http response containing a csv file for download
+    Returns a streaming http response containing a csv, or parquet, file for download
 
     when provided will callback with query metrics details
-    * Total number of rows in original query vs number of rows requested
-    * Total number of columns in origin vs number of columns requested
+    * Number of rows and columns downloaded
+    * Number of bytes downloaded and the time taken
+
+    The metrics are collected while the data is streamed, so they cost no extra queries. In
+    particular, the total number of rows of the query without its filters isn't counted, since
+    that would run the query in full again
 
     @param user_email: for logging - who initiated this download
     @param database: name of database where the query should be executed
     @param query: psycopg2 composed SQL query
     @param filename: the filename that should be generated
     @param query_params: additional query parameters applied to query
-    @param unfiltered_query: the query without any filters applied
     @param query_metrics_callback: function to call with query metrics data
     @param cursor_name: optional name for the cursor - helps with debugging locks
+    @param use_copy: stream the csv as generated by PostgreSQL's COPY, rather than generating
+        it in Python. This is much faster for large downloads, but only quotes values where
+        needed, and the query must be a single statement
+    @param file_format: "csv" or "parquet". Parquet files are written a row group at a time,
+        with column types from those of the query's columns
     @return: Customised DjangoStreamingResponse
     """
     logger.info("streaming_query_response start: %s %s %s", user_email, database, query)
 
-    if unfiltered_query and not query_metrics_callback:
-        logger.warning("Missing value for query_metrics_callback.")
-
     logger.debug("query_params %s", query_params)
 
+    slot = None
+    if waffle.switch_is_active(settings.LIMIT_CONCURRENT_DOWNLOADS_SWITCH):
+        try:
+            slot = acquire_download_slot(user_email, database)
+        except DownloadSlotsUnavailable as e:
+            return download_slots_unavailable_response(e)
+
     batch_size = 1000
     query_timeout = 300 * 1000
     idle_in_transaction_timeout = 60 * 1000
 
+    # COPY is a single statement for the whole download, rather than a statement for each
+    # batch, so has a longer timeout. Its output is put on the queue in chunks of at least
+    # copy_chunk_size bytes
+    copy_statement_timeout = 60 * 60 * 1000
+    copy_chunk_size = 1024 * 1024
+
+    # Larger row groups compress better and are faster to read, but are held in memory
+    parquet_row_group_size = 50 * batch_size
+
     # done is added to the queue once the download of the data for the browser is complete
     # this causes the generator to finish and processing to continue
     done = object()
@@ -847,16 +890,16 @@ def streaming_query_response(
 
     # maxsize of 1 means memory use will be 1 * batch_size * bytes per row
     q = gevent.queue.Queue(maxsize=1)
-    should_run_query_metrics = unfiltered_query and query_metrics_callback
+    should_run_query_metrics = query_metrics_callback is not None
 
-    def stream_query_as_csv_to_queue(conn):
-        class PseudoBuffer:
-            def write(self, value):
-                return value
+    class PseudoBuffer:
+        def write(self, value):
+            return value
 
-        pseudo_buffer = PseudoBuffer()
-        csv_writer = csv.writer(pseudo_buffer, quoting=csv.QUOTE_NONNUMERIC)
+    pseudo_buffer = PseudoBuffer()
+    csv_writer = csv.writer(pseudo_buffer, quoting=csv.QUOTE_NONNUMERIC)
 
+    def stream_query_as_csv_to_queue(conn):
         filtered_columns = []
         start = timer()
 
@@ -895,28 +938,111 @@ def streaming_query_response(
 
         return filtered_columns, i, total_bytes, end - start
 
-    def get_all_columns_from_unfiltered(conn):
-        logger.debug("get_all_columns_from_unfiltered")
-        columns_query = sql.SQL("SELECT * FROM ({query}) as data LIMIT 1").format(
-            query=unfiltered_query
-        )
-        with conn.cursor() as cur:
-            cur.execute(columns_query)
-            columns = [column_desc[0] for column_desc in cur.description]
+    def stream_query_as_parquet_to_queue(conn):
+        # Writing parquet is CPU-bound, so is done in gevent's thread pool to not block other
+        # greenlets for the length of each row group
+        threadpool = gevent.get_hub().threadpool
+        filtered_columns = []
+        start = timer()
 
-        return columns
+        with conn.cursor(name=cursor_name) as cur:
+            cur.itersize = batch_size
+            cur.arraysize = batch_size
+            cur.execute(query, query_params)
 
-    def get_row_count_from_unfiltered(conn):
-        logger.debug("get_row_count_from_unfiltered")
-        total_query = sql.SQL("SELECT COUNT(*) from ({query}) as data;").format(
-            query=unfiltered_query,
-        )
+            writer = None
+            row_group = []
+            i = 0
+            total_bytes = 0
+            while True:
+                rows = cur.fetchmany(batch_size)
+
+                if writer is None:
+                    # Column names and types are not populated until the first row fetched
+                    filtered_columns = [column_desc[0] for column_desc in cur.description]
+                    writer = ParquetStreamWriter(cur.description)
+
+                row_group.extend(rows)
+                if row_group and (not rows or len(row_group) >= parquet_row_group_size):
+                    bytes_written = threadpool.apply(writer.write_rows, (row_group,))
+                    i += len(row_group)
+                    total_bytes += len(bytes_written)
+                    row_group = []
+                    logger.debug("total rows %s, total bytes %s", i, total_bytes)
+                    q.put(bytes_written, block=True, timeout=query_timeout)
+
+                if not rows:
+                    break
+
+            bytes_written = writer.close()
+            total_bytes += len(bytes_written)
+            q.put(bytes_written, block=True, timeout=query_timeout)
+
+        q.put(done)
+        end = timer()
+
+        return filtered_columns, i, total_bytes, end - start
+
+    def stream_query_as_copy_csv_to_queue(conn):
+        filtered_columns = []
+        start = timer()
 
         with conn.cursor() as cur:
-            cur.execute(total_query)
-            counts = cur.fetchone()
+            # COPY only accepts a single statement without a trailing semicolon
+            select_query = cur.mogrify(query, query_params).decode("utf-8").rstrip().rstrip(";")
 
-        return counts[0]
+            if should_run_query_metrics:
+                cur.execute(f"SELECT * FROM ({select_query}) AS data LIMIT 0")
+                filtered_columns = [column_desc[0] for column_desc in cur.description]
+
+        # The COPY runs on its own connection, so this one mustn't be left idle in a
+        # transaction while it does
+        conn.rollback()
+
+        # psycopg2 can't COPY while psycogreen's wait callback is registered, so the COPY
+        # is run in a separate process without it, and its output read from a pipe
+        process = gevent.subprocess.Popen(
+            [sys.executable, copy_csv.__file__],
+            stdout=gevent.subprocess.PIPE,
+            stderr=gevent.subprocess.PIPE,
+            env={
+                **os.environ,
+                copy_csv.COPY_CSV_DSN_ENV: make_dsn(
+                    database_dsn(settings.DATABASES_DATA[database]),
+                    options=(
+                        f"-c statement_timeout={copy_statement_timeout} "
+                        "-c default_transaction_read_only=on"
+                    ),
+                ),
+                copy_csv.COPY_CSV_STATEMENT_ENV: (
+                    f"COPY ({select_query}) TO STDOUT WITH (FORMAT CSV, HEADER)"
+                ),
+            },
+        )
+        total_bytes = 0
+        try:
+            while True:
+                chunk = process.stdout.read(copy_chunk_size)
+                if not chunk:
+                    break
+                total_bytes += len(chunk)
+                q.put(chunk, block=True, timeout=query_timeout)
+            row_count_or_error = process.stderr.read().decode("utf-8")
+            if process.wait() != 0:
+                raise copy_csv.CopyCsvError(row_count_or_error)
+        finally:
+            # For example if the client disconnected, and the queue timed out
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+        i = int(row_count_or_error)
+        logger.debug("total bytes %s", total_bytes)
+        q.put(csv_writer.writerow(["Number of rows: " + str(i)]))
+        q.put(done)
+        end = timer()
+
+        return filtered_columns, i, total_bytes, end - start
 
     def run_queries():
         with connect(
@@ -939,20 +1065,24 @@ def streaming_query_response(
                 filtered_rows_count,
                 total_bytes,
                 seconds_elapsed,
-            ) = stream_query_as_csv_to_queue(conn)
+            ) = (
+                stream_query_as_parquet_to_queue(conn)
+                if file_format == "parquet"
+                else (
+                    stream_query_as_copy_csv_to_queue(conn)
+                    if use_copy
+                    else stream_query_as_csv_to_queue(conn)
+                )
+            )
 
             if should_run_query_metrics:
-                # we run this using the connection context and only return the data to caller
-                # once the context / connection is closed to avoid djangodb and datatdb connections
-                # being open at the same time
-                all_columns = get_all_columns_from_unfiltered(conn)
-                all_rows_count = get_row_count_from_unfiltered(conn)
+                # the callback is called from csv_iterator once the download is complete,
+                # rather than from here, to avoid djangodb and datatdb connections being
+                # open at the same time
                 metrics = {
                     "bytes_downloaded": total_bytes,
-                    "column_count": len(all_columns),
                     "column_count_filtered": len(filtered_columns),
                     "download_time_in_seconds": seconds_elapsed,
-                    "row_count": all_rows_count,
                     "row_count_filtered": filtered_rows_count,
                 }
                 q.put(metrics)
@@ -994,9 +1124,15 @@ def streaming_query_response(
 
     response = StreamingHttpResponseWithoutDjangoDbConnection(
         csv_iterator(),
-        content_type="text/csv",
+        content_type=(
+            "application/vnd.apache.parquet" if file_format == "parquet" else "text/csv"
+        ),
     )
     response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    # Parquet files are already compressed
+    response.compressible = file_format != "parquet"
+    if slot is not None:
+        hold_download_slot(response, slot)
 
     logger.info("streaming_query_response end: %s %s %s", user_email, database, query)
 
@@ -1034,14 +1170,219 @@ def get_random_data_sample(database, query, sample_size):
         return sample
 
 
-def table_data(user_email, database, schema, table, filename=None):
+DOWNLOAD_FILE_FORMATS = ("csv", "parquet")
+
+
+def get_download_file_format(request):
+    """
+    Returns the file format requested by the `format` query string parameter of a download,
+    or None if it's not one of DOWNLOAD_FILE_FORMATS
+    """
+    file_format = request.GET.get("format", "csv")
+    return file_format if file_format in DOWNLOAD_FILE_FORMATS else None
+
+
+def table_data(
+    user_email,
+    database,
+    schema,
+    table,
+    filename=None,
+    file_format="csv",
+    http_range=None,
+    http_if_range=None,
+):
     # There is no ordering here. We just want a full dump.
     # Also, there are not likely to be updates, so a long-running
     # query shouldn't cause problems with concurrency/locking
     query = sql.SQL("SELECT * FROM {}.{}").format(sql.Identifier(schema), sql.Identifier(table))
     if filename is None:
-        filename = f"{schema}_{table}.csv"
-    return streaming_query_response(user_email, database, query, filename)
+        filename = f"{schema}_{table}.{file_format}"
+
+    # The data in tables only changes when a pipeline replaces them, so exports of the same
+    # version of their data are cached. Tables not updated by pipelines have no version
+    use_copy = waffle.switch_is_active(settings.COPY_CSV_DOWNLOADS_SWITCH)
+    export_cache_key = None
+    if waffle.switch_is_active(settings.EXPORT_CACHE_SWITCH):
+        data_version = get_earliest_tables_last_updated_date(database, ((schema, table),))
+        if data_version is not None:
+            export_cache_key = get_export_cache_key(
+                database, schema, table, data_version, file_format, use_copy
+            )
+
+    # Cached exports have a known length, so interrupted downloads of them can be resumed
+    # with a Range request. If-Range means only resume if the export hasn't since changed
+    byte_range = (
+        http_range
+        if http_range is not None
+        and re.match(r"^bytes=\d+-\d*$", http_range)
+        and (http_if_range is None or http_if_range == _cached_export_etag(export_cache_key))
+        else None
+    )
+    try:
+        cached_export = (
+            get_cached_export(export_cache_key, byte_range) if export_cache_key else None
+        )
+    except CachedExportRangeNotSatisfiable as ex:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{ex.size}"
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = _cached_export_etag(export_cache_key)
+        return response
+    if cached_export is not None:
+        logger.info("table_data from export cache: %s %s", user_email, export_cache_key)
+        response = StreamingHttpResponseWithoutDjangoDbConnection(
+            cached_export["Body"].iter_chunks(chunk_size=65536),
+            content_type=cached_export["ContentType"],
+            status=206 if byte_range else 200,
+        )
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        response["Content-Length"] = cached_export["ContentLength"]
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = _cached_export_etag(export_cache_key)
+        if byte_range:
+            response["Content-Range"] = cached_export["ContentRange"]
+        # Cached exports aren't gzipped, since that would remove their Accept-Ranges and make
+        # their ETag weak, and so browsers wouldn't be able to resume interrupted downloads
+        return response
+
+    response = streaming_query_response(
+        user_email,
+        database,
+        query,
+        filename,
+        use_copy=use_copy,
+        file_format=file_format,
+    )
+    if export_cache_key and response.streaming:
+        response.streaming_content = tee_to_export_cache(
+            response.streaming_content, export_cache_key, response["Content-Type"]
+        )
+    return response
+
+
+def _cached_export_etag(export_cache_key):
+    # The key includes the version of the data, so is different for each version of an export
+    return (
+        f'"{hashlib.sha256(export_cache_key.encode("utf-8")).hexdigest()}"'
+        if export_cache_key
+        else None
+    )
+
+
+DOWNLOAD_SEGMENT_FIRST = "first"
+
+
+def table_data_segment(user_email, database, schema, table, segment, file_format="csv"):
+    """
+    Returns a streaming response of one segment of the rows of a table, in order of its
+    primary key, with a Link header to the next segment if there is one
+
+    Large tables can be downloaded as a series of segments, starting with the segment
+    DOWNLOAD_SEGMENT_FIRST, so a download that's interrupted only has to repeat its current
+    segment, rather than the whole table. Each segment is found by the primary key values
+    after which it starts, so resuming doesn't scan the rows before it. Segments are only
+    valid for the version of the data of the table they were started from
+    """
+    data_version = get_earliest_tables_last_updated_date(database, ((schema, table),))
+    data_version = data_version.isoformat() if data_version is not None else None
+
+    if segment == DOWNLOAD_SEGMENT_FIRST:
+        index, after = 0, None
+    else:
+        try:
+            token = json.loads(urlsafe_b64decode(segment.encode("ascii")))
+            index, after, token_data_version = token["index"], token["after"], token["version"]
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest("Invalid segment")
+        if token_data_version != data_version:
+            return HttpResponse(
+                "The data has changed since the download started. Please start it again.",
+                content_type="text/plain",
+                status=409,
+            )
+
+    try:
+        primary_key = get_dataset_primary_key(connections[database], schema, table)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if not primary_key:
+        return HttpResponseBadRequest(
+            "Only tables with a primary key can be downloaded in segments"
+        )
+
+    # Tokens come from the client, so are checked to be of the form of ones made below
+    if segment != DOWNLOAD_SEGMENT_FIRST and not (
+        isinstance(index, int)
+        and not isinstance(index, bool)
+        and index >= 0
+        and isinstance(after, list)
+        and len(after) == len(primary_key)
+        and all(isinstance(value, str) for value in after)
+    ):
+        return HttpResponseBadRequest("Invalid segment")
+
+    primary_key_sql = sql.SQL(",").join(map(sql.Identifier, primary_key))
+    after_sql = (
+        sql.SQL("TRUE")
+        if after is None
+        else sql.SQL("({}) > ({})").format(
+            primary_key_sql, sql.SQL(",").join(sql.Placeholder() * len(after))
+        )
+    )
+    after_params = after or []
+
+    # The end of the segment is found first, using the primary key's index, so the link to the
+    # next segment can be sent before the segment itself
+    with connections[database].cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT {} FROM {}.{} WHERE {} ORDER BY {} OFFSET %s LIMIT 1").format(
+                primary_key_sql,
+                sql.Identifier(schema),
+                sql.Identifier(table),
+                after_sql,
+                primary_key_sql,
+            ),
+            after_params + [settings.DOWNLOAD_SEGMENT_ROWS - 1],
+        )
+        end = cursor.fetchone()
+
+    end_sql = (
+        sql.SQL("TRUE")
+        if end is None
+        else sql.SQL("({}) <= ({})").format(
+            primary_key_sql, sql.SQL(",").join(sql.Placeholder() * len(end))
+        )
+    )
+    query = sql.SQL("SELECT * FROM {}.{} WHERE {} AND {} ORDER BY {}").format(
+        sql.Identifier(schema),
+        sql.Identifier(table),
+        after_sql,
+        end_sql,
+        primary_key_sql,
+    )
+    response = streaming_query_response(
+        user_email,
+        database,
+        query,
+        f"{schema}_{table}_{index:05d}.{file_format}",
+        query_params=after_params + list(end or []),
+        use_copy=waffle.switch_is_active(settings.COPY_CSV_DOWNLOADS_SWITCH),
+        file_format=file_format,
+    )
+
+    if end is not None and response.streaming:
+        next_segment = urlsafe_b64encode(
+            json.dumps(
+                {
+                    "index": index + 1,
+                    "after": [str(value) for value in end],
+                    "version": data_version,
+                }
+            ).encode("utf-8")
+        ).decode("ascii")
+        response["Link"] = f'<?segment={next_segment}&format={file_format}>; rel="next"'
+    return response
 
 
 def get_s3_prefix(user_sso_id):
@@ -1061,6 +1402,10 @@ class StreamingHttpResponseWithoutDjangoDbConnection(StreamingHttpResponse):
     # Django's point of view its closed, but we we currently use
     # django-db-geventpool which overrides "close" to replace the connection
     # into a pool to be reused later
+
+    # Set to True for responses that compress_streamed_downloads should gzip
+    compressible = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         close_admin_db_connection_if_not_in_atomic_block()
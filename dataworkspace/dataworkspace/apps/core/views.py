@@ -43,10 +43,12 @@ from dataworkspace.apps.core.utils import (
     can_access_schema_table,
     check_db,
     get_data_flow_import_pipeline_name,
+    get_download_file_format,
     get_dataflow_dag_status,
     get_dataflow_task_status,
     is_last_days_remaining_notification_banner,
     table_data,
+    table_data_segment,
     table_exists,
     view_exists,
 )
@@ -403,8 +405,27 @@ def table_data_view(request, database, schema, table):
         return HttpResponseForbidden()
     elif not (view_exists(database, schema, table) or table_exists(database, schema, table)):
         return HttpResponseNotFound()
+    elif get_download_file_format(request) is None:
+        return HttpResponseBadRequest("Expected `format` to be csv or parquet")
+    elif request.GET.get("segment") is not None:
+        return table_data_segment(
+            request.user.email,
+            database,
+            schema,
+            table,
+            request.GET["segment"],
+            file_format=get_download_file_format(request),
+        )
     else:
-        return table_data(request.user.email, database, schema, table)
+        return table_data(
+            request.user.email,
+            database,
+            schema,
+            table,
+            file_format=get_download_file_format(request),
+            http_range=request.headers.get("Range"),
+            http_if_range=request.headers.get("If-Range"),
+        )
 
 
 class ServeS3UploadedFileView(View):
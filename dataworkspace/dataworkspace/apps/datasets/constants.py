@@ -3,6 +3,15 @@ from django.db import models
 LINKED_FIELD_IDENTIFIER = "IDENTIFIER"
 LINKED_FIELD_DISPLAY_NAME = "DISPLAY_NAME"
 
+# Content types of source link files that are compressed when downloaded, if the client accepts
+# a compressed response
+COMPRESSIBLE_CONTENT_TYPES = (
+    "application/json",
+    "text/csv",
+    "text/plain",
+    "text/tab-separated-values",
+)
+
 # Map some postgres data types to types ag-grid can filter against.
 # If not set falls back to `text` on the frontend
 GRID_DATA_TYPE_MAP = {
@@ -11,6 +11,7 @@ import boto3
 import botocore
 import requests
 import sqlparse
+from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
@@ -52,6 +53,7 @@ from dataworkspace.datasets_db import (
     get_custom_dataset_query_changelog,
     get_data_hash,
     get_earliest_tables_last_updated_date,
+    get_estimated_row_count,
     get_reference_dataset_changelog,
     get_rows_number,
     get_source_table_changelog,
@@ -873,6 +875,31 @@ def do_store_custom_dataset_query_metadata():
                 )
 
 
+@celery_app.task()
+@close_all_connections_if_not_in_atomic_block
+def store_download_row_count(event_id):
+    """
+    Adds the number of rows of the source of a data grid download, without the download's
+    filters, to the event logged when the download completed. This is the row count recorded
+    in dataflow.metadata by the pipeline, or by store_custom_dataset_query_metadata, falling
+    back to PostgreSQL's estimate for tables, so the source is never counted in full
+    """
+    event = EventLog.objects.get(id=event_id)
+    source = apps.get_model(event.extra["model"]).objects.get(pk=event.extra["pk"])
+
+    row_count = source.get_metadata_row_count()
+    row_count_source = "metadata"
+    if row_count is None and isinstance(source, SourceTable):
+        row_count = get_estimated_row_count(
+            source.database.memorable_name, source.schema, source.table
+        )
+        row_count_source = "estimate"
+
+    event.extra["row_count"] = row_count
+    event.extra["row_count_source"] = row_count_source if row_count is not None else None
+    event.save(update_fields=["extra"])
+
+
 @celery_app.task()
 @close_all_connections_if_not_in_atomic_block
 def store_reference_dataset_metadata():
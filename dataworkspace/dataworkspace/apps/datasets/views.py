@@ -37,6 +37,7 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_GET, require_http_methods, require_POST
 from django.views.generic import DetailView, FormView, TemplateView, UpdateView, View
 from psycopg2 import sql
+from waffle import switch_is_active
 
 from dataworkspace import zendesk
 from dataworkspace import datasets_db
@@ -49,13 +50,19 @@ from dataworkspace.apps.core.models import Database
 from dataworkspace.apps.core.utils import (
     StreamingHttpResponseWithoutDjangoDbConnection,
     database_dsn,
+    get_download_file_format,
     get_notification_banner,
     is_last_days_remaining_notification_banner,
     streaming_query_response,
     table_data,
     view_exists,
 )
-from dataworkspace.apps.datasets.constants import DataLinkType, DataSetType, TagType
+from dataworkspace.apps.datasets.constants import (
+    COMPRESSIBLE_CONTENT_TYPES,
+    DataLinkType,
+    DataSetType,
+    TagType,
+)
 from dataworkspace.apps.datasets.data_dictionary.service import DataDictionaryService
 from dataworkspace.apps.datasets.forms import (
     DatasetEditForm,
@@ -99,6 +106,7 @@ from dataworkspace.apps.datasets.utils import (
     get_code_snippets_for_table,
     get_recently_viewed_catalogue_pages,
     get_tools_links_for_user,
+    store_download_row_count,
 )
 from dataworkspace.apps.eventlog.models import EventLog
 from dataworkspace.apps.eventlog.utils import log_event, log_permission_change
@@ -819,6 +827,10 @@ class SourceLinkDownloadView(DetailView):
         )
         response["Content-Disposition"] = f'attachment; filename="{source_link.get_filename()}"'
         response["Content-Length"] = file_object["ContentLength"]
+        # Files that are already compressed, e.g. zip files, would gain nothing from compression
+        response.compressible = file_object["ContentType"].split(";")[
+            0
+        ].strip() in COMPRESSIBLE_CONTENT_TYPES and not file_object.get("ContentEncoding")
 
         return response
 
@@ -831,7 +843,7 @@ class SourceDownloadMixin:
     def db_object_exists(db_object):
         raise NotImplementedError()
 
-    def get_table_data(self, db_object):
+    def get_table_data(self, db_object, file_format):
         raise NotImplementedError()
 
     def get(self, request, *_, **__):
@@ -841,6 +853,9 @@ class SourceDownloadMixin:
         if not db_object.dataset.user_has_access(self.request.user):
             return HttpResponseForbidden()
 
+        if get_download_file_format(request) is None:
+            return HttpResponseBadRequest("Expected `format` to be csv or parquet")
+
         if not self.db_object_exists(db_object):
             return HttpResponseNotFound()
 
@@ -855,7 +870,7 @@ class SourceDownloadMixin:
         )
         dataset.number_of_downloads = F("number_of_downloads") + 1
         dataset.save(update_fields=["number_of_downloads"])
-        return self.get_table_data(db_object)
+        return self.get_table_data(db_object, get_download_file_format(request))
 
 
 class SourceViewDownloadView(SourceDownloadMixin, DetailView):
@@ -866,13 +881,16 @@ class SourceViewDownloadView(SourceDownloadMixin, DetailView):
     def db_object_exists(db_object):
         return view_exists(db_object.database.memorable_name, db_object.schema, db_object.view)
 
-    def get_table_data(self, db_object):
+    def get_table_data(self, db_object, file_format):
         return table_data(
             self.request.user.email,
             db_object.database.memorable_name,
             db_object.schema,
             db_object.view,
-            db_object.get_filename(),
+            db_object.get_filename(extension=f".{file_format}"),
+            file_format=file_format,
+            http_range=self.request.headers.get("Range"),
+            http_if_range=self.request.headers.get("If-Range"),
         )
 
 
@@ -890,6 +908,10 @@ class CustomDatasetQueryDownloadView(DetailView):
         if not query.reviewed and not request.user.is_superuser:
             return HttpResponseForbidden()
 
+        file_format = get_download_file_format(request)
+        if file_format is None:
+            return HttpResponseBadRequest("Expected `format` to be csv or parquet")
+
         log_event(
             request.user,
             EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD,
@@ -917,8 +939,10 @@ class CustomDatasetQueryDownloadView(DetailView):
             request.user.email,
             query.database.memorable_name,
             filtered_query,
-            query.get_filename(),
+            query.get_filename(extension=f".{file_format}"),
             cursor_name=f"custom_query--{query.id}",
+            use_copy=switch_is_active(settings.COPY_CSV_DOWNLOADS_SWITCH),
+            file_format=file_format,
         )
 
 
@@ -1344,9 +1368,10 @@ class DataGridDataView(DetailView):
             filters = {}
             for filter_data in [json.loads(x) for x in request.POST.getlist("filters")]:
                 filters.update(filter_data)
+            source_column_config = source.get_column_config()
             column_config = [
                 x
-                for x in source.get_column_config()
+                for x in source_column_config
                 if x["field"] in request.POST.getlist("columns", [])
             ]
             if not column_config:
@@ -1399,12 +1424,15 @@ class DataGridDataView(DetailView):
                 logger.debug("write_metrics_to_eventlog %s", log_data)
 
                 log_data.update(extra)
-                log_event(
+                log_data["column_count"] = len(source_column_config)
+                event = log_event(
                     request.user,
                     EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD_COMPLETE,
                     source.dataset,
                     extra=log_data,
                 )
+                # The number of rows without filters isn't known from the download itself
+                store_download_row_count.delay(event.id)
 
             return streaming_query_response(
                 request.user.email,
@@ -1412,7 +1440,6 @@ class DataGridDataView(DetailView):
                 query,
                 request.POST.get("export_file_name", f"custom-{source.dataset.slug}-export.csv"),
                 params,
-                original_query,
                 write_metrics_to_eventlog,
                 cursor_name=f'data-grid--{self.kwargs["model_class"].__name__}--{source.id}',
             )
@@ -429,6 +429,169 @@ def get_latest_row_count_for_query(query):
         return result[0] if result else None
 
 
+def get_estimated_row_count(database_name: str, schema: str, table: str):
+    """
+    Return PostgreSQL's estimate of the number of rows in a table, as of when it was last
+    vacuumed or analysed, or None if it never has been
+    """
+    with connections[database_name].cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.reltuples::bigint
+            FROM pg_class c
+            INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s
+            """,
+            [schema, table],
+        )
+        result = cursor.fetchone()
+        # reltuples is -1 for tables that have never been vacuumed or analysed
+        return result[0] if result and result[0] >= 0 else None
+
+
+def get_dataset_primary_key(connection, schema, table):
+    """
+    Return the names of the columns of the primary key of a table, in order, or an empty list
+    if it has none. Raises ValueError if it doesn't exist or isn't an ordinary table
+    """
+    check_is_table = psycopg2.sql.SQL(
+        """
+        SELECT
+            CASE
+                WHEN pg_class.relkind = 'r' THEN 'table'::text
+                WHEN pg_class.relkind = 'v' THEN 'view'::text
+                ELSE pg_class.relkind::text
+            END
+        FROM pg_class
+                 INNER JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+        WHERE pg_namespace.nspname = %s
+          AND pg_class.relname = %s;
+        """
+    )
+    sql = psycopg2.sql.SQL(
+        """
+        SELECT
+            pg_attribute.attname AS column_name
+        FROM
+            pg_catalog.pg_class pg_class_table
+        INNER JOIN
+            pg_catalog.pg_index ON pg_index.indrelid = pg_class_table.oid
+        INNER JOIN
+            pg_catalog.pg_class pg_class_index ON pg_class_index.oid = pg_index.indexrelid
+        INNER JOIN
+            pg_catalog.pg_namespace ON pg_namespace.oid = pg_class_table.relnamespace
+        INNER JOIN
+            pg_catalog.pg_attribute ON pg_attribute.attrelid = pg_class_index.oid
+        WHERE
+            pg_namespace.nspname = %s
+            AND pg_class_table.relname = %s
+            AND pg_index.indisprimary
+        ORDER BY
+            pg_attribute.attnum
+        """
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(check_is_table, (schema, table))
+        result = cursor.fetchall()
+
+        if len(result) == 0:
+            raise ValueError(f"Table does not exist: `{schema}`.`{table}`")
+        if result[0][0] != "table":
+            raise ValueError(
+                f"Cannot get primary keys from something other than an ordinary table. "
+                f"`{schema}`.`{table}` is a: {result[0][0]}"
+            )
+
+        cursor.execute(sql, (schema, table))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_dataset_partition_boundaries(connection, schema, table, primary_key, num_partitions):
+    """
+    Return up to num_partitions - 1 values of the primary key of a table, in order, that split
+    it into num_partitions ranges of roughly the same number of rows. Each is a list of the
+    values of the columns of the primary key. They are estimated from the histogram of the
+    primary key in pg_stats if it has one column and the table has been analysed, and
+    otherwise from a sample of the table
+    """
+    source = psycopg2.sql.SQL("{}.{}").format(
+        psycopg2.sql.Identifier(schema), psycopg2.sql.Identifier(table)
+    )
+    primary_key_columns = psycopg2.sql.SQL(",").join(map(psycopg2.sql.Identifier, primary_key))
+
+    with connection.cursor() as cursor:
+        values = []
+        if len(primary_key) == 1:
+            cursor.execute(
+                """
+                SELECT format_type(pg_attribute.atttypid, pg_attribute.atttypmod)
+                FROM pg_attribute
+                INNER JOIN pg_class ON pg_class.oid = pg_attribute.attrelid
+                INNER JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+                WHERE pg_namespace.nspname = %s
+                  AND pg_class.relname = %s
+                  AND pg_attribute.attname = %s
+                """,
+                (schema, table, primary_key[0]),
+            )
+            column_type = cursor.fetchone()[0]
+            # histogram_bounds is an anyarray, which can only be cast to the type of the
+            # column via text. The bounds split the rows into buckets of equal size
+            cursor.execute(
+                psycopg2.sql.SQL(
+                    """
+                    SELECT unnest(histogram_bounds::text::{}[])
+                    FROM pg_stats
+                    WHERE schemaname = %s AND tablename = %s AND attname = %s AND NOT inherited
+                    """
+                ).format(psycopg2.sql.SQL(column_type)),
+                (schema, table, primary_key[0]),
+            )
+            values = cursor.fetchall()
+
+        if not values:
+            cursor.execute(
+                """
+                SELECT
+                    c.reltuples::bigint,
+                    pg_relation_size(c.oid) / current_setting('block_size')::bigint
+                FROM pg_class c
+                INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = %s AND c.relname = %s
+                """,
+                (schema, table),
+            )
+            estimated_row_count, num_pages = cursor.fetchone()
+            sample_size = max(10000, 100 * num_partitions)
+            # reltuples is -1, or 0, for tables that have never been vacuumed or analysed, but
+            # their size is known. SYSTEM samples whole pages, so enough pages are sampled for
+            # sample_size rows of up to 800 bytes
+            sample_percent = (
+                min(100, 100 * sample_size / estimated_row_count)
+                if estimated_row_count > 0
+                else min(100, 100 * (sample_size / 10) / max(num_pages, 1))
+            )
+            # The sample is also limited, in case the estimate is far out, so the whole of a
+            # large table is never sorted and fetched
+            cursor.execute(
+                psycopg2.sql.SQL(
+                    "SELECT * FROM (SELECT {} FROM {} TABLESAMPLE SYSTEM (%s) LIMIT %s) AS sample "
+                    "ORDER BY {}"
+                ).format(primary_key_columns, source, primary_key_columns),
+                (sample_percent, 10 * sample_size),
+            )
+            values = cursor.fetchall()
+
+    boundaries = []
+    for i in range(1, num_partitions if values else 1):
+        boundary = list(values[round(i * (len(values) - 1) / num_partitions)])
+        # Small tables can have fewer distinct values than there are partitions
+        if not boundaries or boundary != boundaries[-1]:
+            boundaries.append(boundary)
+    return boundaries
+
+
 def get_all_source_tables():
     """
     Returns a list of all source tables in the datasets db.
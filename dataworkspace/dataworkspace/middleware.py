@@ -1,4 +1,15 @@
-from django.utils.cache import add_never_cache_headers
+import re
+import zlib
+
+import gevent
+from django.conf import settings
+from django.utils.cache import add_never_cache_headers, patch_vary_headers
+
+re_accepts_gzip = re.compile(r"\bgzip\b")
+
+# Chunks are compressed once at least this many bytes of them are buffered, so small chunks,
+# e.g. the header row of a CSV, don't each cost a round trip to a thread
+GZIP_MIN_CHUNK_SIZE = 65536
 
 
 def disable_client_side_caching(get_response):
@@ -8,3 +19,56 @@ def disable_client_side_caching(get_response):
         return response
 
     return middleware
+
+
+def compress_streamed_downloads(get_response):
+    # Only streaming responses that are marked as compressible are compressed, e.g. CSV
+    # downloads, and not HTML pages, which could be vulnerable to BREACH. This runs after
+    # disable_client_side_caching has added its headers, and leaves them as they are
+    def middleware(request):
+        response = get_response(request)
+
+        if (
+            not getattr(response, "streaming", False)
+            or not getattr(response, "compressible", False)
+            or response.has_header("Content-Encoding")
+        ):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if not re_accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            return response
+
+        if response.has_header("Content-Length"):
+            del response.headers["Content-Length"]
+        # Ranges would be of the compressed bytes, which aren't the same each time
+        if response.has_header("Accept-Ranges"):
+            del response.headers["Accept-Ranges"]
+        if response.has_header("ETag") and not response.headers["ETag"].startswith("W/"):
+            response.headers["ETag"] = "W/" + response.headers["ETag"]
+        response.headers["Content-Encoding"] = "gzip"
+        response.streaming_content = gzip_in_thread(
+            response.streaming_content, settings.STREAMING_DOWNLOAD_GZIP_LEVEL
+        )
+        return response
+
+    return middleware
+
+
+def gzip_in_thread(chunks, level):
+    # Compression is CPU-bound and zlib releases the GIL while compressing, so it's done in
+    # gevent's thread pool to not block other greenlets. Only one buffer of chunks is compressed
+    # at a time, so memory use is bounded however fast the chunks are produced
+    threadpool = gevent.get_hub().threadpool
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= GZIP_MIN_CHUNK_SIZE:
+            compressed = threadpool.apply(compressor.compress, (bytes(buffer),))
+            buffer.clear()
+            if compressed:
+                yield compressed
+
+    yield threadpool.apply(lambda: compressor.compress(bytes(buffer)) + compressor.flush())
@@ -135,6 +135,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "waffle.middleware.WaffleMiddleware",
+    "dataworkspace.middleware.compress_streamed_downloads",
     "dataworkspace.middleware.disable_client_side_caching",
     "csp.middleware.CSPMiddleware",
     "django.contrib.redirects.middleware.RedirectFallbackMiddleware",
@@ -362,6 +363,11 @@ if not strtobool(env.get("DISABLE_CELERY_BEAT_SCHEDULE", "0")):
             "schedule": 60 * 10,
             "args": (),
         },
+        "reconcile-spawner-states": {
+            "task": "dataworkspace.apps.applications.utils.reconcile_spawner_states",
+            "schedule": 30,
+            "args": (),
+        },
         "populate-created-stopped-fargate-containers": {
             "task": "dataworkspace.apps.applications.utils.populate_created_stopped_fargate",
             "schedule": 60 * 10,
@@ -516,6 +522,21 @@ SEARCH_RESULTS_DATASETS_PER_PAGE = 15
 REFERENCE_DATASET_PREVIEW_NUM_OF_ROWS = int(env.get("REFERENCE_DATASET_PREVIEW_NUM_OF_ROWS", 1000))
 DATASET_PREVIEW_NUM_OF_ROWS = int(env.get("DATASET_PREVIEW_NUM_OF_ROWS", 10))
 
+# Level of gzip compression of streamed downloads, e.g. of CSVs, from 1 (fastest) to 9 (smallest)
+STREAMING_DOWNLOAD_GZIP_LEVEL = int(env.get("STREAMING_DOWNLOAD_GZIP_LEVEL", 6))
+
+# Limits on concurrent downloads from the datasets databases, when the
+# LIMIT_CONCURRENT_DOWNLOADS_SWITCH switch is active. Downloads wait up to
+# DOWNLOAD_SLOT_WAIT_SECONDS for a slot, before a 429 is returned
+DOWNLOAD_SLOTS_PER_USER = int(env.get("DOWNLOAD_SLOTS_PER_USER", 2))
+DOWNLOAD_SLOTS_PER_DATABASE = int(env.get("DOWNLOAD_SLOTS_PER_DATABASE", 20))
+DOWNLOAD_SLOT_WAIT_SECONDS = int(env.get("DOWNLOAD_SLOT_WAIT_SECONDS", 10))
+DOWNLOAD_SLOT_RETRY_AFTER_SECONDS = int(env.get("DOWNLOAD_SLOT_RETRY_AFTER_SECONDS", 60))
+DOWNLOAD_SLOT_LEASE_SECONDS = int(env.get("DOWNLOAD_SLOT_LEASE_SECONDS", 300))
+
+# Number of rows in each segment of tables downloaded in segments
+DOWNLOAD_SEGMENT_ROWS = int(env.get("DOWNLOAD_SEGMENT_ROWS", 1000000))
+
 # We explicitly allow some environments to not have a connection to GitLab
 GITLAB_URL = env.get("GITLAB_URL")
 GITLAB_TOKEN = env.get("GITLAB_TOKEN")
@@ -765,6 +786,9 @@ SECURITY_CLASSIFICATION_FLAG = "SECURITY_CLASSIFICATION_FLAG"
 REFERENCE_DATASET_PIPELINE_SYNC = "REFERENCE_DATASET_PIPELINE_SYNC"
 EXPLORER_CSV_INJECTION_PROTECTION_FLAG = "EXPLORER_CSV_INJECTION_PROTECTION_FLAG"
 DEFER_SCHEMA_TAB_LOAD_FLAG = "DEFER_SCHEMA_TAB_LOAD_FLAG"
+COPY_CSV_DOWNLOADS_SWITCH = "COPY_CSV_DOWNLOADS_SWITCH"
+EXPORT_CACHE_SWITCH = "EXPORT_CACHE_SWITCH"
+LIMIT_CONCURRENT_DOWNLOADS_SWITCH = "LIMIT_CONCURRENT_DOWNLOADS_SWITCH"
 CACHE_USER_TABLE_PERMISSIONS = "CACHE_USER_TABLE_PERMISSIONS"
 USE_PG_CLASS_FOR_TABLE_PERMISSIONS = "USE_PG_CLASS_FOR_TABLE_PERMISSIONS"
 INCREMENTAL_S3_IMPORT_PIPELINE_FLAG = "INCREMENTAL_S3_IMPORT_PIPELINE_FLAG"
@@ -779,6 +803,8 @@ SLACK_SENTRY_CHANNEL_WEBHOOK = env.get("SLACK_SENTRY_CHANNEL_WEBHOOK", None)
 LONG_RUNNING_QUERY_ALERT_THRESHOLD = env.get("LONG_RUNNING_QUERY_ALERT_THRESHOLD", "15 minutes")
 
 DATAFLOW_IMPORTS_BUCKET_ROOT = "data-flow-imports"
+# Prefix in the uploads bucket of cached full exports of tables
+EXPORT_CACHE_PREFIX = "export-cache/"
 DATAFLOW_API_CONFIG = {
     "DATAFLOW_BASE_URL": env.get("DATAFLOW_BASE_URL"),
     "DATAFLOW_BASE_URL_DATA_WORKSPACE_AWS_INTERNAL": env.get(
@@ -0,0 +1,204 @@
+import datetime
+import decimal
+import json
+import uuid
+from unittest import mock
+
+import pytest
+import pyarrow as pa
+from django.http.request import MediaType
+from psycopg2.extensions import Column
+
+from dataworkspace.apps.api_v1.datasets.streaming import (
+    ArrowPageEncoder,
+    ByteChunker,
+    JsonPageEncoder,
+    NdjsonPageEncoder,
+    dumps,
+    get_page_encoder_class,
+    get_search_query,
+    yield_page,
+)
+
+ROWS = [
+    (
+        1,
+        "Ánd",
+        None,
+        1.5,
+        decimal.Decimal("1.50"),
+        datetime.datetime(2019, 1, 1, 1, 0),
+        datetime.date(2019, 1, 1),
+        uuid.UUID("c8a5c4e5-2f3d-4b56-9f44-8f5a3c6b2d1e"),
+        ["a", "b"],
+    ),
+    (2, "b", True, 0.0, None, None, None, None, []),
+]
+
+
+@pytest.mark.parametrize("rows", [ROWS, ROWS + [(2**70,)]])
+def test_dumps_encodes_as_json_dumps_does(rows):
+    expected = json.loads(json.dumps(rows, default=str))
+    assert json.loads(dumps(rows)) == expected
+
+    with mock.patch("dataworkspace.apps.api_v1.datasets.streaming.orjson", None):
+        assert json.loads(dumps(rows)) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        [(1, None, float("nan")), (2, float("inf"), float("-inf")), (3, None, 1.5)],
+        [(1, "null", [None, float("nan")])],
+        (1, None, float("-inf")),
+        {"next": float("inf")},
+    ],
+)
+def test_dumps_encodes_non_finite_floats_as_json_dumps_does(value):
+    expected = json.dumps(value).encode("utf-8")
+    assert dumps(value) == expected
+
+    with mock.patch("dataworkspace.apps.api_v1.datasets.streaming.orjson", None):
+        assert dumps(value) == expected
+
+
+def test_dumps_uses_orjson_for_nulls():
+    assert dumps([(1, None, 1.5), (2, None, None)]) == b"[[1,null,1.5],[2,null,null]]"
+    assert dumps({"next": None}) == b'{"next":null}'
+
+
+def test_byte_chunker():
+    chunker = ByteChunker(4)
+    assert chunker.write(b"ab") == []
+    assert chunker.write(memoryview(b"cdefghijk")) == [b"abcd", b"efgh"]
+    assert chunker.write(b"l") == [b"ijkl"]
+    assert chunker.write(b"m") == []
+    assert chunker.flush() == [b"m"]
+    assert chunker.flush() == []
+    assert chunker.num_bytes == 13
+
+
+COLUMNS = ["id", "name"]
+DESCRIPTION = [Column("id", 23), Column("name", 25)]
+
+
+def _page(encoder_class, rows, **kwargs):
+    return b"".join(
+        yield_page(
+            encoder_class(DESCRIPTION), ["id"], COLUMNS, iter(rows), "http://test/page", **kwargs
+        )
+    )
+
+
+def test_yield_json_page():
+    rows = [(1, "a"), (2, datetime.date(2019, 1, 1))]
+    assert json.loads(_page(JsonPageEncoder, rows, chunk_size=4)) == {
+        "headers": ["id", "name"],
+        "values": [[1, "a"], [2, "2019-01-01"]],
+        "next": None,
+    }
+    assert json.loads(_page(JsonPageEncoder, [])) == {
+        "headers": ["id", "name"],
+        "values": [],
+        "next": None,
+    }
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_yield_json_page_ends_page_at_first_row_over_max_size(batch_size):
+    rows = [(i, "name") for i in range(100)]
+    page = json.loads(_page(JsonPageEncoder, rows, num_bytes_max=200, batch_size=batch_size))
+    # The page starts with 38 bytes, and each row is 10 to 12 bytes including its comma
+    assert page["values"] == [[i, "name"] for i in range(15)]
+    assert page["next"] == "http://test/page?$searchAfter=14"
+
+
+def test_yield_page_keeps_upper_bound_in_next_url():
+    rows = [(i, "name") for i in range(100)]
+    page = json.loads(
+        b"".join(
+            yield_page(
+                JsonPageEncoder(DESCRIPTION),
+                ["id"],
+                COLUMNS,
+                iter(rows),
+                "http://test/page",
+                search_up_to=["99"],
+                num_bytes_max=200,
+            )
+        )
+    )
+    assert page["next"] == "http://test/page?$searchAfter=14&$searchUpTo=99"
+
+
+def test_get_search_query():
+    assert get_search_query([1, "a b"]) == "$searchAfter=1&$searchAfter=a%20b"
+    assert get_search_query([1], [datetime.date(2019, 1, 1)]) == (
+        "$searchAfter=1&$searchUpTo=2019-01-01"
+    )
+    assert get_search_query(search_up_to=[5]) == "$searchUpTo=5"
+
+
+def test_yield_ndjson_page():
+    rows = [(i, "name") for i in range(100)]
+    lines = _page(NdjsonPageEncoder, rows, num_bytes_max=200, batch_size=7).splitlines()
+    # The headers are 26 bytes, and each row is 11 or 12 bytes including its newline
+    assert [json.loads(line) for line in lines] == (
+        [{"headers": ["id", "name"]}]
+        + [[i, "name"] for i in range(16)]
+        + [{"next": "http://test/page?$searchAfter=15"}]
+    )
+
+    lines = _page(NdjsonPageEncoder, rows[:2]).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"headers": ["id", "name"]},
+        [0, "name"],
+        [1, "name"],
+        {"next": None},
+    ]
+
+
+def _read_arrow_page(page):
+    reader = pa.ipc.open_stream(page)
+    batches = []
+    custom_metadata = None
+    while True:
+        try:
+            batch, custom_metadata = reader.read_next_batch_with_custom_metadata()
+        except StopIteration:
+            break
+        batches.append(batch)
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    return table, custom_metadata[b"next"].decode() if custom_metadata else None
+
+
+def test_yield_arrow_page():
+    table, next_url = _read_arrow_page(_page(ArrowPageEncoder, [(1, "a"), (2, None)]))
+    assert table.schema == pa.schema([("id", pa.int32()), ("name", pa.string())])
+    assert table.to_pylist() == [{"id": 1, "name": "a"}, {"id": 2, "name": None}]
+    assert next_url is None
+
+    table, next_url = _read_arrow_page(_page(ArrowPageEncoder, []))
+    assert table.num_rows == 0
+
+
+def test_yield_arrow_page_ends_page_over_max_size():
+    rows = [(i, "name") for i in range(100)]
+    table, next_url = _read_arrow_page(_page(ArrowPageEncoder, rows, num_bytes_max=200))
+    assert 0 < table.num_rows < 100
+    assert next_url == f"http://test/page?$searchAfter={table.num_rows - 1}"
+
+
+@pytest.mark.parametrize(
+    "accept, encoder_class",
+    [
+        ("*/*", JsonPageEncoder),
+        ("text/html", JsonPageEncoder),
+        ("application/json", JsonPageEncoder),
+        ("application/x-ndjson", NdjsonPageEncoder),
+        ("application/vnd.apache.arrow.stream, application/json", ArrowPageEncoder),
+    ],
+)
+def test_get_page_encoder_class(accept, encoder_class):
+    accepted_types = [MediaType(token) for token in accept.split(",")]
+    assert get_page_encoder_class(accepted_types) is encoder_class
@@ -2,6 +2,7 @@ import json
 from datetime import datetime
 
 import psycopg2
+import pyarrow as pa
 import pytest
 from django.conf import settings
 from django.test import TestCase
@@ -262,6 +263,109 @@ class TestAPIDatasetView(TestCase):
         output_dict = json.loads(output.decode("utf-8"))
         self.assertEqual(output_dict, expected)
 
+    def _create_table(self):
+        database = Database.objects.get_or_create(memorable_name=self.memorable_name)[0]
+        data_grouping = DataGrouping.objects.get_or_create()[0]
+        dataset = DataSet.objects.get_or_create(grouping=data_grouping)[0]
+        source_table = SourceTable.objects.get_or_create(
+            dataset=dataset, database=database, table=self.table
+        )[0]
+        with psycopg2.connect(
+            database_dsn(settings.DATABASES_DATA[self.memorable_name])
+        ) as conn, conn.cursor() as cur:
+            cur.execute(f"create table {self.table} (id int primary key, name varchar(100))")
+            cur.executemany(
+                f"insert into {self.table} values (%s, %s)", [(0, "abigail"), (1, "romeo")]
+            )
+        return f"/api/v1/dataset/{dataset.id}/{source_table.id}"
+
+    def test_ndjson(self):
+        url = self._create_table()
+        response = self.client.get(url + "?$searchAfter=0", HTTP_ACCEPT="application/x-ndjson")
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertIn("Accept", response["Vary"])
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{"headers": ["id", "name"]}, [1, "romeo"], {"next": None}],
+        )
+
+    def test_arrow(self):
+        url = self._create_table()
+        response = self.client.get(url, HTTP_ACCEPT="application/vnd.apache.arrow.stream")
+
+        self.assertEqual(response["Content-Type"], "application/vnd.apache.arrow.stream")
+        table = pa.ipc.open_stream(b"".join(response.streaming_content)).read_all()
+        self.assertEqual(table.schema, pa.schema([("id", pa.int32()), ("name", pa.string())]))
+        self.assertEqual(
+            table.to_pylist(), [{"id": 0, "name": "abigail"}, {"id": 1, "name": "romeo"}]
+        )
+
+    def test_search_up_to(self):
+        url = self._create_table()
+        with psycopg2.connect(
+            database_dsn(settings.DATABASES_DATA[self.memorable_name])
+        ) as conn, conn.cursor() as cur:
+            cur.execute(f"insert into {self.table} values (2, 'juliet')")
+
+        response = self.client.get(url + "?$searchAfter=0&$searchUpTo=1")
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {"headers": ["id", "name"], "values": [[1, "romeo"]], "next": None},
+        )
+
+        response = self.client.get(url + "?$searchUpTo=1")
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content))["values"],
+            [[0, "abigail"], [1, "romeo"]],
+        )
+
+    def test_partitions(self):
+        url = self._create_table()
+        with psycopg2.connect(
+            database_dsn(settings.DATABASES_DATA[self.memorable_name])
+        ) as conn, conn.cursor() as cur:
+            cur.execute(
+                f"insert into {self.table} select i, 'name' from generate_series(2, 999) i"
+            )
+
+        response = self.client.get(url + "/partitions?$partitions=4")
+        self.assertEqual(response.status_code, 200)
+        partitions = response.json()
+        self.assertEqual(partitions["primary_key"], ["id"])
+        self.assertEqual(len(partitions["boundaries"]), 3)
+        self.assertEqual(len(partitions["urls"]), 4)
+
+        # The ranges are disjoint, and together have all the rows
+        ids = []
+        for partition_url in partitions["urls"]:
+            response = self.client.get(partition_url)
+            ids += [row[0] for row in json.loads(b"".join(response.streaming_content))["values"]]
+        self.assertEqual(ids, list(range(1000)))
+
+    def test_partitions_analysed_table(self):
+        url = self._create_table()
+        with psycopg2.connect(
+            database_dsn(settings.DATABASES_DATA[self.memorable_name])
+        ) as conn, conn.cursor() as cur:
+            cur.execute(
+                f"insert into {self.table} select i, 'name' from generate_series(2, 999) i"
+            )
+            cur.execute(f"analyze {self.table}")
+
+        partitions = self.client.get(url + "/partitions?$partitions=4").json()
+        self.assertEqual(len(partitions["boundaries"]), 3)
+        self.assertEqual(
+            partitions["boundaries"], sorted(partitions["boundaries"], key=lambda b: b[0])
+        )
+
+    def test_partitions_invalid(self):
+        url = self._create_table()
+        for partitions in ["", "0", "a", "1001"]:
+            response = self.client.get(url + f"/partitions?$partitions={partitions}")
+            self.assertEqual(response.status_code, 400)
+
 
 class TestAPIReferenceDatasetView(TestCase):
     def test_route(self):
@@ -420,6 +524,31 @@ class TestAPIReferenceDatasetView(TestCase):
             {"headers": ["id", "name"], "values": [[2, "Ánd again"]], "next": None},
         )
 
+    def test_get_data_arrow(self):
+        group = factories.DataGroupingFactory.create()
+        rds = factories.ReferenceDatasetFactory.create(group=group, table_name="test_get_arrow")
+        field1 = factories.ReferenceDatasetFieldFactory.create(
+            reference_dataset=rds, name="id", data_type=2, is_identifier=True
+        )
+        field2 = factories.ReferenceDatasetFieldFactory.create(
+            reference_dataset=rds, name="name", data_type=1
+        )
+        rds.save_record(
+            None,
+            {
+                "reference_dataset": rds,
+                field1.column_name: 1,
+                field2.column_name: "Ánd again",
+            },
+        )
+
+        url = f"/api/v1/reference-dataset/{group.slug}/reference/{rds.slug}"
+        response = self.client.get(url, HTTP_ACCEPT="application/vnd.apache.arrow.stream")
+
+        table = pa.ipc.open_stream(b"".join(response.streaming_content)).read_all()
+        self.assertEqual(table.schema, pa.schema([("id", pa.int32()), ("name", pa.string())]))
+        self.assertEqual(table.to_pylist(), [{"id": 1, "name": "Ánd again"}])
+
 
 @pytest.mark.django_db(transaction=True)
 @freeze_time("2020-01-01 00:01:00")
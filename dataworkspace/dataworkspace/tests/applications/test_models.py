@@ -1,11 +1,17 @@
+from unittest import mock
+
 import pytest
 from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
 
 from dataworkspace.apps.eventlog.models import EventLog
 from dataworkspace.tests.factories import (
+    ApplicationInstanceFactory,
+    ApplicationTemplateFactory,
     VisualisationApprovalFactory,
     VisualisationTemplateFactory,
 )
+from dataworkspace.utils import APPLICATION_INSTANCE_CHANGED_CHANNEL
 
 
 class TestVisualisationApproval:
@@ -58,3 +64,34 @@ class TestVisualisationApproval:
             str(e.value)
             == "A new record must be created for a new approval - you cannot flip a rescinded approval."
         )
+
+
+class TestApplicationInstance:
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.models.get_redis_connection")
+    def test_change_is_published_after_commit(self, mock_get_redis_connection):
+        application_template = ApplicationTemplateFactory.create()
+        with TestCase.captureOnCommitCallbacks(execute=True) as callbacks:
+            instance = ApplicationInstanceFactory.create(
+                application_template=application_template, public_host="testapplication-23b40dd9"
+            )
+            assert not mock_get_redis_connection.return_value.publish.called
+
+        assert len(callbacks) == 1
+        mock_get_redis_connection.return_value.publish.assert_called_once_with(
+            APPLICATION_INSTANCE_CHANGED_CHANNEL, "testapplication-23b40dd9"
+        )
+
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            instance.state = "STOPPED"
+            instance.save(update_fields=["state"])
+
+        assert mock_get_redis_connection.return_value.publish.call_count == 2
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.models.get_redis_connection")
+    def test_failure_to_publish_does_not_fail_save(self, mock_get_redis_connection):
+        mock_get_redis_connection.return_value.publish.side_effect = Exception("Redis is down")
+
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            ApplicationInstanceFactory.create(public_host="testapplication-23b40dd9")
@@ -11,29 +11,35 @@ import mock
 import pytest
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
-from django.test import override_settings
+from django.test import TestCase, override_settings
 from freezegun import freeze_time
 from waffle.testutils import override_switch
 
 import redis
 from dataworkspace.apps.accounts.models import Profile
 from dataworkspace.apps.applications.models import ApplicationInstance
+from dataworkspace.apps.applications.spawner import FargateSpawner
 from dataworkspace.apps.applications.utils import (
     _do_get_staff_sso_s3_object_summaries,
+    _do_reconcile_spawner_states,
     _do_sync_s3_sso_users,
     _do_sync_tool_query_logs,
     _get_seen_ids,
     _is_full_sync,
     _process_staff_sso_file,
+    api_application_dict,
+    application_api_is_allowed,
     delete_unused_datasets_users,
+    invalidate_application_api_is_allowed_cache,
     long_running_query_alert,
     remove_tools_access_for_users_with_expired_cert,
     self_certify_renewal_email_notification,
     sync_quicksight_permissions,
 )
+from dataworkspace.apps.core.errors import ToolPermissionDeniedError
 from dataworkspace.apps.core.utils import _do_create_tools_access_iam_role
 from dataworkspace.apps.datasets.constants import UserAccessType
 from dataworkspace.apps.datasets.models import ToolQueryAuditLog, ToolQueryAuditLogTable
@@ -1199,3 +1205,223 @@ class TestSelfCertifyRenewalEmailNotification:
         )
         mock_send_email.assert_not_called()
         assert user_profile.is_renewal_email_sent is False
+
+
+class TestReconcileSpawnerStates:
+    def teardown_method(self):
+        cache.clear()
+
+    @staticmethod
+    def _fargate_instance(task_arn, state="RUNNING"):
+        return factories.ApplicationInstanceFactory.create(
+            application_template=factories.ApplicationTemplateFactory.create(spawner="FARGATE"),
+            spawner_application_template_options=json.dumps({"CLUSTER_NAME": "test-cluster"}),
+            spawner_application_instance_id=json.dumps({"task_arn": task_arn}),
+            state=state,
+            single_running_or_spawning_integrity=task_arn,
+        )
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.spawner.boto3.client")
+    def test_fargate_states_describes_tasks_in_one_call(self, mock_boto3_client):
+        running = self._fargate_instance("arn:running")
+        stopped = self._fargate_instance("arn:stopped")
+        mock_boto3_client.return_value.describe_tasks.return_value = {
+            "tasks": [
+                {"taskArn": "arn:running", "lastStatus": "RUNNING"},
+                {"taskArn": "arn:stopped", "lastStatus": "STOPPED"},
+            ]
+        }
+
+        states = FargateSpawner.states([running, stopped])
+
+        assert states == {running.id: "RUNNING", stopped.id: "STOPPED"}
+        mock_boto3_client.return_value.describe_tasks.assert_called_once_with(
+            cluster="test-cluster", tasks=["arn:running", "arn:stopped"]
+        )
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.spawner.boto3.client")
+    def test_fargate_states_omits_instances_if_describe_fails(self, mock_boto3_client):
+        instance = self._fargate_instance("arn:running")
+        mock_boto3_client.return_value.describe_tasks.side_effect = Exception("Throttled")
+
+        assert not FargateSpawner.states([instance])
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils.publish_application_instance_change")
+    @mock.patch("dataworkspace.apps.applications.spawner.boto3.client")
+    def test_stores_states_and_publishes_stopped(self, mock_boto3_client, mock_publish):
+        running = self._fargate_instance("arn:running")
+        stopped = self._fargate_instance("arn:stopped", state="SPAWNING")
+        mock_boto3_client.return_value.describe_tasks.return_value = {
+            "tasks": [
+                {"taskArn": "arn:running", "lastStatus": "RUNNING"},
+                {"taskArn": "arn:stopped", "lastStatus": "STOPPED"},
+            ]
+        }
+
+        _do_reconcile_spawner_states()
+        _do_reconcile_spawner_states()
+
+        mock_publish.assert_called_once_with(stopped.public_host)
+
+        # The API then doesn't need to call AWS
+        mock_boto3_client.reset_mock()
+        assert api_application_dict(running)["state"] == "RUNNING"
+        assert api_application_dict(stopped)["state"] == "STOPPED"
+        assert api_application_dict(stopped)["spawner_state_checked_at"] is not None
+        assert not mock_boto3_client.return_value.describe_tasks.called
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.spawner.boto3.client")
+    def test_api_falls_back_to_spawner_if_not_reconciled(self, mock_boto3_client):
+        instance = self._fargate_instance("arn:running")
+        mock_boto3_client.return_value.describe_tasks.return_value = {
+            "tasks": [{"taskArn": "arn:running", "lastStatus": "RUNNING"}]
+        }
+
+        assert api_application_dict(instance)["state"] == "RUNNING"
+        assert api_application_dict(instance)["state"] == "RUNNING"
+        assert mock_boto3_client.return_value.describe_tasks.call_count == 1
+
+
+class TestApplicationApiIsAllowedCache:
+    def teardown_method(self):
+        cache.clear()
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_decision_is_cached_per_user_and_host(self, mock_is_allowed):
+        mock_is_allowed.return_value = True
+        user = UserFactory.create()
+        other_user = UserFactory.create()
+        request = mock.Mock(user=user)
+
+        assert application_api_is_allowed(request, "testvisualisation")
+        assert application_api_is_allowed(request, "testvisualisation")
+        assert mock_is_allowed.call_count == 1
+
+        assert application_api_is_allowed(request, "othervisualisation")
+        assert application_api_is_allowed(mock.Mock(user=other_user), "testvisualisation")
+        assert mock_is_allowed.call_count == 3
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_denial_is_cached(self, mock_is_allowed):
+        mock_is_allowed.return_value = False
+        request = mock.Mock(user=UserFactory.create())
+
+        assert not application_api_is_allowed(request, "testvisualisation")
+        assert not application_api_is_allowed(request, "testvisualisation")
+        assert mock_is_allowed.call_count == 1
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_raised_denial_is_not_cached(self, mock_is_allowed):
+        mock_is_allowed.side_effect = ToolPermissionDeniedError()
+        request = mock.Mock(user=UserFactory.create())
+
+        for _ in range(2):
+            with pytest.raises(ToolPermissionDeniedError):
+                application_api_is_allowed(request, "testvisualisation")
+        assert mock_is_allowed.call_count == 2
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_invalidate_makes_new_decision(self, mock_is_allowed):
+        mock_is_allowed.return_value = True
+        request = mock.Mock(user=UserFactory.create())
+
+        application_api_is_allowed(request, "testvisualisation")
+        invalidate_application_api_is_allowed_cache()
+        mock_is_allowed.return_value = False
+
+        assert not application_api_is_allowed(request, "testvisualisation")
+        assert mock_is_allowed.call_count == 2
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_visualisation_permission_change_invalidates_after_commit(self, mock_is_allowed):
+        mock_is_allowed.return_value = False
+        user = UserFactory.create()
+        request = mock.Mock(user=user)
+        visualisation = factories.VisualisationCatalogueItemFactory.create()
+        application_api_is_allowed(request, "testvisualisation")
+
+        mock_is_allowed.return_value = True
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            factories.VisualisationUserPermissionFactory.create(
+                user=user, visualisation=visualisation
+            )
+            assert not application_api_is_allowed(request, "testvisualisation")
+
+        assert application_api_is_allowed(request, "testvisualisation")
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_download_count_change_does_not_invalidate(self, mock_is_allowed):
+        mock_is_allowed.return_value = True
+        dataset = MasterDataSetFactory.create()
+        request = mock.Mock(user=UserFactory.create())
+        application_api_is_allowed(request, "testvisualisation")
+
+        with TestCase.captureOnCommitCallbacks(execute=True) as callbacks:
+            dataset.number_of_downloads = 1
+            dataset.save(update_fields=["number_of_downloads"])
+
+        assert not callbacks
+        application_api_is_allowed(request, "testvisualisation")
+        assert mock_is_allowed.call_count == 1
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_cached_decision_is_fetched_in_one_call(self, mock_is_allowed):
+        mock_is_allowed.return_value = True
+        request = mock.Mock(user=UserFactory.create())
+        application_api_is_allowed(request, "testvisualisation")
+
+        with mock.patch("dataworkspace.apps.applications.utils.cache", wraps=cache) as mock_cache:
+            assert application_api_is_allowed(request, "testvisualisation")
+        assert [method_call[0] for method_call in mock_cache.method_calls] == ["get_many"]
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_group_permission_change_invalidates(self, mock_is_allowed):
+        mock_is_allowed.return_value = False
+        user = UserFactory.create()
+        group = Group.objects.create(name="test-group")
+        user.groups.add(group)
+        request = mock.Mock(user=user)
+        application_api_is_allowed(request, "testvisualisation")
+
+        mock_is_allowed.return_value = True
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            group.permissions.add(
+                Permission.objects.get(
+                    codename="start_all_applications",
+                    content_type=ContentType.objects.get_for_model(ApplicationInstance),
+                )
+            )
+
+        assert application_api_is_allowed(request, "testvisualisation")
+
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.applications.utils._application_api_is_allowed")
+    def test_user_change_invalidates(self, mock_is_allowed):
+        mock_is_allowed.return_value = False
+        user = UserFactory.create()
+        request = mock.Mock(user=user)
+        application_api_is_allowed(request, "testvisualisation")
+
+        mock_is_allowed.return_value = True
+        with TestCase.captureOnCommitCallbacks(execute=True) as callbacks:
+            user.last_login = datetime.datetime.now()
+            user.save(update_fields=["last_login"])
+        assert not callbacks
+
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            user.is_superuser = True
+            user.save()
+
+        assert application_api_is_allowed(request, "testvisualisation")
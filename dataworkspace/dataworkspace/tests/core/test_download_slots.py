@@ -0,0 +1,113 @@
+import time
+from unittest import mock
+
+import gevent
+import pytest
+from django.http import StreamingHttpResponse
+from django.test import override_settings
+from django_redis import get_redis_connection
+
+from dataworkspace.apps.core.download_slots import (
+    DownloadSlotLost,
+    DownloadSlotsUnavailable,
+    acquire_download_slot,
+    download_slots_unavailable_response,
+    hold_download_slot,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_download_slots():
+    redis_client = get_redis_connection("default")
+    for key in redis_client.scan_iter("download_slots:*"):
+        redis_client.delete(key)
+
+
+@override_settings(DOWNLOAD_SLOTS_PER_USER=2, DOWNLOAD_SLOT_WAIT_SECONDS=0)
+def test_slots_per_user():
+    acquire_download_slot("test@example.com", "my_database")
+    acquire_download_slot("test@example.com", "my_database")
+
+    with pytest.raises(DownloadSlotsUnavailable):
+        acquire_download_slot("test@example.com", "my_database")
+
+    # Other users have their own slots
+    acquire_download_slot("other@example.com", "my_database")
+
+
+@override_settings(DOWNLOAD_SLOTS_PER_DATABASE=2, DOWNLOAD_SLOT_WAIT_SECONDS=0)
+def test_slots_per_database():
+    acquire_download_slot("test@example.com", "my_database")
+    acquire_download_slot(None, "my_database")
+
+    with pytest.raises(DownloadSlotsUnavailable):
+        acquire_download_slot("other@example.com", "my_database")
+
+    acquire_download_slot("other@example.com", "other_database")
+
+
+@override_settings(DOWNLOAD_SLOTS_PER_USER=1, DOWNLOAD_SLOT_WAIT_SECONDS=0)
+def test_released_slot_is_reused():
+    slot = acquire_download_slot("test@example.com", "my_database")
+    slot.release()
+    acquire_download_slot("test@example.com", "my_database")
+
+
+@override_settings(
+    DOWNLOAD_SLOTS_PER_USER=1, DOWNLOAD_SLOT_WAIT_SECONDS=0, DOWNLOAD_SLOT_LEASE_SECONDS=300
+)
+def test_expired_slot_is_reused():
+    acquire_download_slot("test@example.com", "my_database")
+    with mock.patch("dataworkspace.apps.core.download_slots.time.time") as mock_time:
+        mock_time.return_value = time.time() + 301
+        acquire_download_slot("test@example.com", "my_database")
+
+
+@override_settings(DOWNLOAD_SLOTS_PER_USER=1, DOWNLOAD_SLOT_WAIT_SECONDS=0)
+def test_slot_held_until_response_closed():
+    slot = acquire_download_slot("test@example.com", "my_database")
+    response = hold_download_slot(StreamingHttpResponse(iter([b"a", b"b"])), slot)
+    assert next(iter(response)) == b"a"
+
+    with pytest.raises(DownloadSlotsUnavailable):
+        acquire_download_slot("test@example.com", "my_database")
+
+    # As happens if the client disconnects part way through
+    response.close()
+    acquire_download_slot("test@example.com", "my_database")
+
+
+@override_settings(DOWNLOAD_SLOTS_PER_USER=1, DOWNLOAD_SLOT_LEASE_SECONDS=3)
+def test_slot_renewed_while_response_stalls():
+    redis_client = get_redis_connection("default")
+    slot = acquire_download_slot("test@example.com", "my_database")
+    key = "download_slots:user:test@example.com"
+    acquired = redis_client.zrange(key, 0, -1, withscores=True)[0][1]
+    hold_download_slot(StreamingHttpResponse(iter([b"a"])), slot)
+
+    # No chunks are streamed, as if the query or the client is slow
+    gevent.sleep(1.5)
+
+    assert redis_client.zrange(key, 0, -1, withscores=True)[0][1] > acquired
+    slot.release()
+
+
+def test_response_fails_if_slot_lost():
+    slot = acquire_download_slot("test@example.com", "my_database")
+    response = hold_download_slot(StreamingHttpResponse(iter([b"a", b"b"])), slot)
+    content = iter(response)
+    assert next(content) == b"a"
+
+    # As if the lease expired
+    get_redis_connection("default").delete("download_slots:user:test@example.com")
+    slot.renew()
+
+    with pytest.raises(DownloadSlotLost):
+        next(content)
+
+
+@override_settings(DOWNLOAD_SLOT_RETRY_AFTER_SECONDS=60)
+def test_download_slots_unavailable_response():
+    response = download_slots_unavailable_response(DownloadSlotsUnavailable(60))
+    assert response.status_code == 429
+    assert response["Retry-After"] == "60"
@@ -0,0 +1,144 @@
+import datetime
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from dataworkspace.apps.core.export_cache import (
+    CachedExportRangeNotSatisfiable,
+    delete_stale_exports,
+    get_cached_export,
+    get_export_cache_key,
+    tee_to_export_cache,
+)
+
+
+KEY = "export-cache/my_database/public/my_table/20210102T030405000006Z.csv"
+
+
+@pytest.fixture
+def s3_client():
+    with mock.patch("dataworkspace.apps.core.export_cache.get_s3_client") as get_s3_client:
+        client = get_s3_client.return_value
+        client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+        client.upload_part.side_effect = lambda PartNumber, **_: {"ETag": f"etag-{PartNumber}"}
+        client.get_paginator.return_value.paginate.return_value = []
+        yield client
+
+
+def test_export_cache_key_is_versioned():
+    key = get_export_cache_key(
+        "my_database",
+        "public",
+        "my_table",
+        datetime.datetime(2021, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc),
+        "csv",
+    )
+    assert (
+        key
+        == f"{settings.EXPORT_CACHE_PREFIX}my_database/public/my_table/20210102T030405000006Z.csv"
+    )
+
+
+def test_export_cache_key_includes_copy_for_csv():
+    data_version = datetime.datetime(2021, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc)
+    assert get_export_cache_key(
+        "my_database", "public", "my_table", data_version, "csv", use_copy=True
+    ).endswith("/my_table/20210102T030405000006Z.copy.csv")
+    assert get_export_cache_key(
+        "my_database", "public", "my_table", data_version, "parquet", use_copy=True
+    ).endswith("/my_table/20210102T030405000006Z.parquet")
+
+
+def test_get_cached_export_not_cached(s3_client):
+    s3_client.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    assert get_cached_export("export-cache/my_database/public/my_table/1.csv") is None
+
+
+def test_get_cached_export_range_not_satisfiable(s3_client):
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "InvalidRange", "ActualObjectSize": "100"}}, "GetObject"
+    )
+    with pytest.raises(CachedExportRangeNotSatisfiable) as ex:
+        get_cached_export(KEY, "bytes=100-")
+    assert ex.value.size == 100
+
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "InvalidRange"}}, "GetObject"
+    )
+    s3_client.head_object.return_value = {"ContentLength": 200}
+    with pytest.raises(CachedExportRangeNotSatisfiable) as ex:
+        get_cached_export(KEY, "bytes=200-")
+    assert ex.value.size == 200
+
+
+def test_tee_to_export_cache_uploads_complete_export(s3_client):
+    chunks = [b"a,b\n", b"1,2\n"]
+    assert list(tee_to_export_cache(iter(chunks), KEY, "text/csv")) == chunks
+
+    s3_client.upload_part.assert_called_once_with(
+        Bucket=settings.AWS_UPLOADS_BUCKET,
+        Key=KEY,
+        UploadId="upload-id",
+        PartNumber=1,
+        Body=b"a,b\n1,2\n",
+    )
+    s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket=settings.AWS_UPLOADS_BUCKET,
+        Key=KEY,
+        UploadId="upload-id",
+        MultipartUpload={"Parts": [{"ETag": "etag-1", "PartNumber": 1}]},
+    )
+    s3_client.abort_multipart_upload.assert_not_called()
+
+
+def test_tee_to_export_cache_aborts_abandoned_export(s3_client):
+    teed = tee_to_export_cache(iter([b"a,b\n", b"1,2\n"]), KEY, "text/csv")
+    assert next(teed) == b"a,b\n"
+    teed.close()
+
+    s3_client.complete_multipart_upload.assert_not_called()
+    s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket=settings.AWS_UPLOADS_BUCKET, Key=KEY, UploadId="upload-id"
+    )
+
+
+def test_tee_to_export_cache_aborts_failed_export(s3_client):
+    def chunks():
+        yield b"a,b\n"
+        raise Exception("Query failed")
+
+    with pytest.raises(Exception, match="Query failed"):
+        list(tee_to_export_cache(chunks(), KEY, "text/csv"))
+
+    s3_client.complete_multipart_upload.assert_not_called()
+    s3_client.abort_multipart_upload.assert_called_once()
+
+
+def test_tee_to_export_cache_streams_if_upload_fails(s3_client):
+    s3_client.create_multipart_upload.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "CreateMultipartUpload"
+    )
+    chunks = [b"a,b\n", b"1,2\n"]
+    assert list(tee_to_export_cache(iter(chunks), KEY, "text/csv")) == chunks
+    s3_client.upload_part.assert_not_called()
+
+
+def test_delete_stale_exports(s3_client):
+    s3_client.get_paginator.return_value.paginate.return_value = [
+        {
+            "Contents": [
+                {"Key": "export-cache/db/public/table/20210101T000000000000Z.csv"},
+                {"Key": "export-cache/db/public/table/20210102T000000000000Z.csv"},
+                {"Key": "export-cache/db/public/table/20210102T000000000000Z.parquet"},
+                {"Key": "export-cache/db/public/table/20210102T000000000000Z.copy.csv"},
+                {"Key": "export-cache/db/public/table/20210103T000000000000Z.csv"},
+            ]
+        }
+    ]
+    delete_stale_exports("export-cache/db/public/table/20210102T000000000000Z.csv")
+    s3_client.delete_objects.assert_called_once_with(
+        Bucket=settings.AWS_UPLOADS_BUCKET,
+        Delete={"Objects": [{"Key": "export-cache/db/public/table/20210101T000000000000Z.csv"}]},
+    )
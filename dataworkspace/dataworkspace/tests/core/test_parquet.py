@@ -0,0 +1,68 @@
+import datetime
+import io
+from collections import namedtuple
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dataworkspace.apps.core.parquet import ParquetStreamWriter, get_parquet_columns
+
+Column = namedtuple("Column", ["name", "type_code"])
+
+DESCRIPTION = [
+    Column("id", 23),
+    Column("amount", 1700),
+    Column("created", 1184),
+    Column("data", 3802),
+    Column("tags", 1009),
+    Column("location", 600),
+]
+
+
+def test_get_parquet_columns():
+    schema, _ = get_parquet_columns(DESCRIPTION)
+    assert schema == pa.schema(
+        [
+            ("id", pa.int32()),
+            ("amount", pa.float64()),
+            ("created", pa.timestamp("us", tz="UTC")),
+            ("data", pa.string()),
+            ("tags", pa.list_(pa.string())),
+            # Types without a Parquet equivalent are written as strings
+            ("location", pa.string()),
+        ]
+    )
+
+
+def test_parquet_stream_writer_writes_row_groups():
+    writer = ParquetStreamWriter(DESCRIPTION)
+    created = datetime.datetime(2021, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    row = (1, Decimal("1.5"), created, {"a": 1}, ["x", "y"], "(1,2)")
+    null_row = (2, None, None, None, None, None)
+
+    chunks = [
+        writer.write_rows([row, null_row]),
+        writer.write_rows([row]),
+        writer.close(),
+    ]
+
+    # Each row group is returned as soon as it's written, rather than when the file is closed
+    assert all(chunks)
+    parquet_file = pq.ParquetFile(io.BytesIO(b"".join(chunks)))
+    assert parquet_file.num_row_groups == 2
+    assert parquet_file.read().to_pydict() == {
+        "id": [1, 2, 1],
+        "amount": [1.5, None, 1.5],
+        "created": [created, None, created],
+        "data": ['{"a": 1}', None, '{"a": 1}'],
+        "tags": [["x", "y"], None, ["x", "y"]],
+        "location": ["(1,2)", None, "(1,2)"],
+    }
+
+
+def test_parquet_stream_writer_without_rows():
+    writer = ParquetStreamWriter(DESCRIPTION)
+    table = pq.read_table(io.BytesIO(writer.close()))
+    assert table.num_rows == 0
+    assert table.column_names == ["id", "amount", "created", "data", "tags", "location"]
@@ -1,6 +1,8 @@
 import datetime
+import json
 import re
 import time
+from base64 import urlsafe_b64encode
 
 import mock
 import psycopg2
@@ -13,6 +15,7 @@ from freezegun import freeze_time
 from dataworkspace.apps.applications.utils import delete_unused_datasets_users
 from dataworkspace.apps.core.models import DatabaseUser
 from dataworkspace.apps.core.utils import (
+    DOWNLOAD_SEGMENT_FIRST,
     database_dsn,
     db_role_schema_suffix_for_user,
     get_random_data_sample,
@@ -22,6 +25,7 @@ from dataworkspace.apps.core.utils import (
     new_private_database_credentials,
     postgres_user,
     source_tables_for_user,
+    table_data_segment,
 )
 from dataworkspace.apps.datasets.constants import UserAccessType
 from dataworkspace.apps.datasets.management.commands.ensure_databases_configured import (
@@ -70,6 +74,95 @@ class TestGetRandomSample:
         assert len(sample) == 4
 
 
+class TestTableDataSegment:
+    @pytest.fixture
+    def test_db(self, db):
+        database = factories.DatabaseFactory(memorable_name="my_database")
+        with psycopg2.connect(database_dsn(settings.DATABASES_DATA["my_database"])) as conn:
+            conn.cursor().execute(
+                """
+            CREATE TABLE IF NOT EXISTS test_segments (id int PRIMARY KEY, name text);
+            TRUNCATE test_segments;
+            INSERT INTO test_segments VALUES (5, 'e'), (1, 'a'), (3, 'c'), (2, 'b'), (4, 'd');
+            CREATE TABLE IF NOT EXISTS test_segments_no_pk (id int);
+            """
+            )
+            yield database.memorable_name
+            conn.cursor().execute("DROP TABLE test_segments; DROP TABLE test_segments_no_pk;")
+
+    @override_settings(DOWNLOAD_SEGMENT_ROWS=2)
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    def test_download_in_segments(self, mock_data_version, test_db):
+        mock_data_version.return_value = datetime.datetime(2021, 1, 1)
+        segment = DOWNLOAD_SEGMENT_FIRST
+        segments = []
+        while segment:
+            response = table_data_segment(
+                "test@example.com", test_db, "public", "test_segments", segment
+            )
+            assert response.status_code == 200
+            segments.append(b"".join(response.streaming_content))
+            next_link = re.match(
+                r"^<\?segment=([^&]+)&format=csv>; rel=\"next\"$", response.get("Link", "")
+            )
+            segment = next_link.group(1) if next_link else None
+
+        assert segments == [
+            b'"id","name"\r\n1,"a"\r\n2,"b"\r\n"Number of rows: 2"\r\n',
+            b'"id","name"\r\n3,"c"\r\n4,"d"\r\n"Number of rows: 2"\r\n',
+            b'"id","name"\r\n5,"e"\r\n"Number of rows: 1"\r\n',
+        ]
+
+    @override_settings(DOWNLOAD_SEGMENT_ROWS=2)
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    def test_segment_of_changed_data_is_rejected(self, mock_data_version, test_db):
+        mock_data_version.return_value = datetime.datetime(2021, 1, 1)
+        response = table_data_segment(
+            "test@example.com", test_db, "public", "test_segments", DOWNLOAD_SEGMENT_FIRST
+        )
+        b"".join(response.streaming_content)
+        next_segment = re.match(r"^<\?segment=([^&]+)&", response["Link"]).group(1)
+
+        mock_data_version.return_value = datetime.datetime(2021, 1, 2)
+        response = table_data_segment(
+            "test@example.com", test_db, "public", "test_segments", next_segment
+        )
+        assert response.status_code == 409
+
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    def test_invalid_segments_are_rejected(self, mock_data_version, test_db):
+        mock_data_version.return_value = None
+        response = table_data_segment(
+            "test@example.com", test_db, "public", "test_segments", "not-a-segment"
+        )
+        assert response.status_code == 400
+
+        response = table_data_segment(
+            "test@example.com", test_db, "public", "test_segments_no_pk", DOWNLOAD_SEGMENT_FIRST
+        )
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize(
+        "token",
+        (
+            {"index": "1", "after": ["2"], "version": None},
+            {"index": -1, "after": ["2"], "version": None},
+            {"index": 1, "after": "2", "version": None},
+            {"index": 1, "after": None, "version": None},
+            {"index": 1, "after": ["2", "3"], "version": None},
+            {"index": 1, "after": [2], "version": None},
+        ),
+    )
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    def test_malformed_segments_are_rejected(self, mock_data_version, token, test_db):
+        mock_data_version.return_value = None
+        segment = urlsafe_b64encode(json.dumps(token).encode("utf-8")).decode("ascii")
+        response = table_data_segment(
+            "test@example.com", test_db, "public", "test_segments", segment
+        )
+        assert response.status_code == 400
+
+
 class TestPostgresUser:
     def test_very_long_suffix_raises_value_error(self):
         with pytest.raises(ValueError):
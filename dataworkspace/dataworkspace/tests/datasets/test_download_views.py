@@ -1,13 +1,18 @@
+import datetime
 import io
 import uuid
 from unittest import mock
 
 import psycopg2
+import pyarrow.parquet as pq
 import pytest
+from botocore.exceptions import ClientError
 from botocore.response import StreamingBody
 from django.conf import settings
 from django.test import override_settings
 from django.urls import reverse
+from psycogreen.gevent import patch_psycopg
+from waffle.testutils import override_switch
 
 from dataworkspace.apps.core.utils import database_dsn
 from dataworkspace.apps.datasets.constants import UserAccessType
@@ -297,6 +302,191 @@ class TestSourceViewDownloadView:
         assert EventLog.objects.latest().event_type == EventLog.TYPE_DATASET_SOURCE_VIEW_DOWNLOAD
         assert DataSet.objects.get(pk=dataset.id).number_of_downloads == download_count + 1
 
+    @override_switch(settings.COPY_CSV_DOWNLOADS_SWITCH, active=True)
+    @pytest.mark.django_db
+    def test_view_download_with_copy(self, client):
+        dsn = database_dsn(settings.DATABASES_DATA["my_database"])
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE if not exists download_test_table (field2 int,field1 varchar(255));
+                TRUNCATE TABLE download_test_table;
+                INSERT INTO download_test_table VALUES(1, 'record1');
+                INSERT INTO download_test_table VALUES(2, 'record, with a comma');
+                CREATE OR REPLACE VIEW download_test_view AS SELECT * FROM download_test_table;
+                """
+            )
+
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+        log_count = EventLog.objects.count()
+        response = client.get(source_view.get_absolute_url())
+        assert response.status_code == 200
+        assert (
+            b"".join(response.streaming_content)
+            == b'field2,field1\n1,record1\n2,"record, with a comma"\n"Number of rows: 2"\r\n'
+        )
+        assert EventLog.objects.count() == log_count + 1
+        assert EventLog.objects.latest().event_type == EventLog.TYPE_DATASET_SOURCE_VIEW_DOWNLOAD
+
+    @override_switch(settings.COPY_CSV_DOWNLOADS_SWITCH, active=True)
+    @pytest.mark.django_db
+    def test_view_download_with_copy_and_green_connections(self, client):
+        dsn = database_dsn(settings.DATABASES_DATA["my_database"])
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE if not exists download_test_table (field2 int,field1 varchar(255));
+                TRUNCATE TABLE download_test_table;
+                INSERT INTO download_test_table VALUES(1, 'record1');
+                CREATE OR REPLACE VIEW download_test_view AS SELECT * FROM download_test_table;
+                """
+            )
+
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+
+        # As in start.py, under which psycopg2 refuses copy_expert
+        patch_psycopg()
+        try:
+            response = client.get(source_view.get_absolute_url())
+            assert response.status_code == 200
+            assert (
+                b"".join(response.streaming_content)
+                == b'field2,field1\n1,record1\n"Number of rows: 1"\r\n'
+            )
+        finally:
+            psycopg2.extensions.set_wait_callback(None)
+
+    @pytest.mark.django_db
+    def test_view_download_as_parquet(self, client):
+        dsn = database_dsn(settings.DATABASES_DATA["my_database"])
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE if not exists download_test_table (field2 int,field1 varchar(255));
+                TRUNCATE TABLE download_test_table;
+                INSERT INTO download_test_table VALUES(1, 'record1');
+                INSERT INTO download_test_table VALUES(2, 'record, with a comma');
+                CREATE OR REPLACE VIEW download_test_view AS SELECT * FROM download_test_table;
+                """
+            )
+
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+        response = client.get(source_view.get_absolute_url() + "?format=parquet")
+        assert response.status_code == 200
+        assert response["Content-Type"] == "application/vnd.apache.parquet"
+        assert response["Content-Disposition"].endswith('.parquet"')
+        table = pq.read_table(io.BytesIO(b"".join(response.streaming_content)))
+        assert table.to_pydict() == {
+            "field2": [1, 2],
+            "field1": ["record1", "record, with a comma"],
+        }
+
+    @override_switch(settings.EXPORT_CACHE_SWITCH, active=True)
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    @mock.patch("dataworkspace.apps.core.boto3_client.boto3.client")
+    def test_view_download_from_export_cache(self, mock_client, mock_data_version, client):
+        dsn = database_dsn(settings.DATABASES_DATA["my_database"])
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE if not exists download_test_table (field2 int,field1 varchar(255));
+                CREATE OR REPLACE VIEW download_test_view AS SELECT * FROM download_test_table;
+                """
+            )
+        mock_data_version.return_value = datetime.datetime(
+            2021, 1, 2, tzinfo=datetime.timezone.utc
+        )
+        cached = b'"field2","field1"\r\n1,"cached"\r\n"Number of rows: 1"\r\n'
+        mock_client().get_object.return_value = {
+            "ContentType": "text/csv",
+            "ContentLength": len(cached),
+            "Body": StreamingBody(io.BytesIO(cached), len(cached)),
+        }
+
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+        response = client.get(source_view.get_absolute_url(), HTTP_ACCEPT_ENCODING="gzip")
+        assert response.status_code == 200
+        # Not gzipped, so browsers can resume interrupted downloads
+        assert not response.has_header("Content-Encoding")
+        assert response["Accept-Ranges"] == "bytes"
+        assert not response["ETag"].startswith("W/")
+        assert b"".join(response.streaming_content) == cached
+        mock_client().get_object.assert_called_with(
+            Bucket=settings.AWS_UPLOADS_BUCKET,
+            Key=f"{settings.EXPORT_CACHE_PREFIX}my_database/public/download_test_view/"
+            "20210102T000000000000Z.csv",
+        )
+
+    @override_switch(settings.EXPORT_CACHE_SWITCH, active=True)
+    @pytest.mark.django_db
+    @mock.patch("dataworkspace.apps.core.utils.get_earliest_tables_last_updated_date")
+    @mock.patch("dataworkspace.apps.core.boto3_client.boto3.client")
+    def test_view_download_from_export_cache_range_not_satisfiable(
+        self, mock_client, mock_data_version, client
+    ):
+        dsn = database_dsn(settings.DATABASES_DATA["my_database"])
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE if not exists download_test_table (field2 int,field1 varchar(255));
+                CREATE OR REPLACE VIEW download_test_view AS SELECT * FROM download_test_table;
+                """
+            )
+        mock_data_version.return_value = datetime.datetime(
+            2021, 1, 2, tzinfo=datetime.timezone.utc
+        )
+        mock_client().get_object.side_effect = ClientError(
+            {"Error": {"Code": "InvalidRange", "ActualObjectSize": "50"}}, "GetObject"
+        )
+
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+        response = client.get(source_view.get_absolute_url(), HTTP_RANGE="bytes=50-")
+        assert response.status_code == 416
+        assert response["Content-Range"] == "bytes */50"
+
+    @pytest.mark.django_db
+    def test_view_download_unknown_format(self, client):
+        dataset = factories.DataSetFactory(user_access_type=UserAccessType.OPEN)
+        source_view = factories.SourceViewFactory(
+            dataset=dataset,
+            database=factories.DatabaseFactory(memorable_name="my_database"),
+            schema="public",
+            view="download_test_view",
+        )
+        response = client.get(source_view.get_absolute_url() + "?format=xlsx")
+        assert response.status_code == 400
+
     @pytest.mark.parametrize(
         "request_client,published",
         [("client", True), ("staff_client", True), ("staff_client", False)],
@@ -451,6 +641,42 @@ class TestCustomQueryDownloadView:
         assert EventLog.objects.latest().event_type == EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD
         assert DataSet.objects.get(pk=query.dataset.id).number_of_downloads == download_count + 1
 
+    @override_switch(settings.COPY_CSV_DOWNLOADS_SWITCH, active=True)
+    @pytest.mark.django_db
+    def test_valid_sql_with_copy(self, client):
+        query = self._create_query("SELECT * FROM custom_query_test WHERE id IN (1, 3);")
+        log_count = EventLog.objects.count()
+        response = client.get(query.get_absolute_url())
+        assert response.status_code == 200
+        assert b"".join(response.streaming_content) == (
+            b"id,name,date\n1,the first record,\n" b'3,the last record,\n"Number of rows: 2"\r\n'
+        )
+        assert EventLog.objects.count() == log_count + 1
+        assert EventLog.objects.latest().event_type == EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD
+
+    @pytest.mark.django_db
+    def test_valid_sql_as_parquet(self, client):
+        query = self._create_query("SELECT * FROM custom_query_test WHERE id IN (1, 3);")
+        response = client.get(query.get_absolute_url() + "?format=parquet")
+        assert response.status_code == 200
+        assert response["Content-Disposition"].endswith('.parquet"')
+        table = pq.read_table(io.BytesIO(b"".join(response.streaming_content)))
+        assert table.to_pydict() == {
+            "id": [1, 3],
+            "name": ["the first record", "the last record"],
+            "date": [None, None],
+        }
+
+    @override_switch(settings.COPY_CSV_DOWNLOADS_SWITCH, active=True)
+    def test_dangerous_sql_with_copy(self, client):
+        query = self._create_query("DELETE FROM custom_query_test RETURNING *;")
+        with pytest.raises(Exception):
+            list(client.get(query.get_absolute_url()).streaming_content)
+
+        with psycopg2.connect(self._get_dsn()) as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM custom_query_test")
+            assert cursor.fetchone()[0] == 3
+
     @pytest.mark.parametrize(
         "request_client,published",
         [("client", True), ("staff_client", True), ("staff_client", False)],
@@ -486,6 +712,11 @@ class TestCustomQueryDownloadView:
         latest_events = EventLog.objects.all().order_by("-id")[:2]
 
         assert latest_events[0].event_type == EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD_COMPLETE
+        assert latest_events[0].extra["row_count_filtered"] == 2
+        assert latest_events[0].extra["column_count_filtered"] == 2
+        assert latest_events[0].extra["column_count"] == 3
+        # There is no row count for the query in dataflow.metadata, and it isn't counted
+        assert latest_events[0].extra["row_count"] is None
 
         assert latest_events[1].event_type == EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD
 
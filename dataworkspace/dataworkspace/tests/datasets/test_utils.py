@@ -24,8 +24,10 @@ from dataworkspace.apps.datasets.utils import (
     process_quicksight_dashboard_visualisations,
     send_notification_emails,
     store_custom_dataset_query_metadata,
+    store_download_row_count,
     store_reference_dataset_metadata,
 )
+from dataworkspace.apps.eventlog.models import EventLog
 from dataworkspace.datasets_db import get_custom_dataset_query_changelog
 from dataworkspace.tests.factories import (
     CustomDatasetQueryFactory,
@@ -33,6 +35,7 @@ from dataworkspace.tests.factories import (
     ReferenceDatasetFactory,
     ReferenceDatasetFieldFactory,
     SourceTableFactory,
+    UserFactory,
     VisualisationLinkFactory,
 )
 
@@ -981,6 +984,66 @@ class TestStoreCustomDatasetQueryMetadata:
         )
 
 
+class TestStoreDownloadRowCount:
+    def _create_event(self, source):
+        return EventLog.objects.create(
+            user=UserFactory(),
+            event_type=EventLog.TYPE_DATASET_CUSTOM_QUERY_DOWNLOAD_COMPLETE,
+            related_object=source.dataset,
+            extra={"model": source._meta.label_lower, "pk": str(source.pk)},
+        )
+
+    @pytest.mark.django_db
+    @patch("dataworkspace.apps.datasets.utils.get_estimated_row_count")
+    @patch("dataworkspace.apps.datasets.models.get_latest_row_count_for_table")
+    def test_row_count_from_metadata(
+        self, mock_get_latest_row_count_for_table, mock_get_estimated_row_count
+    ):
+        mock_get_latest_row_count_for_table.return_value = 100
+        event = self._create_event(SourceTableFactory())
+
+        store_download_row_count(event.id)
+
+        event.refresh_from_db()
+        assert event.extra["row_count"] == 100
+        assert event.extra["row_count_source"] == "metadata"
+        assert not mock_get_estimated_row_count.called
+
+    @pytest.mark.django_db
+    @patch("dataworkspace.apps.datasets.utils.get_estimated_row_count")
+    @patch("dataworkspace.apps.datasets.models.get_latest_row_count_for_table")
+    def test_row_count_falls_back_to_estimate_for_tables(
+        self, mock_get_latest_row_count_for_table, mock_get_estimated_row_count
+    ):
+        mock_get_latest_row_count_for_table.return_value = None
+        mock_get_estimated_row_count.return_value = 98
+        source_table = SourceTableFactory()
+        event = self._create_event(source_table)
+
+        store_download_row_count(event.id)
+
+        event.refresh_from_db()
+        assert event.extra["row_count"] == 98
+        assert event.extra["row_count_source"] == "estimate"
+        mock_get_estimated_row_count.assert_called_once_with(
+            source_table.database.memorable_name, source_table.schema, source_table.table
+        )
+
+    @pytest.mark.django_db
+    @patch("dataworkspace.apps.datasets.models.get_latest_row_count_for_query")
+    def test_row_count_unknown_for_query_without_metadata(
+        self, mock_get_latest_row_count_for_query
+    ):
+        mock_get_latest_row_count_for_query.return_value = None
+        event = self._create_event(CustomDatasetQueryFactory())
+
+        store_download_row_count(event.id)
+
+        event.refresh_from_db()
+        assert event.extra["row_count"] is None
+        assert event.extra["row_count_source"] is None
+
+
 class TestSendNotificationEmails:
     @pytest.mark.django_db
     @override_settings(
@@ -0,0 +1,70 @@
+import gzip
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, override_settings
+
+from dataworkspace.middleware import compress_streamed_downloads, disable_client_side_caching
+
+CSV_CHUNKS = [b'"a","b"\r\n'] + [b'1,"two"\r\n' * 10000 for _ in range(5)]
+
+
+def _get(view, **headers):
+    middleware = compress_streamed_downloads(disable_client_side_caching(view))
+    return middleware(RequestFactory().get("/", **headers))
+
+
+def _streaming_view(compressible):
+    def view(_):
+        response = StreamingHttpResponse(iter(CSV_CHUNKS), content_type="text/csv")
+        response["Content-Length"] = str(sum(len(chunk) for chunk in CSV_CHUNKS))
+        response.compressible = compressible
+        return response
+
+    return view
+
+
+@override_settings(STREAMING_DOWNLOAD_GZIP_LEVEL=1)
+def test_compressible_streaming_response_is_gzipped():
+    response = _get(_streaming_view(True), HTTP_ACCEPT_ENCODING="gzip, deflate, br")
+
+    body = b"".join(response.streaming_content)
+    assert gzip.decompress(body) == b"".join(CSV_CHUNKS)
+    assert len(body) < sum(len(chunk) for chunk in CSV_CHUNKS) / 10
+    assert response["Content-Encoding"] == "gzip"
+    assert response["Vary"] == "Accept-Encoding"
+    assert not response.has_header("Content-Length")
+    assert "no-store" in response["Cache-Control"]
+
+
+def test_compressible_streaming_response_is_not_gzipped_if_not_accepted():
+    response = _get(_streaming_view(True))
+
+    assert b"".join(response.streaming_content) == b"".join(CSV_CHUNKS)
+    assert not response.has_header("Content-Encoding")
+    assert response["Vary"] == "Accept-Encoding"
+    assert response.has_header("Content-Length")
+
+
+def test_other_responses_are_not_gzipped():
+    response = _get(_streaming_view(False), HTTP_ACCEPT_ENCODING="gzip")
+    assert b"".join(response.streaming_content) == b"".join(CSV_CHUNKS)
+    assert not response.has_header("Content-Encoding")
+
+    response = _get(lambda _: HttpResponse(b"<html></html>"), HTTP_ACCEPT_ENCODING="gzip")
+    assert response.content == b"<html></html>"
+    assert not response.has_header("Content-Encoding")
+    assert "no-store" in response["Cache-Control"]
+
+
+def test_gzipped_streaming_response_does_not_accept_ranges():
+    def view(request):
+        response = _streaming_view(True)(request)
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = '"abc"'
+        return response
+
+    response = _get(view, HTTP_ACCEPT_ENCODING="gzip")
+
+    assert response["Content-Encoding"] == "gzip"
+    assert not response.has_header("Accept-Ranges")
+    assert response["ETag"] == 'W/"abc"'
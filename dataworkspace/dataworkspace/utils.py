@@ -2,6 +2,10 @@ import itertools
 
 from ecs_logging import StdlibFormatter
 
+# Published to by the admin application with the public host of an application instance
+# whenever it changes, so the proxy can invalidate its cache of the application's state
+APPLICATION_INSTANCE_CHANGED_CHANNEL = "data_workspace_application_instance_changed"
+
 
 def normalise_environment(key_values):
     """Converts denormalised dict of (string -> string) pairs, where the first string
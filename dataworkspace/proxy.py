@@ -1,16 +1,19 @@
 import asyncio
 import base64
+import collections
 import hmac
-import ipaddress
 import json
 import logging
 import os
 import random
 import secrets
+import signal
 import string
 import sys
+import time
 import urllib
 import uuid
+import weakref
 
 import aiohttp
 import ecs_logging
@@ -19,13 +22,29 @@ from aiohttp import web
 from elasticapm.contrib.aiohttp import ElasticAPM
 from hawkserver import authenticate_hawk_header
 from multidict import CIMultiDict
+from proxy_cache import InProcessCache
+from proxy_logging import start_queue_logging
+from proxy_metrics import (
+    REDIS_DURATION,
+    REQUEST_DURATION,
+    RESPONSE_BYTES,
+    SSO_PROFILE_FETCHES,
+    UPSTREAM_POOL_LIMIT,
+    WEBSOCKETS_OPEN,
+    handle_metrics,
+    register_counts,
+    upstream_trace_config,
+)
+from proxy_mirror_cache import MirrorCache
+from proxy_networks import NetworkLookup
 from proxy_session import SESSION_KEY, redis_session_middleware
+from proxy_upstreams import UpstreamClientSessions
 from sentry import init_sentry
 from sentry_sdk import set_user
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from yarl import URL
 
-from dataworkspace.utils import normalise_environment
+from dataworkspace.utils import APPLICATION_INSTANCE_CHANGED_CHANNEL, normalise_environment
 
 
 class UserException(Exception):
@@ -41,7 +60,14 @@ PROFILE_CACHE_PREFIX = "data_workspace_profile"
 CONTEXT_ALPHABET = string.ascii_letters + string.digits
 
 
-async def async_main():
+class SpawningProbe:
+    def __init__(self):
+        self.task = None
+        self.ready = False
+        self.last_requested = None
+
+
+async def async_main(reuse_port=False, worker_index=0):
     env = normalise_environment(os.environ)
 
     stdout_handler = logging.StreamHandler(sys.stdout)
@@ -51,10 +77,22 @@ async def async_main():
             ecs_logging.StdlibFormatter(exclude_fields=("log.original", "message"))
         )
     cookie_name = ("__Secure-" if not local else "") + "data_workspace_session"
-    for logger_name in ["aiohttp.server", "aiohttp.web", "aiohttp.access", "proxy"]:
-        logger = logging.getLogger(logger_name)
+    # Records are formatted and written to stdout from another thread, so logging doesn't add
+    # to the latency of requests
+    loggers = [
+        logging.getLogger(logger_name)
+        for logger_name in ["aiohttp.server", "aiohttp.web", "aiohttp.access", "proxy"]
+    ]
+    for logger in loggers:
         logger.setLevel(logging.INFO)
-        logger.addHandler(stdout_handler)
+    log_queue_handler, log_listener = start_queue_logging(
+        loggers, stdout_handler, int(env.get("LOG_QUEUE_MAX_SIZE", "10000"))
+    )
+    logger = logging.getLogger("proxy")
+
+    # Static assets can be most of the requests made through the proxy, so only a proportion of
+    # successful requests for them are logged
+    log_static_assets_sample_rate = float(env.get("LOG_STATIC_ASSETS_SAMPLE_RATE", "1"))
 
     port = int(env["PROXY_PORT"])
     admin_root = env["UPSTREAM_ROOT"]
@@ -74,9 +112,32 @@ async def async_main():
     ip_allowlist = [
         ip_address for ip_addresses in ip_allowlist_groups.values() for ip_address in ip_addresses
     ] + env.get("APPLICATION_IP_WHITELIST", [])
+    ip_allowlist_lookup = NetworkLookup(
+        (address_or_subnet, True) for address_or_subnet in ip_allowlist
+    )
+    ip_allowlist_group_lookup = NetworkLookup(
+        (address_or_subnet, group)
+        for group, ip_addresses in ip_allowlist_groups.items()
+        for address_or_subnet in ip_addresses
+    )
     ga_tracking_id = env.get("GA_TRACKING_ID")
     mirror_remote_root = env["MIRROR_REMOTE_ROOT"]
     mirror_local_root = "/__mirror/"
+    static_asset_path_prefixes = ("/__django_static/", "/static/")
+    static_asset_extensions = (
+        ".css",
+        ".js",
+        ".map",
+        ".png",
+        ".jpg",
+        ".jpeg",
+        ".gif",
+        ".svg",
+        ".ico",
+        ".woff",
+        ".woff2",
+        ".ttf",
+    )
     required_admin_headers = (
         "cookie",
         "host",
@@ -89,6 +150,39 @@ async def async_main():
     )
     mlflow_port = int(env["MLFLOW_PORT"])
 
+    # The state of spawning and running applications is cached, and the cache is invalidated
+    # when the proxy changes the application, or when notified of a change via Redis. The max
+    # age is a fallback for when the spawner's state changes without the admin application
+    # noticing, e.g. if an application dies
+    application_state_cache_max_age = int(env.get("APPLICATION_STATE_CACHE_MAX_AGE", "60"))
+    application_state_cache = InProcessCache(max_size=10000)
+
+    # Credentials for Superset and JWTs for MLflow are valid for hours, but are cached for
+    # much less so that changes to a user's access are picked up soon after they are made
+    credentials_cache_max_age = int(env.get("CREDENTIALS_CACHE_MAX_AGE", "60"))
+    credentials_cache = InProcessCache(max_size=10000)
+
+    in_process_caches = {
+        "application_state": application_state_cache,
+        "credentials": credentials_cache,
+    }
+    register_counts(
+        "proxy_in_process_cache_requests",
+        "Requests for values from in-process caches, by whether they were fresh, stale or missing",
+        ["cache", "result"],
+        lambda: {
+            (name, result): count
+            for name, cache in in_process_caches.items()
+            for result, count in cache.counts.items()
+        },
+    )
+    register_counts(
+        "proxy_log_records",
+        "Log records, by whether they were queued to be written or dropped",
+        ["outcome", "level"],
+        lambda: log_queue_handler.counts,
+    )
+
     # Cookies on the embed path must be allowed to be SameSite=None, so they
     # will be sent when the site is embedded in an iframe
     embed_path = "/visualisations/link"
@@ -165,6 +259,12 @@ async def async_main():
     # we fail quickly and often so a connection check is quick
     spawning_http_timeout = aiohttp.ClientTimeout(sock_read=5, sock_connect=2)
 
+    # Spawning applications are probed in the background while requests are made to them, and
+    # once found to be running, are set as RUNNING in the admin application
+    spawning_probe_interval = float(env.get("SPAWNING_PROBE_INTERVAL", "1"))
+    spawning_probe_max_idle = float(env.get("SPAWNING_PROBE_MAX_IDLE", "60"))
+    spawning_probes = {}
+
     def get_random_context_logger():
         return ContextAdapter(logger, {"context": "".join(random.choices(CONTEXT_ALPHABET, k=8))})
 
@@ -235,7 +335,7 @@ async def async_main():
         credentials = {}
         dashboards = []
 
-        if not path.startswith("/static/"):
+        async def fetch_credentials():
             host_api_url = admin_root + "/api/v1/core/get-superset-role-credentials"
 
             async with client_session.request(
@@ -245,12 +345,25 @@ async def async_main():
             ) as response:
                 if response.status == 200:
                     response_json = await response.json()
-                    credentials = response_json["credentials"]
-                    dashboards = response_json["dashboards"]
                 else:
                     raise UserException(
                         "Unable to fetch credentials for superset", response.status
                     )
+            credentials_and_dashboards = (
+                response_json["credentials"],
+                response_json["dashboards"],
+            )
+            return credentials_and_dashboards, credentials_cache_max_age
+
+        if not path.startswith("/static/"):
+            credentials, dashboards = await credentials_cache.get_or_fetch(
+                (
+                    "superset",
+                    downstream_request.headers["host"],
+                    get_sso_user_id(downstream_request),
+                ),
+                fetch_credentials,
+            )
 
         def standardise_header(header):
             # converts 'multi_word_header' to 'Multi-Word-Header'
@@ -267,19 +380,30 @@ async def async_main():
             + downstream_request["sso_profile_headers"]
         )
 
+    def jwt_expires_in(jwt):
+        payload = jwt.split(".")[1]
+        payload_json = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return payload_json["exp"] - time.time()
+
     async def mlflow_jwt(downstream_request):
-        host_api_url = admin_root + "/api/v1/core/generate-mlflow-jwt"
-        async with client_session.request(
-            "GET",
-            host_api_url,
-            headers=CIMultiDict(admin_headers_request(downstream_request)),
-        ) as response:
-            if response.status == 200:
-                response_json = await response.json()
-                jwt = response_json["jwt"]
-            else:
-                raise UserException("Unable to generate jwt for user", response.status)
-        return jwt
+        async def fetch_jwt():
+            host_api_url = admin_root + "/api/v1/core/generate-mlflow-jwt"
+            async with client_session.request(
+                "GET",
+                host_api_url,
+                headers=CIMultiDict(admin_headers_request(downstream_request)),
+            ) as response:
+                if response.status == 200:
+                    response_json = await response.json()
+                    jwt = response_json["jwt"]
+                else:
+                    raise UserException("Unable to generate jwt for user", response.status)
+            # Leaving time for the request to reach MLflow before the JWT expires
+            return jwt, min(credentials_cache_max_age, jwt_expires_in(jwt) - 60)
+
+        return await credentials_cache.get_or_fetch(
+            ("mlflow", get_sso_user_id(downstream_request)), fetch_jwt
+        )
 
     def is_service_discovery(request):
         return (
@@ -384,12 +508,11 @@ async def async_main():
         if peer_ip is None:
             return None
 
-        for group, ip_addresses in ip_allowlist_groups.items():
-            for address_or_subnet in ip_addresses:
-                if ipaddress.IPv4Address(peer_ip) in ipaddress.IPv4Network(address_or_subnet):
-                    return group
+        group = ip_allowlist_group_lookup.lookup(peer_ip)
+        return group if group is not None else peer_ip
 
-        return peer_ip
+    def get_sso_user_id(request):
+        return dict(request["sso_profile_headers"]).get("sso-profile-user-id")
 
     def request_scheme(request):
         return request.headers.get("x-forwarded-proto", request.url.scheme)
@@ -486,20 +609,33 @@ async def async_main():
         host_api_url = admin_root + "/api/v1/application/" + public_host
         host_html_path = "/tools/" + public_host
 
-        async with client_session.request(
-            "GET",
-            host_api_url,
-            headers=CIMultiDict(admin_headers_request(downstream_request)),
-        ) as response:
-            host_exists = response.status == 200
-            application = await response.json()
+        async def fetch_application():
+            async with client_session.request(
+                "GET",
+                host_api_url,
+                headers=CIMultiDict(admin_headers_request(downstream_request)),
+            ) as response:
+                status = response.status
+                application = await response.json()
+
+            # Only applications that are able to be proxied to are cached: any other response
+            # results in the proxy changing the application, or an error page
+            is_cacheable = status == 200 and application["state"] in ["SPAWNING", "RUNNING"]
+            return (status, application), (application_state_cache_max_age if is_cacheable else 0)
+
+        # The admin application decides if a user can access the application, so the state is
+        # cached per user, and not just per host
+        status, application = await application_state_cache.get_or_fetch(
+            (public_host, get_sso_user_id(downstream_request)), fetch_application
+        )
+        host_exists = status == 200
 
-        if response.status not in (200, 404):
+        if status not in (200, 404):
             raise UserException(
                 "Unable to start the application",
-                response.status,
+                status,
                 "/error_403_visualisation",
-                {"host": str(response.url).rsplit("/", maxsplit=1)[-1]},
+                {"host": public_host},
             )
 
         if host_exists and application["state"] not in ["SPAWNING", "RUNNING"]:
@@ -510,6 +646,7 @@ async def async_main():
                     headers=CIMultiDict(admin_headers_request(downstream_request)),
                 ) as delete_response:
                     await delete_response.read()
+                invalidate_application_state(public_host)
             raise UserException(
                 "Application " + application["state"],
                 500,
@@ -527,8 +664,10 @@ async def async_main():
                     host_api_url,
                     headers=CIMultiDict(admin_headers_request(downstream_request)),
                 ) as response:
-                    host_exists = response.status == 200
+                    status = response.status
+                    host_exists = status == 200
                     application = await response.json()
+                invalidate_application_state(public_host)
             else:
                 raise UserException(
                     "Application stopped while starting",
@@ -540,7 +679,7 @@ async def async_main():
                     },
                 )
 
-        if response.status != 200:
+        if status != 200:
             raise UserException(
                 "Unable to start the application",
                 500,
@@ -583,6 +722,7 @@ async def async_main():
             return await handle_application_http_spawning(
                 downstream_request,
                 method,
+                application["proxy_url"],
                 application_upstream(application["proxy_url"], path, port_override),
                 query,
                 host_html_path,
@@ -610,6 +750,27 @@ async def async_main():
             public_host,
         )
 
+    def invalidate_application_state(public_host):
+        application_state_cache.invalidate_matching(lambda key: key[0] == public_host)
+
+    async def listen_for_application_instance_changes():
+        # The admin application publishes the public host of each application instance that
+        # changes, which may be from a spawner, from another proxy, or from a user stopping it
+        while True:
+            try:
+                async with redis_pool.pubsub() as pubsub:
+                    await pubsub.subscribe(APPLICATION_INSTANCE_CHANGED_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "subscribe":
+                            # Changes could have been missed while not subscribed
+                            application_state_cache.clear()
+                        elif message["type"] == "message":
+                            invalidate_application_state(message["data"].decode("ascii"))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error listening for application instance changes")
+                application_state_cache.clear()
+                await asyncio.sleep(1)
+
     async def handle_application_websocket(
         downstream_request, proxy_url, path, query, port_override
     ):
@@ -630,35 +791,18 @@ async def async_main():
     async def handle_application_http_spawning(
         downstream_request,
         method,
+        proxy_url,
         upstream_url,
         query,
         host_html_path,
         host_api_url,
         public_host,
     ):
-        host = downstream_request.headers["host"]
-        try:
-            logger.info("Spawning: Attempting to connect to %s", upstream_url)
-            response = await handle_http(
-                downstream_request,
-                method,
-                CIMultiDict(application_headers(downstream_request)),
-                upstream_url,
-                query,
-                await get_data(downstream_request),
-                spawning_http_timeout,
-                # Although the application is spawning, if the response makes it back to the client,
-                # we know the application is running, so we return the _running_ CSP headers
-                (
-                    (
-                        "content-security-policy",
-                        csp_application_running_direct(host, public_host),
-                    ),
-                ),
-            )
-
-        except Exception:  # pylint: disable=broad-except
-            logger.info("Spawning: Failed to connect to %s", upstream_url)
+        # Whether the application is ready is found by a single background probe per
+        # application, rather than by each request attempting to connect to it, so the many
+        # requests a browser can make while the application is spawning respond immediately
+        probe = spawning_probe(downstream_request, proxy_url, host_api_url, public_host)
+        if not probe.ready:
             return await handle_http(
                 downstream_request,
                 "GET",
@@ -670,23 +814,81 @@ async def async_main():
                 (("content-security-policy", csp_application_spawning),),
             )
 
-        else:
-            # Once a streaming response is done, if we have not yet returned
-            # from the handler, it looks like aiohttp can cancel the current
-            # task. We set RUNNING in another task to avoid it being cancelled
-            async def set_application_running():
+        host = downstream_request.headers["host"]
+        return await handle_http(
+            downstream_request,
+            method,
+            CIMultiDict(application_headers(downstream_request)),
+            upstream_url,
+            query,
+            await get_data(downstream_request),
+            default_http_timeout,
+            # Although the application may not yet be RUNNING in the admin application, the
+            # probe has found that it is, so we return the _running_ CSP headers
+            (
+                (
+                    "content-security-policy",
+                    csp_application_running_direct(host, public_host),
+                ),
+            ),
+        )
+
+    def spawning_probe(downstream_request, proxy_url, host_api_url, public_host):
+        key = (public_host, proxy_url)
+        try:
+            probe = spawning_probes[key]
+        except KeyError:
+            probe = SpawningProbe()
+            spawning_probes[key] = probe
+            # The PATCH to the admin application is made with the headers of the request
+            # that started the probe, so it's made as the user of the application
+            admin_headers = CIMultiDict(admin_headers_request(downstream_request))
+            probe.task = asyncio.ensure_future(
+                probe_spawning_application(
+                    probe, proxy_url, host_api_url, public_host, admin_headers
+                )
+            )
+            probe.task.add_done_callback(lambda _: spawning_probes.pop(key, None))
+        probe.last_requested = time.monotonic()
+        return probe
+
+    async def probe_spawning_application(
+        probe, proxy_url, host_api_url, public_host, admin_headers
+    ):
+        # Any HTTP response from the application, even an error, means it's running
+        while not probe.ready:
+            if time.monotonic() - probe.last_requested > spawning_probe_max_idle:
+                logger.info("Spawning: No longer probing %s", proxy_url)
+                return
+            try:
                 async with client_session.request(
-                    "PATCH",
-                    host_api_url,
-                    json={"state": "RUNNING"},
-                    headers=CIMultiDict(admin_headers_request(downstream_request)),
-                    timeout=default_http_timeout,
-                ) as patch_response:
-                    await patch_response.read()
+                    "GET", proxy_url, allow_redirects=False, timeout=spawning_http_timeout
+                ) as response:
+                    await response.read()
+            except Exception:  # pylint: disable=broad-except
+                logger.debug("Spawning: Failed to connect to %s", proxy_url)
+                await asyncio.sleep(spawning_probe_interval)
+            else:
+                logger.info("Spawning: Connected to %s", proxy_url)
+                probe.ready = True
 
-            asyncio.ensure_future(set_application_running())
+        try:
+            async with client_session.request(
+                "PATCH",
+                host_api_url,
+                json={"state": "RUNNING"},
+                headers=admin_headers,
+                timeout=default_http_timeout,
+            ) as patch_response:
+                await patch_response.read()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Spawning: Unable to set %s as RUNNING", public_host)
+        finally:
+            invalidate_application_state(public_host)
 
-            return response
+        # Requests can still see the application as SPAWNING until they see the change made by
+        # the PATCH, and the probe is kept so they don't start another that would PATCH again
+        await asyncio.sleep(application_state_cache_max_age)
 
     async def handle_application_http_running_wrapped(
         downstream_request, upstream_url, host_html_path, public_host
@@ -735,14 +937,29 @@ async def async_main():
     async def handle_mirror(downstream_request, method, path):
         mirror_path = path[len(mirror_local_root) :]
         upstream_url = URL(mirror_remote_root + mirror_path)
-        return await handle_http(
+
+        async def handle_uncached():
+            return await handle_http(
+                downstream_request,
+                method,
+                CIMultiDict(mirror_headers(downstream_request)),
+                upstream_url,
+                {},
+                await get_data(downstream_request),
+                default_http_timeout,
+            )
+
+        if mirror_cache is None:
+            return await handle_uncached()
+
+        _, _, _, with_session_cookie = downstream_request[SESSION_KEY]
+        return await mirror_cache.handle(
             downstream_request,
-            method,
-            CIMultiDict(mirror_headers(downstream_request)),
+            mirror_path,
             upstream_url,
-            {},
-            await get_data(downstream_request),
-            default_http_timeout,
+            CIMultiDict(mirror_headers(downstream_request)),
+            with_session_cookie,
+            handle_uncached,
         )
 
     async def handle_superset(downstream_request, method, path, query):
@@ -807,6 +1024,14 @@ async def async_main():
             default_http_timeout,
         )
 
+    # So they can be closed on shutdown: otherwise they would hold up the shutdown until timeout
+    downstream_websockets = weakref.WeakSet()
+    WEBSOCKETS_OPEN.set_function(lambda: len(downstream_websockets))
+
+    async def close_downstream_websockets(_):
+        for downstream_ws in list(downstream_websockets):
+            await downstream_ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b"Shutdown")
+
     async def handle_websocket(downstream_request, upstream_headers, upstream_url):
         request_protocols = downstream_request.headers.get("Sec-WebSocket-Protocol")
         response_protocols = (
@@ -867,6 +1092,7 @@ async def async_main():
 
             await downstream_ws.prepare(downstream_request)
             downstream_connection.set_result(downstream_ws)
+            downstream_websockets.add(downstream_ws)
 
             async for msg in downstream_ws:
                 await proxy_msg(msg, upstream_ws)
@@ -876,6 +1102,23 @@ async def async_main():
 
         return downstream_ws
 
+    # Hits are queued and sent in batches by a single task, rather than each by its own task and
+    # request. If Google Analytics can't keep up the queue fills, and further hits are dropped
+    google_analytics_batch_url = "https://www.google-analytics.com/batch"
+    google_analytics_batch_max_hits = 20
+    google_analytics_batch_max_bytes = 16 * 1024
+    google_analytics_hit_max_bytes = 8 * 1024
+    google_analytics_queue = asyncio.Queue(
+        maxsize=int(env.get("GOOGLE_ANALYTICS_QUEUE_MAX_SIZE", "1000"))
+    )
+    google_analytics_counts = collections.Counter()
+    register_counts(
+        "proxy_google_analytics_hits",
+        "Hits for Google Analytics, by whether they were queued, sent, failed, or dropped",
+        ["outcome"],
+        lambda: google_analytics_counts,
+    )
+
     async def send_to_google_analytics(downstream_request):
         # Not perfect, but a good enough guide for usage
         _, extension = os.path.splitext(downstream_request.url.path)
@@ -894,30 +1137,85 @@ async def async_main():
         if not send_to_google:
             return
 
-        async def _send():
-            logger.info("Sending to Google Analytics %s...", downstream_request.url)
-            peer_ip = get_peer_ip(downstream_request)
-
-            response = await client_session.request(
-                "POST",
-                "https://www.google-analytics.com/collect",
-                data={
-                    "v": "1",
-                    "tid": ga_tracking_id,
-                    "cid": str(uuid.uuid4()),
-                    "t": "pageview",
-                    "uip": peer_ip,
-                    "dh": downstream_request.url.host,
-                    "dp": downstream_request.url.path_qs,
-                    "ds": "data-workspace-server",
-                    "dr": downstream_request.headers.get("referer", ""),
-                    "ua": downstream_request.headers.get("user-agent", ""),
-                },
-                timeout=default_http_timeout,
-            )
-            logger.info("Sending to Google Analytics %s... %s", downstream_request.url, response)
-
-        asyncio.create_task(_send())
+        hit = {
+            "v": "1",
+            "tid": ga_tracking_id,
+            "cid": str(uuid.uuid4()),
+            "t": "pageview",
+            "uip": get_peer_ip(downstream_request),
+            "dh": downstream_request.url.host,
+            "dp": downstream_request.url.path_qs,
+            "ds": "data-workspace-server",
+            "dr": downstream_request.headers.get("referer", ""),
+            "ua": downstream_request.headers.get("user-agent", ""),
+        }
+        try:
+            google_analytics_queue.put_nowait((time.monotonic(), hit))
+        except asyncio.QueueFull:
+            google_analytics_counts["dropped"] += 1
+            if google_analytics_counts["dropped"] % 100 == 1:
+                logger.warning(
+                    "Google Analytics queue full: %s hits dropped in total",
+                    google_analytics_counts["dropped"],
+                )
+        else:
+            google_analytics_counts["queued"] += 1
+
+    def encode_google_analytics_hit(queued_at, hit):
+        # The queue time parameter means hits are attributed to when they were made
+        queue_time = {"qt": int((time.monotonic() - queued_at) * 1000)}
+        return urllib.parse.urlencode({**hit, **queue_time}).encode("utf-8")
+
+    def is_google_analytics_hit_too_large(hit):
+        if len(hit) <= google_analytics_hit_max_bytes:
+            return False
+        logger.warning("Google Analytics hit too large: %s bytes", len(hit))
+        google_analytics_counts["dropped"] += 1
+        return True
+
+    async def forward_to_google_analytics():
+        next_hit = None
+        while True:
+            hit = next_hit or encode_google_analytics_hit(*await google_analytics_queue.get())
+            next_hit = None
+            if is_google_analytics_hit_too_large(hit):
+                continue
+
+            batch = [hit]
+            batch_bytes = len(hit)
+            while (
+                len(batch) < google_analytics_batch_max_hits and not google_analytics_queue.empty()
+            ):
+                hit = encode_google_analytics_hit(*google_analytics_queue.get_nowait())
+                if is_google_analytics_hit_too_large(hit):
+                    continue
+                if batch_bytes + 1 + len(hit) > google_analytics_batch_max_bytes:
+                    next_hit = hit
+                    break
+                batch.append(hit)
+                batch_bytes += 1 + len(hit)
+
+            logger.info("Sending %s hits to Google Analytics...", len(batch))
+            try:
+                async with client_session.request(
+                    "POST",
+                    google_analytics_batch_url,
+                    data=b"\n".join(batch),
+                    timeout=default_http_timeout,
+                ) as response:
+                    await response.read()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Unable to send %s hits to Google Analytics", len(batch))
+                google_analytics_counts["failed"] += len(batch)
+            else:
+                if 200 <= response.status < 300:
+                    logger.info("Sending %s hits to Google Analytics... %s", len(batch), response)
+                    google_analytics_counts["sent"] += len(batch)
+                else:
+                    logger.error(
+                        "Unable to send %s hits to Google Analytics: %s", len(batch), response
+                    )
+                    google_analytics_counts["failed"] += len(batch)
 
     async def get_data(downstream_request):
         # Avoid aiohttp treating request as chunked unnecessarily, which works
@@ -965,8 +1263,10 @@ async def async_main():
                 )
             )
             await downstream_response.prepare(downstream_request)
+            response_bytes = RESPONSE_BYTES.labels(downstream_request.get("route_class", "other"))
             async for chunk in upstream_response.content.iter_any():
                 await downstream_response.write(chunk)
+                response_bytes.inc(len(chunk))
 
         return downstream_response
 
@@ -976,31 +1276,44 @@ async def async_main():
             request_logger = get_random_context_logger()
             request["logger"] = request_logger
             url = request_url(request)
-
-            request_logger.info(
-                "Receiving (%s) (%s) (%s) (%s)",
-                request.method,
-                url,
-                request.headers.get("User-Agent", "-"),
-                request.headers.get("X-Forwarded-For", "-"),
+            sampled = (
+                log_static_assets_sample_rate >= 1
+                or not is_static_asset(request.path)
+                or random.random() < log_static_assets_sample_rate
             )
 
+            if sampled:
+                request_logger.info(
+                    "Receiving (%s) (%s) (%s) (%s)",
+                    request.method,
+                    url,
+                    request.headers.get("User-Agent", "-"),
+                    request.headers.get("X-Forwarded-For", "-"),
+                )
+
             response = await handler(request)
 
-            request_logger.info(
-                "Responding (%s) (%s) (%s) (%s) (%s) (%s)",
-                request.method,
-                url,
-                request.headers.get("User-Agent", "-"),
-                request.headers.get("X-Forwarded-For", "-"),
-                response.status,
-                response.content_length,
-            )
+            # Requests that aren't sampled are still logged if they fail
+            if sampled or response.status >= 400:
+                request_logger.info(
+                    "Responding (%s) (%s) (%s) (%s) (%s) (%s)",
+                    request.method,
+                    url,
+                    request.headers.get("User-Agent", "-"),
+                    request.headers.get("X-Forwarded-For", "-"),
+                    response.status,
+                    response.content_length,
+                )
 
             return response
 
         return _server_logger
 
+    def is_static_asset(path):
+        return path.startswith(static_asset_path_prefixes) or path.lower().endswith(
+            static_asset_extensions
+        )
+
     def require_peer_ip():
         @web.middleware
         async def _authenticate_by_peer_ip(request, handler):
@@ -1028,6 +1341,15 @@ async def async_main():
         redirect_from_sso_path = "/__redirect_from_sso"
         session_token_key = "staff_sso_access_token"
 
+        # Profiles are cached in memory in front of Redis, which is shared between instances
+        # of the proxy. After expiry a profile is still used for up to the max stale, while it
+        # is refreshed in the background. A token that SSO rejects is not used again
+        profile_cache_max_age = 60
+        profile_cache = InProcessCache(
+            max_size=10000, max_stale=int(env.get("SSO_PROFILE_CACHE_MAX_STALE", "60"))
+        )
+        in_process_caches["sso_profile"] = profile_cache
+
         async def get_redirect_uri_authenticate(set_session_value, redirect_uri_final):
             scheme = URL(redirect_uri_final).scheme
             sso_state = await set_redirect_uri_final(set_session_value, redirect_uri_final)
@@ -1077,6 +1399,55 @@ async def async_main():
                 )
             )
 
+        async def fetch_me_profile(request, token):
+            # Get profile from Redis cache to avoid calling SSO on every request
+            redis_profile_key = f"{PROFILE_CACHE_PREFIX}___{session_token_key}___{token}".encode(
+                "ascii"
+            )
+            with REDIS_DURATION.labels("sso_profile_read").time():
+                async with redis_pool as conn:
+                    async with conn.pipeline() as pipe:
+                        pipe.get(redis_profile_key)
+                        pipe.ttl(redis_profile_key)
+                        me_profile_raw, ttl = await pipe.execute()
+            if me_profile_raw:
+                SSO_PROFILE_FETCHES.labels("redis").inc()
+                return json.loads(me_profile_raw), ttl
+
+            SSO_PROFILE_FETCHES.labels("sso").inc()
+
+            request["logger"].info(
+                "Making request to SSO - %s%s",
+                sso_base_url,
+                me_path,
+            )
+            async with client_session.get(
+                f"{sso_base_url}{me_path}",
+                headers={"Authorization": f"Bearer {token}"},
+            ) as me_response:
+                me_profile_full = await me_response.json() if me_response.status == 200 else None
+
+            if not me_profile_full:
+                return None, 0
+
+            me_profile = {
+                "email": me_profile_full["email"],
+                "related_emails": me_profile_full["related_emails"],
+                "contact_email": me_profile_full["contact_email"],
+                "user_id": me_profile_full["user_id"],
+                "first_name": me_profile_full["first_name"],
+                "last_name": me_profile_full["last_name"],
+            }
+            with REDIS_DURATION.labels("sso_profile_write").time():
+                async with redis_pool as conn:
+                    await conn.set(
+                        redis_profile_key,
+                        json.dumps(me_profile).encode("utf-8"),
+                        ex=profile_cache_max_age,
+                    )
+
+            return me_profile, profile_cache_max_age
+
         @web.middleware
         async def _authenticate_by_sso(request, handler):
             sso_auth_required = is_sso_auth_required(request)
@@ -1131,76 +1502,39 @@ async def async_main():
                     )
                 )
 
-            # Get profile from Redis cache to avoid calling SSO on every request
-            redis_profile_key = f"{PROFILE_CACHE_PREFIX}___{session_token_key}___{token}".encode(
-                "ascii"
+            me_profile = await profile_cache.get_or_fetch(
+                token, lambda: fetch_me_profile(request, token)
             )
-            async with redis_pool as conn:
-                me_profile_raw = await conn.get(redis_profile_key)
-            me_profile = json.loads(me_profile_raw) if me_profile_raw else None
-
-            async def handler_with_sso_headers():
-                request["sso_profile_headers"] = (
-                    ("sso-profile-email", me_profile["email"]),
-                    # The default value of '' should be able to be removed after the cached
-                    # profile in Redis without contact_email has expired, i.e. 60 seconds after
-                    # deployment of this change
-                    ("sso-profile-contact-email", me_profile.get("contact_email", "")),
-                    (
-                        "sso-profile-related-emails",
-                        ",".join(me_profile.get("related_emails", [])),
-                    ),
-                    ("sso-profile-user-id", me_profile["user_id"]),
-                    ("sso-profile-first-name", me_profile["first_name"]),
-                    ("sso-profile-last-name", me_profile["last_name"]),
-                )
-
-                request["logger"].info(
-                    "SSO-authenticated: %s %s %s",
-                    me_profile["email"],
-                    me_profile["user_id"],
-                    request_url(request),
+            if not me_profile:
+                return await redirection_to_sso(
+                    with_new_session_cookie, set_session_value, request_url(request)
                 )
 
-                set_user({"id": me_profile["user_id"], "email": me_profile["email"]})
-
-                return await handler(request)
-
-            if me_profile:
-                return await handler_with_sso_headers()
+            request["sso_profile_headers"] = (
+                ("sso-profile-email", me_profile["email"]),
+                # The default value of '' should be able to be removed after the cached
+                # profile in Redis without contact_email has expired, i.e. 60 seconds after
+                # deployment of this change
+                ("sso-profile-contact-email", me_profile.get("contact_email", "")),
+                (
+                    "sso-profile-related-emails",
+                    ",".join(me_profile.get("related_emails", [])),
+                ),
+                ("sso-profile-user-id", me_profile["user_id"]),
+                ("sso-profile-first-name", me_profile["first_name"]),
+                ("sso-profile-last-name", me_profile["last_name"]),
+            )
 
             request["logger"].info(
-                "Making request to SSO - %s%s",
-                sso_base_url,
-                me_path,
+                "SSO-authenticated: %s %s %s",
+                me_profile["email"],
+                me_profile["user_id"],
+                request_url(request),
             )
-            async with client_session.get(
-                f"{sso_base_url}{me_path}",
-                headers={"Authorization": f"Bearer {token}"},
-            ) as me_response:
-                me_profile_full = await me_response.json() if me_response.status == 200 else None
-
-            if not me_profile_full:
-                return await redirection_to_sso(
-                    with_new_session_cookie, set_session_value, request_url(request)
-                )
 
-            me_profile = {
-                "email": me_profile_full["email"],
-                "related_emails": me_profile_full["related_emails"],
-                "contact_email": me_profile_full["contact_email"],
-                "user_id": me_profile_full["user_id"],
-                "first_name": me_profile_full["first_name"],
-                "last_name": me_profile_full["last_name"],
-            }
-            async with redis_pool as conn:
-                await conn.set(
-                    redis_profile_key,
-                    json.dumps(me_profile).encode("utf-8"),
-                    ex=60,
-                )
+            set_user({"id": me_profile["user_id"], "email": me_profile["email"]})
 
-            return await handler_with_sso_headers()
+            return await handler(request)
 
         return _authenticate_by_sso
 
@@ -1305,10 +1639,7 @@ async def async_main():
                 return await handler(request)
 
             peer_ip = get_peer_ip(request)
-            peer_ip_in_whitelist = any(
-                ipaddress.IPv4Address(peer_ip) in ipaddress.IPv4Network(address_or_subnet)
-                for address_or_subnet in ip_allowlist
-            )
+            peer_ip_in_whitelist = ip_allowlist_lookup.lookup(peer_ip) is not None
 
             if not peer_ip_in_whitelist:
                 request["logger"].info("IP-whitelist unauthenticated: %s", peer_ip)
@@ -1328,13 +1659,81 @@ async def async_main():
 
         return _authenticate_by_ip_whitelist
 
-    async with aiohttp.ClientSession(
+    # Upstreams are identified by their origin, and anything else is an application, or MLflow.
+    # Each upstream has its own pool of connections, and its own metrics
+    upstreams_by_origin = {
+        URL(admin_root).origin(): "admin",
+        URL(superset_root).origin(): "superset",
+        URL(flower_root).origin(): "flower",
+        URL(sso_base_url).origin(): "sso",
+        URL(mirror_remote_root).origin(): "mirror",
+        URL(google_analytics_batch_url).origin(): "google_analytics",
+    }
+
+    def get_upstream(url):
+        try:
+            return upstreams_by_origin[url.origin()]
+        except (KeyError, ValueError):
+            return "mlflow" if url.port == mlflow_port else "application"
+
+    def route_class(request):
+        if is_app_requested(request):
+            is_websocket = request.headers.get("upgrade", "").lower() == "websocket"
+            return "application_websocket" if is_websocket else "application"
+        if is_mirror_requested(request):
+            return "mirror"
+        if is_superset_requested(request):
+            return "superset"
+        if is_flower_requested(request):
+            return "flower"
+        if is_mlflow_requested(request):
+            return "mlflow"
+        if is_static_asset(request.path):
+            return "admin_static"
+        return "admin"
+
+    def request_metrics():
+        @web.middleware
+        async def _request_metrics(request, handler):
+            request["route_class"] = route_class(request)
+            with REQUEST_DURATION.labels(request["route_class"]).time():
+                return await handler(request)
+
+        return _request_metrics
+
+    async with UpstreamClientSessions(
+        get_upstream,
+        env.get("PROXY_UPSTREAM_POOLS", {}),
         auto_decompress=False,
         cookie_jar=aiohttp.DummyCookieJar(),
         skip_auto_headers=["Accept-Encoding"],
+        trace_configs=[upstream_trace_config(get_upstream)],
     ) as client_session:
+        for upstream, connector in client_session.connectors.items():
+            UPSTREAM_POOL_LIMIT.labels(upstream).set(connector.limit)
+        # Each worker has its own mirror cache, so they share the configured size between them
+        mirror_cache_dir = env.get("MIRROR_CACHE_DIR")
+        mirror_cache = (
+            MirrorCache(
+                mirror_cache_dir,
+                int(env.get("MIRROR_CACHE_MAX_BYTES", str(10 * 1024**3)))
+                // int(env.get("PROXY_WORKERS", "1")),
+                client_session,
+                default_http_timeout,
+            )
+            if mirror_cache_dir
+            else None
+        )
+        register_counts(
+            "proxy_mirror_cache_requests",
+            "Requests for files from the mirror, by how they were served by the cache",
+            ["result"],
+            lambda: mirror_cache.counts if mirror_cache is not None else {},
+        )
+
         app = web.Application(
             middlewares=[
+                request_metrics(),
                 server_logger(),
                 require_peer_ip(),
                 redis_session_middleware(
@@ -1378,18 +1777,120 @@ async def async_main():
         if elastic_apm:
             ElasticAPM(app)
 
-        runner = web.AppRunner(app)
+        background_tasks = [
+            asyncio.ensure_future(listen_for_application_instance_changes()),
+            asyncio.ensure_future(forward_to_google_analytics()),
+        ]
+
+        app.on_shutdown.append(close_downstream_websockets)
+
+        # On SIGTERM, the proxy stops accepting connections, closes websockets, and waits for
+        # other requests, e.g. streaming downloads, to complete for up to the shutdown timeout
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stopping.set)
+
+        runner = web.AppRunner(
+            app, shutdown_timeout=float(env.get("PROXY_SHUTDOWN_TIMEOUT", "60"))
+        )
         await runner.setup()
-        site = web.TCPSite(runner, "0.0.0.0", port)
+        site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=reuse_port)
         await site.start()
-        await asyncio.Future()
 
+        # Metrics are served on their own port, away from the routes that are proxied. Each
+        # worker has its own metrics, so each listens on its own port
+        metrics_port = env.get("PROXY_METRICS_PORT")
+        metrics_app = web.Application()
+        metrics_app.add_routes([web.get("/metrics", handle_metrics)])
+        metrics_runner = web.AppRunner(metrics_app)
+        await metrics_runner.setup()
+        if metrics_port is not None:
+            await web.TCPSite(metrics_runner, "0.0.0.0", int(metrics_port) + worker_index).start()
+        try:
+            await stopping.wait()
+            logger.info("Stopping: waiting for connections to close...")
+            await runner.cleanup()
+            await metrics_runner.cleanup()
+            logger.info("Stopping: waiting for connections to close... (done)")
+        finally:
+            for task in background_tasks:
+                task.cancel()
+            for probe in list(spawning_probes.values()):
+                probe.task.cancel()
+            logger.info("Log records: %s", dict(log_queue_handler.counts))
+            log_listener.stop()
 
-def main():
+
+def run_worker(reuse_port, worker_index=0):
     init_sentry(integrations=[AioHttpIntegration()])
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(async_main())
+    loop.run_until_complete(async_main(reuse_port, worker_index))
+
+
+def supervise_workers(num_workers):
+    # Each worker is a process with its own event loop, and they all listen on the same port
+    # using SO_REUSEPORT, so the kernel distributes connections between them. Each worker has its
+    # own in-memory caches, which are kept coherent by each subscribing to changes via Redis
+    logger = logging.getLogger("proxy_supervisor")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    # The index of each worker is kept when it's restarted, so it serves metrics on the same port
+    worker_pids = {}
+    stopping = False
+
+    def start_worker(worker_index):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_worker(reuse_port=True, worker_index=worker_index)
+                exit_code = 0
+            finally:
+                os._exit(exit_code)  # pylint: disable=protected-access
+        worker_pids[pid] = worker_index
+        logger.info("Started worker %s", pid)
+
+    def stop_workers(signal_number, _):
+        nonlocal stopping
+        stopping = True
+        for pid in worker_pids:
+            # The worker could have exited and been waited for, but not yet removed
+            try:
+                os.kill(pid, signal_number)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for worker_index in range(num_workers):
+        start_worker(worker_index)
+
+    while worker_pids:
+        pid, status = os.wait()
+        worker_index = worker_pids.pop(pid, None)
+        if worker_index is None:
+            continue
+        if stopping:
+            logger.info("Worker %s stopped", pid)
+        else:
+            logger.error("Worker %s exited with status %s: restarting", pid, status)
+            time.sleep(1)
+            if not stopping:
+                start_worker(worker_index)
+
+
+def main():
+    num_workers = int(normalise_environment(os.environ).get("PROXY_WORKERS", "1"))
+    if num_workers == 1:
+        run_worker(reuse_port=False)
+    else:
+        supervise_workers(num_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+"""Small in-process caches for the proxy
+
+The proxy makes requests to the admin application, and to SSO, that return the
+same values for many consecutive requests. These caches hold such values in the
+memory of the proxy process, so they can be returned without any network round
+trip at all.
+
+- Entries expire after a per-entry max age, and the least recently used entries
+  are evicted once the cache is full;
+- concurrent requests for the same missing key share a single fetch, so a
+  burst of requests results in a single upstream request;
+- optionally, expired entries are served for up to a further max stale
+  seconds while a single fetch refreshes them in the background, so requests
+  don't wait on the upstream each time an entry expires;
+- entries can be invalidated explicitly, e.g. when notified of a change via
+  Redis pub/sub.
+
+Values are only ever read and written from the event loop, so no locking is
+needed.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+
+# A child of the proxy's logger, so records go to the same handlers
+logger = logging.getLogger("proxy.cache")
+
+
+class InProcessCache:
+    def __init__(self, max_size, max_stale=0):
+        self._max_size = max_size
+        self._max_stale = max_stale
+        self._entries = OrderedDict()
+        self._fetches = {}
+        self.counts = Counter()
+
+    def get(self, key):
+        value, is_fresh = self._get(key)
+        return value if is_fresh else None
+
+    def _get(self, key):
+        try:
+            expires_at, value = self._entries[key]
+        except KeyError:
+            self.counts["miss"] += 1
+            return None, False
+
+        now = time.monotonic()
+        if expires_at + self._max_stale <= now:
+            del self._entries[key]
+            self.counts["miss"] += 1
+            return None, False
+
+        self._entries.move_to_end(key)
+        is_fresh = expires_at > now
+        self.counts["hit" if is_fresh else "stale"] += 1
+        return value, is_fresh
+
+    def set(self, key, value, max_age):
+        # A value that must not be cached replaces any previous one, e.g. if a
+        # refresh finds that the previous value is no longer valid
+        if max_age <= 0:
+            self._entries.pop(key, None)
+            return
+
+        self._entries[key] = (time.monotonic() + max_age, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        # A fetch in progress may have started before the change that caused
+        # the invalidation, so its result must not be cached
+        fetch = self._fetches.pop(key, None)
+        if fetch is not None:
+            fetch.invalidated = True
+
+    def invalidate_matching(self, predicate):
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+        for key in [key for key in self._fetches if predicate(key)]:
+            self._fetches.pop(key).invalidated = True
+
+    def clear(self):
+        self._entries.clear()
+        for fetch in self._fetches.values():
+            fetch.invalidated = True
+        self._fetches.clear()
+
+    async def get_or_fetch(self, key, fetch):
+        """Returns the cached value for key, or awaits fetch() to get it
+
+        fetch must return a (value, max_age) tuple, and the value is only
+        cached if max_age is positive. Concurrent calls for the same key await
+        the same call to fetch. An expired value within max stale is returned
+        immediately, and fetch() is called in the background to refresh it
+        """
+        value, is_fresh = self._get(key)
+        if value is not None:
+            if not is_fresh:
+                self._fetch(key, fetch)
+            return value
+
+        # Shielded so a client disconnecting doesn't cancel the fetch that
+        # other requests may be waiting on
+        value, _ = await asyncio.shield(self._fetch(key, fetch).task)
+        return value
+
+    def _fetch(self, key, fetch):
+        try:
+            return self._fetches[key]
+        except KeyError:
+            pass
+
+        in_flight = _Fetch(asyncio.ensure_future(fetch()))
+        self._fetches[key] = in_flight
+
+        def on_done(task):
+            if self._fetches.get(key) is in_flight:
+                del self._fetches[key]
+            if task.cancelled() or in_flight.invalidated:
+                return
+            if task.exception() is not None:
+                # Background refreshes have nothing awaiting them, so would otherwise fail
+                # silently. The key isn't logged, since some are secrets, e.g. access tokens
+                logger.warning("Unable to fetch cache entry", exc_info=task.exception())
+                return
+            self.set(key, *task.result())
+
+        in_flight.task.add_done_callback(on_done)
+        return in_flight
+
+
+class _Fetch:
+    def __init__(self, task):
+        self.task = task
+        self.invalidated = False
@@ -0,0 +1,88 @@
+"""Logging from the proxy without formatting or writing records on the event loop
+
+The proxy logs every request and response, and records are formatted as ECS
+JSON and written to stdout. Doing this on the event loop adds to the latency
+of every request, and if stdout is slow to accept writes, blocks all requests.
+
+Instead, records are put on a bounded queue, and formatted and written by a
+dedicated thread.
+
+- If the queue is full, records are dropped rather than waiting for space,
+  since waiting would block the event loop, and so every request;
+- a record of WARNING or above instead takes the place of the oldest queued
+  record below WARNING, if there is one, which is dropped;
+- dropped records are counted by level, and the number dropped is itself
+  logged once there is space in the queue again.
+"""
+
+import logging
+import logging.handlers
+import queue
+from collections import Counter
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, max_size):
+        super().__init__(queue.Queue(maxsize=max_size))
+        self.counts = Counter()
+        self._dropped_since_reported = 0
+
+    def prepare(self, record):
+        # The base class formats the record here, on the caller's thread, which is what this
+        # handler avoids. Records are only handled in this process, so they don't need to be
+        # made picklable
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self._dropped_since_reported:
+                self.queue.put_nowait(
+                    logging.LogRecord(
+                        record.name,
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        "Dropped %s log records since the log queue was full",
+                        (self._dropped_since_reported,),
+                        None,
+                    )
+                )
+                self._dropped_since_reported = 0
+
+            self.queue.put_nowait(record)
+        except queue.Full:
+            evicted = self._evict_below_warning() if record.levelno >= logging.WARNING else None
+            self._count_dropped(evicted or record)
+            if evicted is not None:
+                self.queue.put_nowait(record)
+                self.counts["queued", record.levelname] += 1
+        else:
+            self.counts["queued", record.levelname] += 1
+
+    def _evict_below_warning(self):
+        # queue.Queue has no way to remove a particular item, so this removes it from the
+        # underlying deque under the queue's lock, as its own methods do
+        with self.queue.mutex:
+            for queued in self.queue.queue:
+                if queued.levelno < logging.WARNING:
+                    self.queue.queue.remove(queued)
+                    # So QueueListener.stop, which joins the queue, doesn't wait for it
+                    self.queue.unfinished_tasks -= 1
+                    return queued
+        return None
+
+    def _count_dropped(self, record):
+        self.counts["dropped", record.levelname] += 1
+        self._dropped_since_reported += 1
+
+
+def start_queue_logging(loggers, handler, max_size):
+    """Replaces the handlers of the loggers with a DroppingQueueHandler, and returns it and the
+    started QueueListener that passes its records to handler from another thread
+    """
+    queue_handler = DroppingQueueHandler(max_size)
+    for logger in loggers:
+        logger.handlers = [queue_handler]
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    listener.start()
+    return queue_handler, listener
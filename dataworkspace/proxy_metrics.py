@@ -0,0 +1,173 @@
+"""Prometheus metrics for the proxy
+
+Metrics are recorded in the default registry of prometheus_client, and served
+in the text exposition format from a separate port, so they are never exposed
+through the proxy's public routes.
+
+- Requests to and responses from upstreams are timed using an aiohttp
+  TraceConfig on the client session, so every upstream request is timed
+  without changing the code that makes it;
+- counts that are already kept by other parts of the proxy, e.g. by its
+  caches, are read when metrics are collected, rather than being duplicated.
+"""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily
+
+REQUEST_DURATION = Histogram(
+    "proxy_request_duration_seconds",
+    "Time taken to respond to requests, including streaming their response",
+    ["route_class"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800),
+)
+UPSTREAM_RESPONSE_DURATION = Histogram(
+    "proxy_upstream_response_headers_seconds",
+    "Time from starting requests to upstreams to receiving their response headers",
+    ["upstream"],
+)
+UPSTREAM_CONNECTION_QUEUED_DURATION = Histogram(
+    "proxy_upstream_connection_queued_seconds",
+    "Time requests to upstreams waited for a connection from the pool",
+    ["upstream"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+UPSTREAM_CONNECTIONS_QUEUED = Gauge(
+    "proxy_upstream_connections_queued",
+    "Requests to upstreams currently waiting for a connection from the pool",
+    ["upstream"],
+)
+UPSTREAM_POOL_LIMIT = Gauge(
+    "proxy_upstream_pool_limit",
+    "Maximum number of connections in the pool for each upstream, where 0 is unlimited",
+    ["upstream"],
+)
+UPSTREAM_CONNECTIONS = Counter(
+    "proxy_upstream_connections",
+    "Connections used for requests to upstreams, by whether they were created or reused",
+    ["upstream", "result"],
+)
+UPSTREAM_ERRORS = Counter(
+    "proxy_upstream_errors",
+    "Requests to upstreams that raised an exception",
+    ["upstream"],
+)
+RESPONSE_BYTES = Counter(
+    "proxy_response_bytes",
+    "Bytes streamed from upstreams to clients",
+    ["route_class"],
+)
+WEBSOCKETS_OPEN = Gauge(
+    "proxy_websockets_open",
+    "Websockets currently open from clients to the proxy",
+)
+REDIS_DURATION = Histogram(
+    "proxy_redis_duration_seconds",
+    "Time taken by Redis operations, including waiting for a connection",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+SESSION_READS = Counter(
+    "proxy_session_reads",
+    "Reads of sessions from Redis, by whether the session was found",
+    ["result"],
+)
+SSO_PROFILE_FETCHES = Counter(
+    "proxy_sso_profile_fetches",
+    "Fetches of SSO profiles not cached in the proxy process, by where they were found",
+    ["source"],
+)
+
+
+class CountsCollector:
+    """Collects a counter from a dict, or collections.Counter, of label values to counts
+
+    The keys of the dict are label values, or tuples of them if there is more than one label
+    """
+
+    def __init__(self, name, documentation, labelnames, get_counts):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = labelnames
+        self._get_counts = get_counts
+
+    def collect(self):
+        metric = CounterMetricFamily(self._name, self._documentation, labels=self._labelnames)
+        for labels, count in list(self._get_counts().items()):
+            metric.add_metric(labels if isinstance(labels, tuple) else (labels,), count)
+        yield metric
+
+    def describe(self):
+        return []
+
+
+def register_counts(name, documentation, labelnames, get_counts):
+    REGISTRY.register(CountsCollector(name, documentation, labelnames, get_counts))
+
+
+def upstream_trace_config(get_upstream):
+    """A TraceConfig that records metrics for requests to upstreams
+
+    get_upstream is called with the URL of each request, and returns the name of the upstream
+    to label its metrics with
+    """
+    loop = asyncio.get_running_loop()
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(_, context, params):
+        context.upstream = get_upstream(params.url)
+        context.request_start = loop.time()
+
+    async def on_request_end(_, context, __):
+        UPSTREAM_RESPONSE_DURATION.labels(context.upstream).observe(
+            loop.time() - context.request_start
+        )
+
+    async def on_request_exception(_, context, __):
+        UPSTREAM_ERRORS.labels(context.upstream).inc()
+        # The end of queueing isn't traced if the request is cancelled while queued
+        if getattr(context, "queued_start", None) is not None:
+            UPSTREAM_CONNECTIONS_QUEUED.labels(context.upstream).dec()
+
+    async def on_connection_queued_start(_, context, __):
+        context.queued_start = loop.time()
+        UPSTREAM_CONNECTIONS_QUEUED.labels(context.upstream).inc()
+
+    async def on_connection_queued_end(_, context, __):
+        UPSTREAM_CONNECTIONS_QUEUED.labels(context.upstream).dec()
+        UPSTREAM_CONNECTION_QUEUED_DURATION.labels(context.upstream).observe(
+            loop.time() - context.queued_start
+        )
+        context.queued_start = None
+
+    async def on_connection_create_end(_, context, __):
+        UPSTREAM_CONNECTIONS.labels(context.upstream, "created").inc()
+
+    async def on_connection_reuseconn(_, context, __):
+        UPSTREAM_CONNECTIONS.labels(context.upstream, "reused").inc()
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+async def handle_metrics(_):
+    return web.Response(
+        body=generate_latest(REGISTRY),
+        headers={"content-type": CONTENT_TYPE_LATEST},
+    )
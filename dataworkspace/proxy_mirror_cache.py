@@ -0,0 +1,334 @@
+"""On-disk cache of files requested through the proxy's mirror
+
+Tools install packages from the mirror of PyPI, CRAN and conda, and spawning
+many identical tools results in the same multi-hundred-megabyte files being
+fetched from the remote mirror over and over. This caches them on local disk.
+
+- Package files, e.g. wheels, never change once published, so once cached
+  they are served from disk without contacting the remote mirror;
+- other files, e.g. index pages, can change, so each request for them is
+  revalidated with the remote mirror using the ETag of the cached copy, and is
+  only fetched in full if it has changed;
+- concurrent requests for the same file share a single fetch from the remote
+  mirror, and all are streamed the file as it's written to disk;
+- cached files are served with support for range requests, and with the
+  headers that describe their representation, e.g. Content-Encoding, as the
+  remote mirror sent them;
+- responses other than 200 are streamed through to every request waiting on
+  the fetch, rather than cached;
+- the least recently used files are deleted once the total size of the cache
+  exceeds its maximum.
+
+Each process has its own directory inside the cache directory, since the index
+of cached files is held in memory. Any existing directory for a process that is
+no longer running is deleted on startup.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+
+from aiohttp import web
+from multidict import CIMultiDict
+
+IMMUTABLE_EXTENSIONS = (
+    ".whl",
+    ".egg",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".conda",
+    ".zip",
+)
+
+CHUNK_SIZE = 65536
+
+# Stored with each cached file, and sent with every response from it
+REPRESENTATION_HEADERS = (
+    "content-type",
+    "content-encoding",
+    "content-language",
+    "content-disposition",
+)
+
+# A fetch is shared by requests that could each have sent different conditions, and the
+# cache makes its own conditional requests to the remote mirror
+CONDITIONAL_REQUEST_HEADERS = (
+    "if-match",
+    "if-none-match",
+    "if-modified-since",
+    "if-unmodified-since",
+    "if-range",
+    "range",
+)
+
+
+class MirrorCache:
+    def __init__(self, directory, max_bytes, client_session, timeout):
+        _delete_directories_of_stopped_processes(directory)
+        self._directory = os.path.join(directory, str(os.getpid()))
+        shutil.rmtree(self._directory, ignore_errors=True)
+        os.makedirs(self._directory)
+
+        self._max_bytes = max_bytes
+        self._client_session = client_session
+        self._timeout = timeout
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._fetches = {}
+        self.counts = Counter()
+
+    async def handle(
+        self,
+        downstream_request,
+        mirror_path,
+        upstream_url,
+        upstream_headers,
+        with_cookie,
+        uncached,
+    ):
+        """Responds to a request for mirror_path from the cache, fetching it if needed from
+        upstream_url with upstream_headers, or awaits uncached() to respond without the cache,
+        e.g. for methods other than GET
+        """
+        if downstream_request.method != "GET":
+            return await uncached()
+
+        entry = self._entries.get(mirror_path)
+        if entry is not None and mirror_path.endswith(IMMUTABLE_EXTENSIONS):
+            self.counts["hit"] += 1
+            return await self._file_response(mirror_path, entry, with_cookie)
+
+        try:
+            fetch = self._fetches[mirror_path]
+        except KeyError:
+            fetch = _Fetch(entry.etag if entry is not None else None)
+            self._fetches[mirror_path] = fetch
+            asyncio.ensure_future(self._fetch(mirror_path, upstream_url, upstream_headers, fetch))
+
+        fetch.readers += 1
+        try:
+            return await self._fetched_response(
+                downstream_request, mirror_path, fetch, with_cookie, uncached
+            )
+        finally:
+            fetch.readers -= 1
+            fetch.remove_if_unread()
+
+    async def _fetched_response(
+        self, downstream_request, mirror_path, fetch, with_cookie, uncached
+    ):
+        # Shielded so a client disconnecting doesn't cancel the fetch that other requests may be
+        # waiting on
+        status = await asyncio.shield(fetch.status)
+
+        entry = self._entries.get(mirror_path)
+        if status == 304:
+            if entry is None:
+                # Evicted since the fetch was started
+                self.counts["uncached"] += 1
+                return await uncached()
+            self.counts["revalidated"] += 1
+            return await self._file_response(mirror_path, entry, with_cookie)
+
+        if status != 200:
+            self.counts["passed_through"] += 1
+            return await self._streamed_response(downstream_request, fetch, with_cookie)
+
+        # Range requests are rare enough to not need to be served while the file is fetched
+        if "range" in downstream_request.headers:
+            await asyncio.shield(fetch.done)
+            entry = self._entries.get(mirror_path)
+            if entry is None:
+                self.counts["uncached"] += 1
+                return await uncached()
+            return await self._file_response(mirror_path, entry, with_cookie)
+
+        self.counts["miss"] += 1
+        return await self._streamed_response(downstream_request, fetch, with_cookie)
+
+    async def _file_response(self, mirror_path, entry, with_cookie):
+        self._entries.move_to_end(mirror_path)
+        return await with_cookie(web.FileResponse(entry.path, headers=entry.headers))
+
+    async def _streamed_response(self, downstream_request, fetch, with_cookie):
+        loop = asyncio.get_running_loop()
+        downstream_response = await with_cookie(
+            web.StreamResponse(status=fetch.status.result(), headers=fetch.headers)
+        )
+        await downstream_response.prepare(downstream_request)
+
+        # The file is read as it's written by the fetch, which could be from before it's
+        # complete, or after it's been deleted by eviction: both of which are fine on POSIX
+        with open(fetch.path, "rb") as file:
+            position = 0
+            while True:
+                chunk = await loop.run_in_executor(None, file.read, CHUNK_SIZE)
+                if chunk:
+                    position += len(chunk)
+                    await downstream_response.write(chunk)
+                elif position < fetch.bytes_written:
+                    continue
+                elif fetch.done.done():
+                    # Raises if the fetch failed, so the client sees an incomplete response
+                    fetch.done.result()
+                    break
+                else:
+                    await fetch.progress.wait()
+
+        return downstream_response
+
+    async def _fetch(self, mirror_path, upstream_url, upstream_headers, fetch):
+        loop = asyncio.get_running_loop()
+        headers = CIMultiDict(
+            (key, value)
+            for key, value in upstream_headers.items()
+            if key.lower() not in CONDITIONAL_REQUEST_HEADERS
+        )
+        if fetch.etag is not None:
+            headers["if-none-match"] = fetch.etag
+        try:
+            async with self._client_session.request(
+                "GET",
+                str(upstream_url),
+                headers=headers,
+                allow_redirects=False,
+                timeout=self._timeout,
+            ) as upstream_response:
+                if upstream_response.status == 304:
+                    fetch.status.set_result(upstream_response.status)
+                    fetch.done.set_result(None)
+                    return
+
+                # Responses other than 200, e.g. redirects, are passed through with all their
+                # headers, since they aren't cached
+                fetch.headers = CIMultiDict(
+                    (key, value)
+                    for key, value in upstream_response.headers.items()
+                    if (
+                        key.lower()
+                        in REPRESENTATION_HEADERS + ("content-length", "etag", "last-modified")
+                        if upstream_response.status == 200
+                        else key.lower() != "transfer-encoding"
+                    )
+                )
+
+                # The file must exist before any request is told of the status, since each
+                # then reads it as it's written
+                fd, fetch.path = tempfile.mkstemp(dir=self._directory)
+                fetch.status.set_result(upstream_response.status)
+
+                with open(fd, "wb") as file:
+
+                    def write(chunk):
+                        file.write(chunk)
+                        file.flush()
+
+                    async for chunk in upstream_response.content.iter_chunked(CHUNK_SIZE):
+                        await loop.run_in_executor(None, write, chunk)
+                        fetch.bytes_written += len(chunk)
+                        fetch.notify_progress()
+
+            if fetch.status.result() == 200:
+                fetch.cached = True
+                self._add(
+                    mirror_path,
+                    _Entry(
+                        fetch.path,
+                        fetch.bytes_written,
+                        fetch.headers.get("etag"),
+                        CIMultiDict(
+                            (key, value)
+                            for key, value in fetch.headers.items()
+                            if key.lower() in REPRESENTATION_HEADERS
+                        ),
+                    ),
+                )
+            fetch.done.set_result(None)
+            fetch.remove_if_unread()
+        except BaseException as exception:
+            # Requests waiting on the fetch see the exception, so it's not raised from the task,
+            # which nothing awaits
+            if fetch.path is not None:
+                _remove(fetch.path)
+            for future in (fetch.status, fetch.done):
+                if not future.done():
+                    future.set_exception(exception)
+                # Retrieved so asyncio doesn't warn if no request was waiting
+                future.exception()
+            if isinstance(exception, asyncio.CancelledError):
+                raise
+        finally:
+            # Here rather than in a callback of the task, so no request can start reading a
+            # fetch whose file was removed by remove_if_unread
+            if self._fetches.get(mirror_path) is fetch:
+                del self._fetches[mirror_path]
+            fetch.notify_progress()
+
+    def _add(self, mirror_path, entry):
+        previous = self._entries.pop(mirror_path, None)
+        if previous is not None:
+            self._total_bytes -= previous.size
+            _remove(previous.path)
+
+        self._entries[mirror_path] = entry
+        self._total_bytes += entry.size
+        while self._total_bytes > self._max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= evicted.size
+            _remove(evicted.path)
+            self.counts["evicted"] += 1
+
+
+class _Entry:
+    def __init__(self, path, size, etag, headers):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.headers = headers
+
+
+class _Fetch:
+    def __init__(self, etag):
+        self.etag = etag
+        self.status = asyncio.Future()
+        self.done = asyncio.Future()
+        self.headers = {}
+        self.path = None
+        self.bytes_written = 0
+        self.progress = asyncio.Event()
+        self.readers = 0
+        self.cached = False
+
+    def notify_progress(self):
+        self.progress.set()
+        self.progress = asyncio.Event()
+
+    def remove_if_unread(self):
+        # The file of a response that isn't cached is only needed until the fetch is done and
+        # every request waiting on it has been sent it
+        if not self.cached and self.path is not None and self.readers == 0 and self.done.done():
+            _remove(self.path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _delete_directories_of_stopped_processes(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        try:
+            os.kill(int(name), 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        except PermissionError:
+            # The process exists, but is owned by another user
+            continue
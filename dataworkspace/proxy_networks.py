@@ -0,0 +1,59 @@
+"""Lookup of the network that an IP address is in, for allowlists in the proxy
+
+The allowlists are checked on every request to an allowlisted application, and
+can have thousands of entries. Rather than testing the address against each
+network in turn, the networks are compiled once on startup into a table per
+IP version and prefix length, mapping each network address to its value.
+
+An address is then looked up by masking it with each prefix length that is in
+use, and looking up the result in that prefix length's table. This is at most
+33 dictionary lookups for IPv4 addresses, and 129 for IPv6, however many
+networks there are. Typically only a handful of prefix lengths are in use.
+
+If an address is in more than one network, the value of the first of them is
+returned, as would be from a linear scan of the networks in order.
+"""
+
+import ipaddress
+from functools import lru_cache
+
+
+class NetworkLookup:
+    def __init__(self, networks_and_values, cache_size=10000):
+        # For each IP version, (prefix length, mask, {network address: (index, value)})
+        tables_by_version = {4: {}, 6: {}}
+        for index, (network, value) in enumerate(networks_and_values):
+            network = ipaddress.ip_network(network)
+            table = tables_by_version[network.version].setdefault(network.prefixlen, {})
+            table.setdefault(int(network.network_address), (index, value))
+
+        max_prefixlen_by_version = {4: 32, 6: 128}
+        self._tables = {
+            version: tuple(
+                (
+                    (((1 << prefixlen) - 1) << (max_prefixlen_by_version[version] - prefixlen)),
+                    table,
+                )
+                for prefixlen, table in sorted(tables.items())
+            )
+            for version, tables in tables_by_version.items()
+        }
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, ip):
+        """The value of the first network that contains ip, or None if there is no such
+        network or ip is not a valid IP address
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        address_int = int(address)
+        best = None
+        for mask, table in self._tables[address.version]:
+            match = table.get(address_int & mask)
+            if match is not None and (best is None or match[0] < best[0]):
+                best = match
+
+        return best[1] if best is not None else None
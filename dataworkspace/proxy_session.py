@@ -24,14 +24,18 @@ Note, we don't need to
 - get a list of all keys in session;
 - read-back a value once set (in the same request).
 
-So we use SET and GET to manually keep a "dict" in Redis that allows multiple
-requests to add keys concurrently
+So we use a Redis hash per session, to which multiple requests can add fields
+concurrently with HSET. The hash is fetched with a single HGETALL the first time
+a value is requested, and values set during a request are written together
+once the response's cookie is set. So a request makes at most one round trip to
+Redis to read the session, and one to write to it
 """
 
 import secrets
 import time
 
 from aiohttp import web
+from proxy_metrics import REDIS_DURATION, SESSION_READS
 
 COOKIE_MAX_AGE = 60 * 60 * 10
 
@@ -52,18 +56,24 @@ def redis_session_middleware(
         cookie_value = request.cookies.get(cookie_name)
         peer_ip_group = get_peer_ip_group(request)
         to_set = {}
+        values = None
+
+        def get_redis_key():
+            return f"{REDIS_KEY_PREFIX}___{cookie_value}___{peer_ip_group}".encode("ascii")
 
         async def get_value(key):
+            nonlocal values
+
             if not cookie_value or peer_ip_group is None:
                 return None
 
-            async with redis_pool as conn:
-                redis_key = (
-                    f"{REDIS_KEY_PREFIX}___{cookie_value}___{peer_ip_group}___{key}".encode(
-                        "ascii"
-                    )
-                )
-                raw = await conn.get(redis_key)
+            if values is None:
+                with REDIS_DURATION.labels("session_read").time():
+                    async with redis_pool as conn:
+                        values = await conn.hgetall(get_redis_key())
+                SESSION_READS.labels("found" if values else "not_found").inc()
+
+            raw = values.get(key.encode("ascii"))
             return raw.decode("ascii") if raw is not None else None
 
         async def set_value(key, value):
@@ -85,13 +95,19 @@ def redis_session_middleware(
                 cookie_value = get_secret_cookie_value()
 
             if to_set and peer_ip_group is not None:
-                async with redis_pool as conn:
-                    for key, value in to_set.items():
-                        redis_key = f"{REDIS_KEY_PREFIX}___{cookie_value}___{peer_ip_group}___{key}".encode(
-                            "ascii"
-                        )
-                        redis_value = value.encode("ascii")
-                        await conn.set(redis_key, redis_value, ex=REDIS_MAX_AGE)
+                redis_key = get_redis_key()
+                with REDIS_DURATION.labels("session_write").time():
+                    async with redis_pool as conn:
+                        async with conn.pipeline() as pipe:
+                            pipe.hset(
+                                redis_key,
+                                mapping={
+                                    key.encode("ascii"): value.encode("ascii")
+                                    for key, value in to_set.items()
+                                },
+                            )
+                            pipe.expire(redis_key, REDIS_MAX_AGE)
+                            await pipe.execute()
 
             expires = time.strftime(
                 "%a, %d-%b-%Y %T GMT", time.gmtime(time.time() + COOKIE_MAX_AGE)
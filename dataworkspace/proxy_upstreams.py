@@ -0,0 +1,91 @@
+"""A pool of connections per upstream for the proxy
+
+With a single client session, all upstreams share one pool of connections,
+so a burst of requests to one, e.g. a tool streaming many assets, can leave
+requests to others waiting for a connection. This includes requests to the
+admin application, which nearly every request through the proxy depends on.
+
+Instead, there is a client session per upstream, each with its own connector
+and so its own pool, with its own limits. Requests are made using the same
+methods as on a single client session, and are made with the session of the
+upstream of their URL.
+
+The connection limits, how long idle connections are kept for reuse, and how
+long DNS lookups are cached can be configured per upstream, e.g. with
+
+    PROXY_UPSTREAM_POOLS__ADMIN__LIMIT=200
+    PROXY_UPSTREAM_POOLS__ADMIN__KEEPALIVE_TIMEOUT=60
+"""
+
+import aiohttp
+from yarl import URL
+
+DEFAULT_POOL = {
+    "LIMIT": 100,
+    "LIMIT_PER_HOST": 0,
+    "KEEPALIVE_TIMEOUT": 15,
+    "DNS_CACHE_TTL": 10,
+}
+
+DEFAULT_POOLS = {
+    # The admin application is on the critical path of nearly every request, so has a
+    # large pool whose connections are kept open for a long time to maximise reuse
+    "admin": {"LIMIT": 200, "KEEPALIVE_TIMEOUT": 60, "DNS_CACHE_TTL": 300},
+    "sso": {"LIMIT": 50, "KEEPALIVE_TIMEOUT": 30, "DNS_CACHE_TTL": 60},
+    "superset": {"LIMIT": 100, "KEEPALIVE_TIMEOUT": 30, "DNS_CACHE_TTL": 60},
+    "flower": {"LIMIT": 10},
+    "mlflow": {"LIMIT": 100},
+    "mirror": {"LIMIT": 100, "KEEPALIVE_TIMEOUT": 30, "DNS_CACHE_TTL": 60},
+    "google_analytics": {"LIMIT": 10, "KEEPALIVE_TIMEOUT": 30, "DNS_CACHE_TTL": 300},
+    # Each tool is a different host, so a limit per host stops one from using all the
+    # connections to tools. The total is still limited, so a burst of requests across
+    # many tools can't exhaust the proxy's file descriptors
+    "application": {"LIMIT": 1000, "LIMIT_PER_HOST": 100},
+}
+
+
+class UpstreamClientSessions:
+    def __init__(self, get_upstream, pools_config, **session_kwargs):
+        """get_upstream is called with the URL of each request, and returns the name of its
+        upstream, which must be one of the keys of DEFAULT_POOLS. pools_config overrides the
+        defaults for each upstream, and is keyed by the upper-cased upstream name
+        """
+        self._get_upstream = get_upstream
+        self.connectors = {}
+        self._sessions = {}
+        for upstream, default_pool in DEFAULT_POOLS.items():
+            pool = {
+                **DEFAULT_POOL,
+                **default_pool,
+                **pools_config.get(upstream.upper(), {}),
+            }
+            connector = aiohttp.TCPConnector(
+                limit=int(pool["LIMIT"]),
+                limit_per_host=int(pool["LIMIT_PER_HOST"]),
+                keepalive_timeout=float(pool["KEEPALIVE_TIMEOUT"]),
+                ttl_dns_cache=int(pool["DNS_CACHE_TTL"]),
+            )
+            self.connectors[upstream] = connector
+            self._sessions[upstream] = aiohttp.ClientSession(connector=connector, **session_kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        for session in self._sessions.values():
+            await session.close()
+
+    def _session(self, url):
+        return self._sessions[self._get_upstream(URL(url))]
+
+    def request(self, method, url, **kwargs):
+        return self._session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self._session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._session(url).post(url, **kwargs)
+
+    def ws_connect(self, url, **kwargs):
+        return self._session(url).ws_connect(url, **kwargs)
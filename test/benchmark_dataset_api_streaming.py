@@ -0,0 +1,122 @@
+"""Micro-benchmarks of encoding pages of the dataset API as chunked JSON
+
+Run from the root of the repository, with the directory containing the application
+on the path, for example
+
+    PYTHONPATH=dataworkspace python -m test.benchmark_dataset_api_streaming
+
+For a narrow and a wide table, reports the rows per second of the previous
+encoding of each row with json.dumps and re-joining of the queue of bytes for each
+chunk, and of yield_page of JSON with and without orjson. The rows are generated up
+front, so the database isn't part of the results
+"""
+
+import datetime
+import decimal
+import json
+import timeit
+from unittest import mock
+
+from dataworkspace.apps.api_v1.datasets.streaming import JsonPageEncoder, yield_page
+
+
+def previous_yield_json_page(primary_key, columns, rows, base_url):
+    def yield_chunks(row_bytes):
+        nonlocal queue
+        nonlocal num_bytes_queued
+        nonlocal num_bytes_sent_and_queued
+
+        queue.append(row_bytes)
+        num_bytes_queued += len(row_bytes)
+        num_bytes_sent_and_queued += len(row_bytes)
+        while num_bytes_queued >= chunk_size:
+            to_send_bytes = b"".join(queue)
+            chunk, to_send_bytes = (
+                to_send_bytes[:chunk_size],
+                to_send_bytes[chunk_size:],
+            )
+            queue = [to_send_bytes] if to_send_bytes else []
+            num_bytes_queued = len(to_send_bytes)
+            yield chunk
+
+    num_bytes_max = 49_990_000
+    chunk_size = 16384
+    queue = []
+    num_bytes_queued = 0
+    num_bytes_sent_and_queued = 0
+
+    yield from yield_chunks(b'{"headers": ')
+    yield from yield_chunks(json.dumps(columns).encode("utf-8"))
+    yield from yield_chunks(b', "values": [')
+    for i, row in enumerate(rows):
+        row_bytes = json.dumps(row, default=str).encode("utf-8")
+        if i > 0:
+            row_bytes = b"," + row_bytes
+        yield from yield_chunks(row_bytes)
+
+        if num_bytes_sent_and_queued > num_bytes_max:
+            search_after = [row[columns.index(k)] for k in primary_key]
+            search_after = "&".join(["$searchAfter={}".format(k) for k in search_after])
+            next_url = "{}?{}".format(base_url, search_after)
+            yield from yield_chunks(b'], "next": "' + next_url.encode("utf-8") + b'"}')
+            break
+    else:
+        yield from yield_chunks(b'], "next": null}')
+    if queue:
+        yield b"".join(queue)
+
+
+def yield_json_page(*args):
+    yield from yield_page(JsonPageEncoder(None), *args)
+
+
+def yield_json_page_without_orjson(*args):
+    with mock.patch("dataworkspace.apps.api_v1.datasets.streaming.orjson", None):
+        yield from yield_json_page(*args)
+
+
+def make_row(i, num_columns):
+    values = [
+        i,
+        f"name-{i}",
+        1.5 * i,
+        decimal.Decimal(i) / 100,
+        datetime.datetime(2019, 1, 1) + datetime.timedelta(seconds=i),
+        None,
+    ]
+    return tuple(values[j % len(values)] if j else i for j in range(num_columns))
+
+
+def main():
+    for name, num_columns, num_rows in (("narrow", 3, 100_000), ("wide", 100, 10_000)):
+        columns = ["id"] + [f"column_{j}" for j in range(1, num_columns)]
+        rows = [make_row(i, num_columns) for i in range(num_rows)]
+
+        def rows_per_second(func, columns=columns, rows=rows):
+            seconds = min(
+                timeit.repeat(
+                    lambda: sum(
+                        len(chunk) for chunk in func(["id"], columns, iter(rows), "http://test/")
+                    ),
+                    number=1,
+                    repeat=3,
+                )
+            )
+            return len(rows) / seconds
+
+        results = {
+            "previous": rows_per_second(previous_yield_json_page),
+            "json": rows_per_second(yield_json_page_without_orjson),
+            "orjson": rows_per_second(yield_json_page),
+        }
+        print(
+            f"{name} ({num_columns} columns): "
+            + ", ".join(
+                f"{implementation} {result:,.0f} rows/s"
+                for implementation, result in results.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+"""Benchmarks of the proxy's throughput and latency for each class of route
+
+Boots dataworkspace/proxy.py against local stand-ins for everything it talks
+to: the echo server as a tool, a fake admin application, a fake SSO, fake
+Superset, MLflow and mirror servers, and the local Redis. Each scenario makes a
+number of requests through the proxy with a given concurrency, after a warm up,
+and the results are written as JSON so they can be compared from run to run:
+
+- requests per second, and p50 and p99 latency in milliseconds;
+- bytes per second received;
+- Redis commands, and calls to the admin application and to SSO, per request.
+
+It needs the same hosts as the integration tests, so is run in the test
+container, for example by
+
+    make docker-benchmark-proxy ARGS="--output /test-results/benchmark-proxy.json"
+
+The stand-ins other than the echo server run in the same process and event loop
+as the client making the requests. So the results are most useful compared to
+other runs on the same machine, rather than as absolute numbers.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+import redis.asyncio as redis
+from aiohttp import web
+
+from proxy_session import REDIS_KEY_PREFIX
+
+PROXY_PORT = 8011
+ADMIN_PORT = 8012
+MLFLOW_PORT = 8014
+SSO_PORT = 8015
+MIRROR_PORT = 8016
+SUPERSET_PORT = 8018
+ECHO_PORT = 8888
+
+ROOT_DOMAIN = "dataworkspace.test:8000"
+PEER_IP = "1.2.3.4"
+COOKIE_NAME = "data_workspace_session"
+TOKEN = "benchmark-token"
+
+ME_PROFILE = {
+    "email": "benchmark@example.com",
+    "related_emails": [],
+    "contact_email": "benchmark@example.com",
+    "user_id": "7f93c2c7-bc32-43f3-87dc-40d0b8fb2cd2",
+    "first_name": "Bench",
+    "last_name": "Mark",
+}
+
+# (name, host, path, expected status). {stream_bytes} in a path is replaced by --stream-bytes
+HTTP_SCENARIOS = (
+    ("admin", ROOT_DOMAIN, "/benchmark/page", 200),
+    ("admin_streaming", ROOT_DOMAIN, "/benchmark/stream", 200),
+    ("tool", f"testapplication-23b40dd9.{ROOT_DOMAIN}", "/http", 405),
+    (
+        "tool_streaming",
+        f"testapplication-23b40dd9.{ROOT_DOMAIN}",
+        "/stream?bytes={stream_bytes}",
+        200,
+    ),
+    ("superset", f"superset.{ROOT_DOMAIN}", "/superset/welcome/", 200),
+    ("mlflow", f"mlflow--data-science.{ROOT_DOMAIN}", "/", 200),
+    ("mirror", ROOT_DOMAIN, "/__mirror/some/file.tar.gz", 200),
+)
+WEBSOCKET_SCENARIOS = (
+    ("tool_websocket", f"testapplication-23b40dd9.{ROOT_DOMAIN}", "/websockets"),
+)
+
+
+def b64encode_nopadding(to_encode):
+    return base64.urlsafe_b64encode(to_encode).rstrip(b"=")
+
+
+async def create_server(port, routes, calls):
+    @web.middleware
+    async def count_calls(request, handler):
+        calls[port] += 1
+        return await handler(request)
+
+    app = web.Application(middlewares=[count_calls])
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", port)
+    await site.start()
+    return runner.cleanup
+
+
+async def create_stand_ins(calls, stream_bytes):
+    page = b"<html><body>" + b"Data Workspace " * 1000 + b"</body></html>"
+
+    async def handle_page(_):
+        return web.Response(body=page, content_type="text/html")
+
+    async def handle_stream(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        chunk = b"-" * 65536
+        remaining = stream_bytes
+        while remaining > 0:
+            await response.write(chunk[:remaining])
+            remaining -= len(chunk)
+        await response.write_eof()
+        return response
+
+    async def handle_application(_):
+        return web.json_response(
+            {
+                "id": "3b3b2a8e-0b63-4a53-9bb5-4b5ef3f0f7b1",
+                "state": "RUNNING",
+                "proxy_url": f"http://localhost:{ECHO_PORT}",
+                "wrap": "NONE",
+            }
+        )
+
+    async def handle_superset_credentials(_):
+        return web.json_response(
+            {
+                "credentials": {"db_user": "benchmark", "db_password": "benchmark"},
+                "dashboards": ["1", "2"],
+            }
+        )
+
+    async def handle_mlflow_jwt(_):
+        header = b64encode_nopadding(json.dumps({"typ": "JWT", "alg": "EdDSA"}).encode())
+        payload = b64encode_nopadding(
+            json.dumps({"sub": ME_PROFILE["email"], "exp": int(time.time()) + 86400}).encode()
+        )
+        return web.json_response({"jwt": (header + b"." + payload + b".signature").decode()})
+
+    async def handle_ok(_):
+        return web.Response(text="OK")
+
+    async def handle_me(request):
+        if request.headers.get("authorization") != f"Bearer {TOKEN}":
+            return web.json_response({}, status=403)
+        return web.json_response(ME_PROFILE)
+
+    cleanups = [
+        await create_server(
+            ADMIN_PORT,
+            [
+                web.get("/healthcheck", handle_ok),
+                web.get("/benchmark/page", handle_page),
+                web.get("/benchmark/stream", handle_stream),
+                web.get("/api/v1/application/{public_host}", handle_application),
+                web.get("/api/v1/core/get-superset-role-credentials", handle_superset_credentials),
+                web.get("/api/v1/core/generate-mlflow-jwt", handle_mlflow_jwt),
+            ],
+            calls,
+        ),
+        await create_server(SSO_PORT, [web.get("/api/v1/user/me/", handle_me)], calls),
+        await create_server(SUPERSET_PORT, [web.get("/{path:.*}", handle_ok)], calls),
+        await create_server(MLFLOW_PORT, [web.get("/{path:.*}", handle_ok)], calls),
+        await create_server(MIRROR_PORT, [web.get("/{path:.*}", handle_page)], calls),
+    ]
+
+    async def cleanup():
+        for _cleanup in cleanups:
+            await _cleanup()
+
+    return cleanup
+
+
+async def create_process(args, env, stdout):
+    proc = await asyncio.create_subprocess_exec(*args, env=env, stdout=stdout, stderr=stdout)
+
+    async def cleanup():
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+    return cleanup
+
+
+async def create_proxy(redis_url, proxy_workers, stdout):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(
+            [os.path.join(root, "dataworkspace")]
+            + ([os.environ["PYTHONPATH"]] if "PYTHONPATH" in os.environ else [])
+        ),
+        "PROXY_PORT": str(PROXY_PORT),
+        "PROXY_WORKERS": str(proxy_workers),
+        "UPSTREAM_ROOT": f"http://localhost:{ADMIN_PORT}",
+        "AUTHBROKER_URL": f"http://localhost:{SSO_PORT}/",
+        "AUTHBROKER_CLIENT_ID": "benchmark-client-id",
+        "AUTHBROKER_CLIENT_SECRET": "benchmark-client-secret",
+        "SUPERSET_ROOT": f"http://localhost:{SUPERSET_PORT}",
+        "FLOWER_ROOT": "http://localhost:1",
+        "MLFLOW_PORT": str(MLFLOW_PORT),
+        "MIRROR_REMOTE_ROOT": f"http://localhost:{MIRROR_PORT}/some-remote-folder/",
+        "REDIS_URL": redis_url,
+        "APPLICATION_ROOT_DOMAIN": ROOT_DOMAIN,
+        "ALLOWED_HOSTS__1": "dataworkspace.test",
+        "APPLICATION_IP_WHITELIST__1": f"{PEER_IP}/32",
+        "X_FORWARDED_FOR_TRUSTED_HOPS": "1",
+        "HAWK_SENDERS__1__id": "benchmark",
+        "HAWK_SENDERS__1__key": "benchmark",
+        "HAWK_SENDERS__1__algorithm": "sha256",
+        "METRICS_SERVICE_DISCOVERY_BASIC_AUTH_USER": "benchmark",
+        "METRICS_SERVICE_DISCOVERY_BASIC_AUTH_PASSWORD": "benchmark",
+    }
+    return await create_process([sys.executable, "-m", "proxy"], env, stdout)
+
+
+async def create_echo_server(stdout):
+    echo_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "echo_server.py")
+    return await create_process([sys.executable, echo_server], os.environ, stdout)
+
+
+async def create_session(redis_client):
+    # Rather than going through SSO, the session is created directly in Redis, as the proxy
+    # would after a successful sign in
+    cookie_value = secrets.token_urlsafe(64)
+    redis_key = f"{REDIS_KEY_PREFIX}___{cookie_value}___{PEER_IP}".encode("ascii")
+    await redis_client.hset(redis_key, mapping={b"staff_sso_access_token": TOKEN.encode()})
+    await redis_client.expire(redis_key, 60 * 60)
+    return cookie_value
+
+
+async def until_succeeds(session, url, headers):
+    for _ in range(120):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise Exception(f"{url} did not succeed")
+
+
+async def redis_commands(redis_client):
+    commandstats = await redis_client.info("commandstats")
+    return sum(stats["calls"] for stats in commandstats.values())
+
+
+async def run_concurrently(num_requests, concurrency, make_request):
+    latencies = []
+    counts = Counter()
+    remaining = iter(range(num_requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                ok, num_bytes = await make_request()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok, num_bytes = False, 0
+            latencies.append(time.perf_counter() - start)
+            counts["errors"] += not ok
+            counts["bytes"] += num_bytes
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, counts
+
+
+async def run_scenario(name, make_request, num_requests, concurrency, warmup, redis_client, calls):
+    await run_concurrently(warmup, concurrency, make_request)
+
+    calls.clear()
+    redis_commands_before = await redis_commands(redis_client)
+    seconds, latencies, counts = await run_concurrently(num_requests, concurrency, make_request)
+    # The INFO command used to count the commands is itself counted
+    redis_commands_during = await redis_commands(redis_client) - redis_commands_before - 1
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        "name": name,
+        "requests": num_requests,
+        "concurrency": concurrency,
+        "errors": counts["errors"],
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(num_requests / seconds, 1),
+        "bytes_per_second": round(counts["bytes"] / seconds),
+        "latency_p50_ms": round(statistics.median(latencies_ms), 2),
+        "latency_p99_ms": round(latencies_ms[int(0.99 * (len(latencies_ms) - 1))], 2),
+        "redis_commands_per_request": round(redis_commands_during / num_requests, 3),
+        "admin_api_calls_per_request": round(calls[ADMIN_PORT] / num_requests, 3),
+        "sso_calls_per_request": round(calls[SSO_PORT] / num_requests, 3),
+    }
+
+
+def http_request(session, host, path, expected_status, cookie_value):
+    url = f"http://127.0.0.1:{PROXY_PORT}{path}"
+    headers = {
+        "host": host,
+        "x-forwarded-for": PEER_IP,
+        "cookie": f"{COOKIE_NAME}={cookie_value}",
+    }
+
+    async def make_request():
+        async with session.get(url, headers=headers, allow_redirects=False) as response:
+            num_bytes = 0
+            async for chunk in response.content.iter_any():
+                num_bytes += len(chunk)
+            return response.status == expected_status, num_bytes
+
+    return make_request
+
+
+async def run_websocket_scenario(
+    name, session, host, path, cookie_value, num_messages, concurrency, warmup, redis_client, calls
+):
+    # Each request is a round trip of a message over one of concurrency websockets
+    url = f"http://127.0.0.1:{PROXY_PORT}{path}"
+    headers = {
+        "host": host,
+        "x-forwarded-for": PEER_IP,
+        "cookie": f"{COOKIE_NAME}={cookie_value}",
+    }
+    websockets = asyncio.Queue()
+    for _ in range(concurrency):
+        websocket = await session.ws_connect(url, headers=headers)
+        await websocket.receive()  # The echo server first sends the request headers
+        websockets.put_nowait(websocket)
+
+    message = "-" * 1024
+
+    async def make_request():
+        websocket = await websockets.get()
+        try:
+            await websocket.send_str(message)
+            response = await websocket.receive()
+            ok = response.type == aiohttp.WSMsgType.TEXT and response.data == message
+            return ok, len(message) if ok else 0
+        finally:
+            websockets.put_nowait(websocket)
+
+    try:
+        return await run_scenario(
+            name, make_request, num_messages, concurrency, warmup, redis_client, calls
+        )
+    finally:
+        while not websockets.empty():
+            await websockets.get_nowait().close()
+
+
+async def async_main(args):
+    if args.proxy_log:
+        with open(args.proxy_log, "ab") as log:
+            return await run_benchmarks(args, log)
+    return await run_benchmarks(args, asyncio.subprocess.DEVNULL)
+
+
+async def run_benchmarks(args, log):
+    calls = Counter()
+    redis_client = redis.from_url(args.redis_url)
+    cleanups = [
+        await create_stand_ins(calls, args.stream_bytes),
+        await create_echo_server(log),
+        await create_proxy(args.redis_url, args.proxy_workers, log),
+    ]
+    results = []
+    try:
+        session = aiohttp.ClientSession(
+            auto_decompress=False,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(total=120),
+        )
+        async with session:
+            await until_succeeds(
+                session,
+                f"http://127.0.0.1:{PROXY_PORT}/healthcheck",
+                {"host": ROOT_DOMAIN},
+            )
+            cookie_value = await create_session(redis_client)
+
+            for name, host, path, expected_status in HTTP_SCENARIOS:
+                if args.scenario and name not in args.scenario:
+                    continue
+                is_streaming = name.endswith("_streaming")
+                results.append(
+                    await run_scenario(
+                        name,
+                        http_request(
+                            session,
+                            host,
+                            path.format(stream_bytes=args.stream_bytes),
+                            expected_status,
+                            cookie_value,
+                        ),
+                        args.streaming_requests if is_streaming else args.requests,
+                        args.concurrency,
+                        args.warmup,
+                        redis_client,
+                        calls,
+                    )
+                )
+
+            for name, host, path in WEBSOCKET_SCENARIOS:
+                if args.scenario and name not in args.scenario:
+                    continue
+                results.append(
+                    await run_websocket_scenario(
+                        name,
+                        session,
+                        host,
+                        path,
+                        cookie_value,
+                        args.requests,
+                        args.concurrency,
+                        args.warmup,
+                        redis_client,
+                        calls,
+                    )
+                )
+    finally:
+        for cleanup in reversed(cleanups):
+            await cleanup()
+        await redis_client.close()
+
+    return {
+        "started_at": args.started_at,
+        "python": sys.version.split()[0],
+        "proxy_workers": args.proxy_workers,
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--streaming-requests", type=int, default=100)
+    parser.add_argument("--stream-bytes", type=int, default=10_000_000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--proxy-workers", type=int, default=1)
+    parser.add_argument(
+        "--redis-url", default=os.environ.get("REDIS_URL", "redis://localhost:6379")
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[scenario[0] for scenario in HTTP_SCENARIOS + WEBSOCKET_SCENARIOS],
+        help="Run only this scenario. Can be given more than once. Defaults to all",
+    )
+    parser.add_argument("--proxy-log", help="File to append the output of the proxy to")
+    parser.add_argument("--output", help="File to write the JSON results to. Defaults to stdout")
+    args = parser.parse_args()
+    args.started_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    results = asyncio.run(async_main(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Micro-benchmarks of looking up peer IPs in the proxy's allowlists
+
+Run from the root of the repository, with the directory containing the proxy
+on the path, for example
+
+    PYTHONPATH=dataworkspace python -m test.benchmark_proxy_networks
+
+For each allowlist size, reports the time per lookup of the previous linear scan
+of the allowlist, and of NetworkLookup with and without its cache of recent
+decisions
+"""
+
+import ipaddress
+import random
+import timeit
+
+from proxy_networks import NetworkLookup
+
+
+def linear_scan(ip_allowlist, peer_ip):
+    return any(
+        ipaddress.IPv4Address(peer_ip) in ipaddress.IPv4Network(address_or_subnet)
+        for address_or_subnet in ip_allowlist
+    )
+
+
+def main():
+    rng = random.Random(0)
+    for size in (10, 100, 1000, 5000):
+        ip_allowlist = [
+            (
+                f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.0/24"
+                if i % 2
+                else f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"
+            )
+            for i in range(size)
+        ]
+        ip_allowlist = list(dict.fromkeys(ip_allowlist))
+        peer_ips = [
+            f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"
+            for _ in range(200)
+        ]
+
+        lookup = NetworkLookup((address_or_subnet, True) for address_or_subnet in ip_allowlist)
+
+        def time_per_lookup(func, peer_ips, number):
+            seconds = timeit.timeit(lambda: [func(peer_ip) for peer_ip in peer_ips], number=number)
+            return seconds / (number * len(peer_ips))
+
+        results = {
+            # The linear scan is slow enough for large allowlists that fewer IPs are looked up
+            "linear_scan": time_per_lookup(
+                lambda peer_ip, ip_allowlist=ip_allowlist: linear_scan(ip_allowlist, peer_ip),
+                peer_ips[:10],
+                1,
+            ),
+            # pylint: disable=protected-access
+            "network_lookup_uncached": time_per_lookup(lookup._lookup, peer_ips, 100),
+            "network_lookup_cached": time_per_lookup(lookup.lookup, peer_ips, 100),
+        }
+        print(
+            f"{size} entries: "
+            + ", ".join(f"{name} {seconds * 1_000_000:.2f}µs" for name, seconds in results.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,18 @@ async def async_main():
             data, status=405, headers={"from-upstream": "upstream-header-value"}
         )
 
+    async def handle_stream(request):
+        # Used to benchmark streaming responses through the proxy
+        response = web.StreamResponse()
+        await response.prepare(request)
+        chunk = b"-" * 65536
+        remaining = int(request.query.get("bytes", "10000000"))
+        while remaining > 0:
+            await response.write(chunk[:remaining])
+            remaining -= len(chunk)
+        await response.write_eof()
+        return response
+
     async def handle_websockets(request):
         wsock = web.WebSocketResponse()
         await wsock.prepare(request)
@@ -45,6 +57,7 @@ async def async_main():
         [
             web.get("/http", handle_http),
             web.patch("/http", handle_http),
+            web.get("/stream", handle_stream),
             web.get("/websockets", handle_websockets),
         ]
     )
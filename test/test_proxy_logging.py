@@ -0,0 +1,64 @@
+import logging
+import unittest
+
+from proxy_logging import DroppingQueueHandler, start_queue_logging
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def test_records_are_handled_by_another_thread(self):
+        handler = RecordingHandler()
+        logger = logging.getLogger("test_proxy_logging_threads")
+        queue_handler, listener = start_queue_logging([logger], handler, 10)
+
+        logger.warning("Record %s", 1)
+        listener.stop()
+
+        self.assertEqual(handler.messages, ["Record 1"])
+        self.assertEqual(queue_handler.counts["queued", "WARNING"], 1)
+
+    def test_records_are_dropped_and_counted_when_queue_is_full(self):
+        queue_handler = DroppingQueueHandler(2)
+        logger = logging.getLogger("test_proxy_logging_dropped")
+        logger.handlers = [queue_handler]
+
+        for i in range(4):
+            logger.warning("Record %s", i)
+        self.assertEqual(queue_handler.counts["dropped", "WARNING"], 2)
+
+        queue_handler.queue.get_nowait()
+        queue_handler.queue.get_nowait()
+        logger.warning("Record %s", 4)
+
+        self.assertEqual(
+            queue_handler.queue.get_nowait().getMessage(),
+            "Dropped 2 log records since the log queue was full",
+        )
+        self.assertEqual(queue_handler.queue.get_nowait().getMessage(), "Record 4")
+
+    def test_warnings_replace_lower_level_records_when_queue_is_full(self):
+        queue_handler = DroppingQueueHandler(2)
+        logger = logging.getLogger("test_proxy_logging_evicted")
+        logger.setLevel(logging.INFO)
+        logger.handlers = [queue_handler]
+
+        logger.warning("Record %s", 0)
+        logger.info("Record %s", 1)
+        logger.info("Record %s", 2)
+        logger.error("Record %s", 3)
+        logger.warning("Record %s", 4)
+
+        self.assertEqual(queue_handler.counts["dropped", "INFO"], 2)
+        self.assertEqual(queue_handler.counts["dropped", "WARNING"], 1)
+        self.assertEqual(queue_handler.counts["queued", "ERROR"], 1)
+        self.assertEqual(queue_handler.queue.unfinished_tasks, 2)
+        self.assertEqual(queue_handler.queue.get_nowait().getMessage(), "Record 0")
+        self.assertEqual(queue_handler.queue.get_nowait().getMessage(), "Record 3")
@@ -0,0 +1,62 @@
+import unittest
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+from prometheus_client import CollectorRegistry, generate_latest
+
+from proxy_metrics import REGISTRY, CountsCollector, upstream_trace_config
+
+
+class TestCountsCollector(unittest.TestCase):
+    def test_counts_with_one_and_many_labels(self):
+        counts = Counter({"hit": 2, "miss": 1})
+        registry = CollectorRegistry()
+        registry.register(CountsCollector("test_cache", "Test cache", ["result"], lambda: counts))
+        registry.register(
+            CountsCollector(
+                "test_log", "Test log", ["outcome", "level"], lambda: {("dropped", "INFO"): 3}
+            )
+        )
+        counts["hit"] += 1
+
+        output = generate_latest(registry).decode("utf-8")
+        self.assertIn('test_cache_total{result="hit"} 3.0', output)
+        self.assertIn('test_cache_total{result="miss"} 1.0', output)
+        self.assertIn('test_log_total{level="INFO",outcome="dropped"} 3.0', output)
+
+
+class TestUpstreamTraceConfig(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_are_timed_by_upstream(self):
+        async def handle(_):
+            return web.Response(text="ok")
+
+        upstream = web.Application()
+        upstream.add_routes([web.get("/", handle)])
+        runner = web.AppRunner(upstream)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 8021).start()
+
+        def get_sample(name):
+            return REGISTRY.get_sample_value(name, {"upstream": "test_upstream"}) or 0
+
+        count_before = get_sample("proxy_upstream_response_headers_seconds_count")
+        trace_config = upstream_trace_config(lambda url: "test_upstream")
+        try:
+            async with aiohttp.ClientSession(trace_configs=[trace_config]) as session:
+                for _ in range(3):
+                    async with session.get("http://127.0.0.1:8021/") as response:
+                        await response.read()
+        finally:
+            await runner.cleanup()
+
+        self.assertEqual(
+            get_sample("proxy_upstream_response_headers_seconds_count") - count_before, 3
+        )
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "proxy_upstream_connections_total",
+                {"upstream": "test_upstream", "result": "reused"},
+            ),
+            2,
+        )
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from proxy_mirror_cache import MirrorCache
+
+
+class TestMirrorCache(unittest.IsolatedAsyncioTestCase):
+    # The servers are started in asyncSetUp, since they need the test's event loop
+    # pylint: disable=attribute-defined-outside-init
+    async def asyncSetUp(self):
+        self.upstream_requests = []
+        self.release_upstream = asyncio.Event()
+        self.release_upstream.set()
+
+        async def handle_upstream(request):
+            self.upstream_requests.append(
+                (request.match_info["path"], request.headers.get("if-none-match"))
+            )
+            self.upstream_user_agents.append(request.headers.get("user-agent"))
+            try:
+                body = self.upstream_bodies[request.match_info["path"]]
+            except KeyError:
+                return web.Response(status=404, text="not found")
+            etag = f'"{len(body)}"'
+            if request.headers.get("if-none-match") == etag:
+                return web.Response(status=304, headers={"etag": etag})
+
+            response = web.StreamResponse(
+                headers={
+                    "etag": etag,
+                    "content-type": "application/octet-stream",
+                    **self.upstream_headers,
+                }
+            )
+            await response.prepare(request)
+            await response.write(body[:10])
+            await self.release_upstream.wait()
+            await response.write(body[10:])
+            return response
+
+        self.upstream_bodies = {}
+        self.upstream_headers = {}
+        self.upstream_user_agents = []
+        upstream = web.Application()
+        upstream.add_routes([web.get("/{path:.*}", handle_upstream)])
+        self.upstream_runner = web.AppRunner(upstream)
+        await self.upstream_runner.setup()
+        await web.TCPSite(self.upstream_runner, "127.0.0.1", 8019).start()
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.client_session = aiohttp.ClientSession(auto_decompress=False)
+        self.cache = MirrorCache(
+            self.cache_dir.name, 1000, self.client_session, aiohttp.ClientTimeout()
+        )
+
+        async def with_cookie(response):
+            return response
+
+        async def handle(request):
+            path = request.match_info["path"]
+
+            async def handle_uncached():
+                return web.Response(status=502, text="uncached")
+
+            return await self.cache.handle(
+                request,
+                path,
+                URL("http://127.0.0.1:8019/" + path),
+                CIMultiDict(request.headers),
+                with_cookie,
+                handle_uncached,
+            )
+
+        proxy = web.Application()
+        proxy.add_routes([web.route("*", "/{path:.*}", handle)])
+        self.proxy_runner = web.AppRunner(proxy)
+        await self.proxy_runner.setup()
+        await web.TCPSite(self.proxy_runner, "127.0.0.1", 8020).start()
+
+    async def asyncTearDown(self):
+        await self.proxy_runner.cleanup()
+        await self.upstream_runner.cleanup()
+        await self.client_session.close()
+        self.cache_dir.cleanup()
+
+    async def get(self, path, headers=None):
+        async with self.client_session.get(
+            "http://127.0.0.1:8020/" + path, headers=headers or {}
+        ) as response:
+            return response.status, await response.read()
+
+    async def get_headers(self, path, headers=None):
+        async with self.client_session.get(
+            "http://127.0.0.1:8020/" + path, headers=headers or {}
+        ) as response:
+            await response.read()
+            return response.headers
+
+    async def test_package_files_are_fetched_once(self):
+        self.upstream_bodies["package.whl"] = b"a" * 100
+
+        self.assertEqual(await self.get("package.whl"), (200, b"a" * 100))
+        self.assertEqual(await self.get("package.whl"), (200, b"a" * 100))
+        self.assertEqual(self.upstream_requests, [("package.whl", None)])
+
+    async def test_index_pages_are_revalidated(self):
+        self.upstream_bodies["simple/package/"] = b"b" * 100
+
+        self.assertEqual(await self.get("simple/package/"), (200, b"b" * 100))
+        self.assertEqual(await self.get("simple/package/"), (200, b"b" * 100))
+        self.upstream_bodies["simple/package/"] = b"c" * 200
+        self.assertEqual(await self.get("simple/package/"), (200, b"c" * 200))
+        self.assertEqual(
+            self.upstream_requests,
+            [
+                ("simple/package/", None),
+                ("simple/package/", '"100"'),
+                ("simple/package/", '"100"'),
+            ],
+        )
+
+    async def test_concurrent_requests_share_a_fetch(self):
+        self.upstream_bodies["package.whl"] = bytes(range(100))
+        self.release_upstream.clear()
+
+        requests = [asyncio.ensure_future(self.get("package.whl")) for _ in range(5)]
+        await asyncio.sleep(0.1)
+        self.release_upstream.set()
+
+        self.assertEqual(await asyncio.gather(*requests), [(200, bytes(range(100)))] * 5)
+        self.assertEqual(self.upstream_requests, [("package.whl", None)])
+
+    async def test_range_requests(self):
+        self.upstream_bodies["video.mp4"] = bytes(range(100))
+
+        self.assertEqual(
+            await self.get("video.mp4", headers={"range": "bytes=10-19"}),
+            (206, bytes(range(10, 20))),
+        )
+        self.assertEqual(
+            await self.get("video.mp4", headers={"range": "bytes=90-"}),
+            (206, bytes(range(90, 100))),
+        )
+
+    async def test_least_recently_used_files_are_evicted(self):
+        for name in ("1.whl", "2.whl", "3.whl"):
+            self.upstream_bodies[name] = b"d" * 400
+
+        await self.get("1.whl")
+        await self.get("2.whl")
+        await self.get("1.whl")
+        await self.get("3.whl")
+        await self.get("1.whl")
+        await self.get("2.whl")
+
+        self.assertEqual(
+            [path for path, _ in self.upstream_requests], ["1.whl", "2.whl", "3.whl", "2.whl"]
+        )
+        self.assertLessEqual(
+            sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(self.cache_dir.name)
+                for name in names
+            ),
+            1000,
+        )
+
+    async def test_upstream_errors_are_passed_through_and_not_cached(self):
+        self.assertEqual(await self.get("missing.whl"), (404, b"not found"))
+        self.assertEqual(await self.get("missing.whl"), (404, b"not found"))
+        self.assertEqual(self.upstream_requests, [("missing.whl", None)] * 2)
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir.name, str(os.getpid()))), [])
+
+    async def test_representation_headers_are_cached(self):
+        self.upstream_bodies["package.tar.gz"] = b"e" * 100
+        self.upstream_headers["content-encoding"] = "gzip"
+
+        for _ in range(2):
+            headers = await self.get_headers("package.tar.gz")
+            self.assertEqual(headers["content-encoding"], "gzip")
+            self.assertEqual(headers["content-type"], "application/octet-stream")
+        self.assertEqual(self.upstream_requests, [("package.tar.gz", None)])
+
+    async def test_request_headers_are_passed_upstream(self):
+        self.upstream_bodies["simple/package/"] = b"f" * 100
+
+        await self.get("simple/package/", headers={"user-agent": "pip/24.0"})
+        await self.get(
+            "simple/package/", headers={"user-agent": "pip/24.0", "if-none-match": '"1"'}
+        )
+
+        self.assertEqual(self.upstream_user_agents, ["pip/24.0", "pip/24.0"])
+        self.assertEqual(
+            self.upstream_requests, [("simple/package/", None), ("simple/package/", '"100"')]
+        )
@@ -0,0 +1,51 @@
+import ipaddress
+import unittest
+
+from proxy_networks import NetworkLookup
+
+
+class TestNetworkLookup(unittest.TestCase):
+    def test_ipv4_addresses_and_subnets(self):
+        lookup = NetworkLookup([("1.2.3.4", "a"), ("5.6.0.0/16", "b")])
+
+        self.assertEqual(lookup.lookup("1.2.3.4"), "a")
+        self.assertEqual(lookup.lookup("5.6.7.8"), "b")
+        self.assertIsNone(lookup.lookup("1.2.3.5"))
+        self.assertIsNone(lookup.lookup("5.7.0.0"))
+
+    def test_ipv6_addresses_and_subnets(self):
+        lookup = NetworkLookup([("2001:db8::/32", "a"), ("1.2.3.0/24", "b")])
+
+        self.assertEqual(lookup.lookup("2001:db8::1"), "a")
+        self.assertIsNone(lookup.lookup("2001:db9::1"))
+        self.assertIsNone(lookup.lookup("::ffff:1.2.3.4"))
+
+    def test_first_matching_network_wins(self):
+        lookup = NetworkLookup([("10.0.0.0/24", "a"), ("10.0.0.0/8", "b"), ("10.0.0.1", "c")])
+
+        self.assertEqual(lookup.lookup("10.0.0.1"), "a")
+        self.assertEqual(lookup.lookup("10.1.0.1"), "b")
+
+    def test_invalid_and_missing_addresses_do_not_match(self):
+        lookup = NetworkLookup([("0.0.0.0/0", "a")])
+
+        self.assertIsNone(lookup.lookup("not-an-ip"))
+        self.assertIsNone(lookup.lookup(None))
+        self.assertEqual(lookup.lookup("8.8.8.8"), "a")
+
+    def test_matches_linear_scan_of_many_networks(self):
+        networks = [f"10.{i // 256}.{i % 256}.0/24" for i in range(0, 4000, 3)] + [
+            f"172.16.{i}.{j}/32" for i in range(4) for j in range(0, 256, 7)
+        ]
+        lookup = NetworkLookup((network, network) for network in networks)
+
+        for ip in ["10.0.3.1", "10.0.4.1", "10.15.159.255", "172.16.2.14", "172.16.2.15"]:
+            expected = next(
+                (
+                    network
+                    for network in networks
+                    if ipaddress.ip_address(ip) in ipaddress.ip_network(network)
+                ),
+                None,
+            )
+            self.assertEqual(lookup.lookup(ip), expected)
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from proxy_upstreams import UpstreamClientSessions
+
+
+class TestUpstreamClientSessions(unittest.IsolatedAsyncioTestCase):
+    async def test_pools_are_configured_per_upstream(self):
+        async with UpstreamClientSessions(
+            lambda url: "admin", {"ADMIN": {"LIMIT": "5", "KEEPALIVE_TIMEOUT": "10"}}
+        ) as sessions:
+            self.assertEqual(sessions.connectors["admin"].limit, 5)
+            self.assertEqual(sessions.connectors["sso"].limit, 50)
+            self.assertEqual(sessions.connectors["application"].limit, 1000)
+            self.assertEqual(sessions.connectors["application"].limit_per_host, 100)
+
+    async def test_requests_to_one_upstream_do_not_wait_for_another(self):
+        release = asyncio.Event()
+
+        async def handle_slow(_):
+            await release.wait()
+            return web.Response(text="slow")
+
+        async def handle_fast(_):
+            return web.Response(text="fast")
+
+        app = web.Application()
+        app.add_routes([web.get("/slow", handle_slow), web.get("/fast", handle_fast)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 8022).start()
+
+        async def get(sessions, path):
+            async with sessions.get(f"http://127.0.0.1:8022{path}") as response:
+                return await response.text()
+
+        try:
+            async with UpstreamClientSessions(
+                lambda url: "application" if url.path == "/slow" else "admin",
+                {"APPLICATION": {"LIMIT_PER_HOST": "2"}},
+            ) as sessions:
+                slow = [asyncio.ensure_future(get(sessions, "/slow")) for _ in range(5)]
+                self.assertEqual(await asyncio.wait_for(get(sessions, "/fast"), 1), "fast")
+                release.set()
+                self.assertEqual(await asyncio.gather(*slow), ["slow"] * 5)
+        finally:
+            await runner.cleanup()